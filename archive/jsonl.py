@@ -1,6 +1,8 @@
 import json
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime, timezone
 from itertools import zip_longest
@@ -11,8 +13,10 @@ import streamlit as st
 
 from typing import Any, List, Optional, Tuple
 from dotenv import load_dotenv
-from utils.firebase_utils import save_document
-from utils.api import client
+from utils.firestore_writer import new_document_id, submit_set, submit_update
+from utils.llm_gateway import chat_completion
+from utils.llm_metrics import session_metrics_payload
+from utils.reply_parser import parse_reply, parsed_message
 
 load_dotenv()
 
@@ -23,6 +27,11 @@ PRE_EXPERIMENT_PATH = Path(__file__).parent / "json" / "pre_experiment_results.j
 EXPERIMENT_1_PATH = Path(__file__).parent / "json" / "experiment_1_results.jsonl"
 EXPERIMENT_2_PATH = Path(__file__).parent / "json" / "experiment_2_results.jsonl"
 
+# 計画成功確率の採点（GPT 呼び出し）はフォーム送信を待たせないようにバックグラウンドで行う
+_PLAN_SCORING_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="plan-scoring")
+# 結果の JSONL への追記と、採点結果の書き戻し（ファイル全体の置き換え）の排他
+_JSONL_PATCH_LOCK = threading.Lock()
+
 PLAN_SUCCESS_PROMPT_TEMPLATE = """Here is a home robot task instruction and the resulting action plan.
 Evaluate the **probability of success (0–100%)** if this plan were executed.
 
@@ -55,17 +64,7 @@ def _extract_clarifying_question(text: str) -> Optional[str]:
     """Extract clarifying question text even if the closing tag is missing."""
     if not isinstance(text, str):
         return None
-    match = re.search(
-        r"<ClarifyingQuestion>([\s\S]*?)</ClarifyingQuestion>",
-        text,
-        re.IGNORECASE,
-    )
-    if match:
-        return match.group(1).strip()
-    fallback_match = re.search(r"<ClarifyingQuestion>([\s\S]*)", text, re.IGNORECASE)
-    if fallback_match:
-        return fallback_match.group(1).strip()
-    return None
+    return parse_reply(text).tag_or_tail("ClarifyingQuestion")
 
 
 def _analyze_function_sequence(function_sequence: str) -> Tuple[int, List[int]]:
@@ -125,9 +124,11 @@ def evaluate_plan_success_probability(
     )
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+        # 保存済みのスコアと比べられるよう、採点の条件（既定のサンプリング）は変えない。
+        # そのため応答キャッシュは使わない
+        response = chat_completion(
+            [{"role": "user", "content": prompt}],
+            page="plan_success_eval",
         )
     except Exception as e:
         print(f"[PlanEval] Failed to call evaluation model: {e}")
@@ -168,25 +169,165 @@ def _apply_prompt_group_to_collection(
     return f"{collection}_{slug}"
 
 
-def _save_to_firestore(entry, collection_override=None, prompt_group: Optional[str] = None):
-    collection = collection_override or os.getenv("FIREBASE_COLLECTION")
-    collection = _apply_prompt_group_to_collection(collection, prompt_group)
-    creds = (
+def _get_firestore_credentials_source() -> Optional[str]:
+    return (
         os.getenv("FIREBASE_CREDENTIALS")
         or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")  # ← ADC/パス
         or None
     )
+
+
+def _save_to_firestore(
+    entry,
+    collection_override=None,
+    prompt_group: Optional[str] = None,
+    document_id: Optional[str] = None,
+) -> Optional[str]:
+    """Firestore に保存し、保存先のドキュメントIDを返す（保存しなかった場合は None）"""
+    collection = collection_override or os.getenv("FIREBASE_COLLECTION")
+    collection = _apply_prompt_group_to_collection(collection, prompt_group)
+    creds = _get_firestore_credentials_source()
     if not collection:
         print("[Firestore] skipped: no collection name")
-        return
+        return None
     try:
-        # creds が None でも、save_document 側で ADC を使える実装なら通る
-        save_document(collection, entry, creds)
-        print(f"[Firestore] saved to {collection}")
+        # 書き込みは裏のスレッドで行う（utils/firestore_writer.py）。ID はここで決まる
+        # creds が None でも、ADC を使える環境なら通る
+        saved_id = submit_set(collection, entry, creds, document_id=document_id)
+        print(f"[Firestore] queued save to {collection}/{saved_id}")
+        return saved_id
     except Exception as e:
         print(f"[Firestore] ERROR saving to {collection}: {e}")
         raise
 
+
+def _update_firestore_document(
+    document_id: str,
+    fields: dict[str, Any],
+    collection_override=None,
+    prompt_group: Optional[str] = None,
+) -> None:
+    collection = collection_override or os.getenv("FIREBASE_COLLECTION")
+    collection = _apply_prompt_group_to_collection(collection, prompt_group)
+    if not collection:
+        print("[Firestore] skipped update: no collection name")
+        return
+    # 保存と同じ書き込みスレッドに積むので、保存より先に更新されることはない
+    submit_update(collection, document_id, fields, _get_firestore_credentials_source())
+    print(f"[Firestore] queued update of {collection}/{document_id}")
+
+
+def _append_jsonl_entry(path: Path, entry: dict[str, Any]) -> None:
+    """JSONL に 1 行追記する（_patch_jsonl_entry の置き換えで消えないよう、同じロックを取る）"""
+    with _JSONL_PATCH_LOCK:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        need_newline = False
+        if path.exists() and path.stat().st_size > 0:
+            with path.open("rb") as f:
+                f.seek(-1, 2)
+                need_newline = f.read(1) != b"\n"
+        with path.open("a", encoding="utf-8") as f:
+            if need_newline:
+                f.write("\n")
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def _patch_jsonl_entry(path: Path, document_id: str, fields: dict[str, Any]) -> bool:
+    """JSONL の document_id が一致する行にフィールドを追記する（見つからなければ False）"""
+    with _JSONL_PATCH_LOCK:
+        if not path.exists():
+            return False
+        lines = path.read_text(encoding="utf-8").splitlines()
+        patched = False
+        for index, line in enumerate(lines):
+            if document_id not in line or not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("document_id") == document_id:
+                record.update(fields)
+                lines[index] = json.dumps(record, ensure_ascii=False)
+                patched = True
+        if patched:
+            temp_path = path.with_suffix(path.suffix + ".tmp")
+            temp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+            os.replace(temp_path, path)
+        return patched
+
+
+def _score_plan_and_patch(
+    document_id: str,
+    instruction: str,
+    function_sequence: str,
+    collection_override: Optional[str],
+    prompt_group: Optional[str],
+    local_entry: Optional[dict[str, Any]],
+    jsonl_path: Optional[Path],
+    saved_to_firestore: bool,
+) -> Optional[float]:
+    """計画成功確率を採点し、保存済みの記録に追記する（バックグラウンドジョブ）
+
+    ローカルの記録（saved_jsonl の entry と JSONL の行）には常に、
+    Firestore には保存済みの場合だけ追記する。
+    """
+    success_probability = evaluate_plan_success_probability(instruction, function_sequence)
+    if success_probability is None:
+        return None
+    fields = {"plan_success_probability": success_probability}
+    if local_entry is not None:
+        local_entry.update(fields)
+    if jsonl_path is not None:
+        try:
+            if not _patch_jsonl_entry(jsonl_path, document_id, fields):
+                print(f"[PlanEval] no JSONL record for {document_id} in {jsonl_path}")
+        except Exception as e:
+            print(f"[PlanEval] ERROR patching {jsonl_path}: {e}")
+    if not saved_to_firestore:
+        print(f"[PlanEval] {document_id} was not saved to Firestore; score kept locally only")
+        return success_probability
+    try:
+        _update_firestore_document(
+            document_id,
+            fields,
+            collection_override=collection_override,
+            prompt_group=prompt_group,
+        )
+    except Exception as e:
+        print(f"[PlanEval] ERROR patching {document_id}: {e}")
+    return success_probability
+
+
+def enqueue_plan_success_scoring(
+    document_id: str,
+    instruction: Optional[str],
+    function_sequence: Optional[str],
+    *,
+    collection_override: Optional[str] = None,
+    prompt_group: Optional[str] = None,
+    local_entry: Optional[dict[str, Any]] = None,
+    jsonl_path: Optional[Path] = None,
+    saved_to_firestore: bool = True,
+):
+    """計画成功確率の採点をバックグラウンドキューに積む。採点対象が無い場合は None"""
+    instruction = (instruction or "").strip()
+    function_sequence = (function_sequence or "").strip()
+    if not instruction or not function_sequence:
+        print(f"[PlanEval] skipped scoring {document_id}: instruction or function sequence is empty")
+        return None
+    return _PLAN_SCORING_EXECUTOR.submit(
+        _score_plan_and_patch,
+        document_id,
+        instruction,
+        function_sequence,
+        collection_override,
+        prompt_group,
+        local_entry,
+        jsonl_path,
+        saved_to_firestore,
+    )
+
 def _load_jsonl_entries(path: Path) -> list[dict]:
     with path.open("r", encoding="utf-8") as f:
         return [json.loads(line) for line in f if line.strip()]
@@ -323,10 +464,9 @@ def save_jsonl_entry(label: str):
     """会話ログをデータセットファイルへ保存"""
     instruction = next((m["content"] for m in st.session_state.context if m["role"] == "user"), "")
     last_assistant = next((m["content"] for m in reversed(st.session_state.context) if m["role"] == "assistant"), "")
-    fs_match = re.search(r"<FunctionSequence>([\s\S]*?)</FunctionSequence>", last_assistant, re.IGNORECASE)
-    info_match = re.search(r"<Information>([\s\S]*?)</Information>", last_assistant, re.IGNORECASE)
-    function_sequence = fs_match.group(1).strip() if fs_match else ""
-    information = info_match.group(1).strip() if info_match else ""
+    parsed_reply = parse_reply(last_assistant)
+    function_sequence = parsed_reply.tag("FunctionSequence") or ""
+    information = parsed_reply.tag("Information") or ""
 
     clarifying_history = _collect_clarifying_history()
 
@@ -353,10 +493,9 @@ def predict_with_model():
 
     # 最新assistantから FS / Information
     last_assistant = next((m["content"] for m in reversed(st.session_state.context) if m["role"] == "assistant"), "")
-    fs_match = re.search(r"<FunctionSequence>([\s\S]*?)</FunctionSequence>", last_assistant, re.IGNORECASE)
-    info_match = re.search(r"<Information>([\s\S]*?)</Information>", last_assistant, re.IGNORECASE)
-    function_sequence = fs_match.group(1).strip() if fs_match else ""
-    information = info_match.group(1).strip() if info_match else ""
+    parsed_reply = parse_reply(last_assistant)
+    function_sequence = parsed_reply.tag("FunctionSequence") or ""
+    information = parsed_reply.tag("Information") or ""
 
     clarifying_history = _collect_clarifying_history()
     text = build_critic_model_input(
@@ -420,11 +559,10 @@ def save_pre_experiment_result(human_score: int):
     instruction = next((m["content"] for m in st.session_state.context if m["role"] == "user"), "")
     last_assistant = next((m["content"] for m in reversed(st.session_state.context) if m["role"] == "assistant"), "")
 
-    fs_match = re.search(r"<FunctionSequence>([\s\S]*?)</FunctionSequence>", last_assistant, re.IGNORECASE)
-    info_match = re.search(r"<Information>([\s\S]*?)</Information>", last_assistant, re.IGNORECASE)
+    parsed_reply = parse_reply(last_assistant)
 
-    function_sequence = fs_match.group(1).strip() if fs_match else ""
-    information = info_match.group(1).strip() if info_match else ""
+    function_sequence = parsed_reply.tag("FunctionSequence") or ""
+    information = parsed_reply.tag("Information") or ""
 
     clarifying_history = _collect_clarifying_history()
     text = f"instruction: {instruction} \nfs: {function_sequence}"
@@ -437,7 +575,10 @@ def save_pre_experiment_result(human_score: int):
         except Exception:
             similarity = None
 
+    # plan_success_probability は保存後にバックグラウンドで採点し、同じIDの記録（JSONL・Firestore）へ追記する
+    document_id = new_document_id()
     entry = {
+        "document_id": document_id,
         "instruction": instruction,
         "function_sequence": function_sequence,
         "information": information,
@@ -447,28 +588,25 @@ def save_pre_experiment_result(human_score: int):
         "mode": st.session_state.get("mode", "")
     }
 
-    success_probability = evaluate_plan_success_probability(
-        instruction,
-        function_sequence,
-    )
-    if success_probability is not None:
-        entry["plan_success_probability"] = success_probability
-
     if "saved_jsonl" not in st.session_state:
         st.session_state.saved_jsonl = []
     st.session_state.saved_jsonl.append(entry)
 
-    PRE_EXPERIMENT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    need_newline = False
-    if PRE_EXPERIMENT_PATH.exists() and PRE_EXPERIMENT_PATH.stat().st_size > 0:
-        with PRE_EXPERIMENT_PATH.open("rb") as f:
-            f.seek(-1, 2)
-            need_newline = f.read(1) != b"\n"
-    with PRE_EXPERIMENT_PATH.open("a", encoding="utf-8") as f:
-        if need_newline:
-            f.write("\n")
-        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-    _save_to_firestore(entry, collection_override="pre_experiment_results")
+    _append_jsonl_entry(PRE_EXPERIMENT_PATH, entry)
+    saved_id = _save_to_firestore(
+        entry,
+        collection_override="pre_experiment_results",
+        document_id=document_id,
+    )
+    enqueue_plan_success_scoring(
+        document_id,
+        instruction,
+        function_sequence,
+        collection_override="pre_experiment_results",
+        local_entry=entry,
+        jsonl_path=PRE_EXPERIMENT_PATH,
+        saved_to_firestore=saved_id is not None,
+    )
 
 def _strip_visible_text(text: Optional[str]) -> str:
     """Convert assistant output into the plain text shown to users."""
@@ -482,15 +620,6 @@ def _strip_visible_text(text: Optional[str]) -> str:
     return cleaned.strip()
 
 
-def _extract_xml_tag(text: Optional[str], tag: str) -> str:
-    if not text:
-        return ""
-    match = re.search(fr"<{tag}>([\s\S]*?)</{tag}>", text, re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    return ""
-
-
 def _collect_conversation_history(include_system: bool = False) -> list[dict[str, Any]]:
     """Return the current conversation history stored in session state."""
 
@@ -523,18 +652,16 @@ def _collect_conversation_history(include_system: bool = False) -> list[dict[str
         }
 
         if role == "assistant":
+            # 画面表示のときに解析した結果（メッセージに保持）をそのまま使う
+            parsed_reply = parsed_message(message)
             spoken = message.get("spoken_response")
             if not isinstance(spoken, str):
-                spoken = _extract_xml_tag(raw_content, "SpokenResponse") or (
+                spoken = parsed_reply.spoken_response or (
                     visible_content if isinstance(visible_content, str) else ""
                 )
             entry["32_spoken_response"] = spoken
-            entry["33_task_goal_definition"] = _extract_xml_tag(
-                raw_content, "TaskGoalDefinition"
-            )
-            entry["34_function_sequence"] = _extract_xml_tag(
-                raw_content, "FunctionSequence"
-            )
+            entry["33_task_goal_definition"] = parsed_reply.task_goal_definition or ""
+            entry["34_function_sequence"] = parsed_reply.function_sequence or ""
         else:
             entry["32_spoken_response"] = (
                 visible_content if isinstance(visible_content, str) else ""
@@ -585,6 +712,7 @@ def save_conversation_history_to_firestore(
 
     prompt_label = st.session_state.get("prompt_label")
     entry["1_prompt_label"] = prompt_label or ""
+    entry["8_llm_metrics"] = session_metrics_payload()
 
     _save_to_firestore(
         entry,
@@ -642,23 +770,18 @@ def save_experiment_result(
     instruction = next((m["content"] for m in st.session_state.context if m["role"] == "user"), "")
     last_assistant = next((m["content"] for m in reversed(st.session_state.context) if m["role"] == "assistant"), "")
 
-    fs_match = re.search(r"<FunctionSequence>([\s\S]*?)</FunctionSequence>", last_assistant, re.IGNORECASE)
-    info_match = re.search(r"<Information>([\s\S]*?)</Information>", last_assistant, re.IGNORECASE)
+    parsed_reply = parse_reply(last_assistant)
 
-    function_sequence = fs_match.group(1).strip() if fs_match else ""
-    information = info_match.group(1).strip() if info_match else ""
+    function_sequence = parsed_reply.tag("FunctionSequence") or ""
+    information = parsed_reply.tag("Information") or ""
 
     function_count, variable_lengths = _analyze_function_sequence(function_sequence)
 
     human_scores = dict(human_scores)
-    success_probability = evaluate_plan_success_probability(
-        instruction,
-        function_sequence,
-    )
-    if success_probability is not None:
-        human_scores["plan_success_probability"] = success_probability
 
-    entry = {}
+    # plan_success_probability は保存後にバックグラウンドで採点し、同じIDの記録（JSONL・Firestore）へ追記する
+    document_id = new_document_id()
+    entry = {"document_id": document_id}
     prompt_group_value = prompt_group or st.session_state.get("prompt_group") or ""
 
     prompt_label = st.session_state.get("prompt_label")
@@ -677,11 +800,23 @@ def save_experiment_result(
     entry["3_conversation_history"] = conversation_history
 
     esm = st.session_state.get("esm")
-    state_history: list[dict[str, Any]] = []
-    if esm and hasattr(esm, "state_history"):
-        state_history = [deepcopy(s) for s in getattr(esm, "state_history", [])]
-    formatted_state_history = _format_state_history_snapshots(state_history)
-    entry["4_current_state"] = formatted_state_history
+    if esm and hasattr(esm, "export_state_history"):
+        # 行動ごとの完全なスナップショットではなく、初期状態 + 差分 + 最終状態で保存する
+        # （各時点の状態は utils.esm.materialize_state_history で復元できる）
+        exported = esm.export_state_history()
+        initial, final = _format_state_history_snapshots(
+            [exported["initial"], esm.snapshot_at(-1)]
+        )
+        entry["4_current_state"] = {
+            "initial": initial,
+            "changes": exported["changes"],
+            "final": final,
+        }
+    else:
+        state_history: list[dict[str, Any]] = []
+        if esm and hasattr(esm, "state_history"):
+            state_history = [deepcopy(s) for s in getattr(esm, "state_history", [])]
+        entry["4_current_state"] = _format_state_history_snapshots(state_history)
 
     task_duration = st.session_state.get("task_duration_latest")
     if not task_duration:
@@ -702,8 +837,6 @@ def save_experiment_result(
             }
     if task_duration:
         entry["5_task_duration"] = task_duration
-    if success_probability is not None:
-        entry["plan_success_probability"] = success_probability
 
     if termination_label:
         entry["termination_label"] = termination_label
@@ -718,25 +851,28 @@ def save_experiment_result(
     }
     entry["6_human_scores"] = structured_human_scores
     entry["7_participant_name"] = human_scores.get("participant_name", "")
+    entry["8_llm_metrics"] = session_metrics_payload()
 
     if "saved_jsonl" not in st.session_state:
         st.session_state.saved_jsonl = []
     st.session_state.saved_jsonl.append(entry)
 
-    EXPERIMENT_2_PATH.parent.mkdir(parents=True, exist_ok=True)
-    need_newline = False
-    if EXPERIMENT_2_PATH.exists() and EXPERIMENT_2_PATH.stat().st_size > 0:
-        with EXPERIMENT_2_PATH.open("rb") as f:
-            f.seek(-1, 2)
-            need_newline = f.read(1) != b"\n"
-    with EXPERIMENT_2_PATH.open("a", encoding="utf-8") as f:
-        if need_newline:
-            f.write("\n")
-        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-    _save_to_firestore(
+    _append_jsonl_entry(EXPERIMENT_2_PATH, entry)
+    saved_id = _save_to_firestore(
         entry,
         collection_override="results",
         prompt_group=prompt_group_value,
+        document_id=document_id,
+    )
+    enqueue_plan_success_scoring(
+        document_id,
+        instruction,
+        function_sequence,
+        collection_override="results",
+        prompt_group=prompt_group_value,
+        local_entry=entry,
+        jsonl_path=EXPERIMENT_2_PATH,
+        saved_to_firestore=saved_id is not None,
     )
 
 def show_jsonl_block():
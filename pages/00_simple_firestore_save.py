@@ -7,7 +7,7 @@ from typing import Any, Dict
 
 import streamlit as st
 
-from utils.firebase_utils import save_document
+from utils.firebase_utils import check_firestore_health, save_document
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -37,6 +37,13 @@ credentials_source = st.text_input(
 
 status_placeholder = st.empty()
 
+if st.button("接続を確認", use_container_width=True):
+    health = check_firestore_health(credentials_source.strip() or None)
+    if health["ok"]:
+        status_placeholder.success(f"Firestore に接続できました（{health['latency_s']} 秒）。")
+    else:
+        status_placeholder.error(f"Firestore に接続できませんでした。詳細: {health['error']}")
+
 if st.button("Firestore に保存", use_container_width=True):
     if not collection.strip():
         status_placeholder.error("コレクション名を入力してください。")
@@ -14,18 +14,38 @@ from pages.consent import (
 )
 from dotenv import load_dotenv
 
-from utils.api import client
+from utils.llm_gateway import LLMGatewayError, chat_completion, stream_chat_completion
 from archive.jsonl import (
     record_task_duration,
     save_conversation_history_to_firestore
 )
 from utils.run_and_show import show_function_sequence
+from utils.reply_parser import PARSED_REPLY_KEY, parse_reply, parse_steps, parsed_message
+from utils.strips import extract_between, strip_tags
+from utils.streaming import stream_chat_reply
+from utils.context_window import build_context_window, execution_log_message, plan_check_message
+from utils.prompt_builder import build_planner_messages
+from utils.llm_metrics import reset_session_metrics, session_calls, summarize_calls
+from utils.speculation import discard_speculation, ensure_speculation, take_speculative_reply
+from utils.structured_reply import (
+    PLANNER_RESPONSE_FORMAT,
+    STRUCTURED_OUTPUT_INSTRUCTION,
+    items_needed_to_dict,
+    parse_structured_reply,
+    structured_reply_to_xml,
+)
 from archive.image_task_sets import extract_task_lines
 from utils.esm import ExternalStateManager
 from utils.evaluation_form import render_standard_evaluation_form
 
 PROMPT_GROUP = "empathetic"
 NEXT_PAGE = "pages/03_smalltalk.py"
+STREAM_REPLY = True  # SpokenResponse をトークン単位で逐次表示する
+SPECULATIVE_PREFETCH = True  # 計画の実行中に次の計画を裏で先に要求しておく
+STRUCTURED_OUTPUT = False  # True にすると XML ではなく JSON Schema で応答を受け取る（逐次表示はしない）
+PLANNER_REQUEST_PARAMS = {"response_format": PLANNER_RESPONSE_FORMAT} if STRUCTURED_OUTPUT else {}
+PLAN_PRECHECK = True  # 計画をキューに積む前に ESM のコピー上で試し、実行できない手順はまとめて修正を依頼する
+STATE_ENCODING = "repr"  # <CurrentState> の書式（utils.esm.STATE_ENCODINGS。"delimited" などでトークンを減らせる）
 
 REPO_ROOT = Path(__file__).resolve().parent.parent
 PROMPT_TASKINFO_PATH = REPO_ROOT / "prompts" / "prompt_taskinfo_sets.yaml"
@@ -127,6 +147,12 @@ def _reset_conversation_state(system_prompt: str) -> None:
     
     # 5. contextは「空」で開始する
     st.session_state.context = [] 
+
+    # 6. LLM 呼び出しのトークン数・レイテンシは会話（条件）ごとに集計する
+    reset_session_metrics()
+    discard_speculation()
+    st.session_state.plan_check_retried = False
+    st.session_state.pop("pending_plan_check", None)
     
     # --- 以下は既存のリセットロジック ---
     st.session_state.active = True
@@ -164,34 +190,155 @@ def _update_random_task_selection(label_key: str, labels_key: str, mapping_key:
     label_to_key = st.session_state.get(mapping_key) or {}
     st.session_state[set_key] = label_to_key.get(new_label)
 
-TAG_RE = re.compile(r"</?([A-Za-z0-9_]+)(\s[^>]*)?>")
-
-def strip_tags(text: str) -> str:
-    return TAG_RE.sub("", text or "").strip()
-
-def extract_between(tag: str, text: str) -> str | None:
-    match = re.search(fr"<{tag}>([\s\S]*?)</{tag}>", text or "", re.IGNORECASE)
-    return match.group(1).strip() if match else None
-
 def extract_xml_tag(xml_string, tag_name):
-    """指定されたタグの内容を抽出する"""
-    pattern = f"<{tag_name}>(.*?)</{tag_name}>"
-    match = re.search(pattern, xml_string, re.DOTALL | re.IGNORECASE)
-    return match.group(1).strip() if match else None
+    """指定されたタグの内容を抽出する（応答の解析結果はキャッシュされる）"""
+    return parse_reply(xml_string).tag(tag_name)
 
 def parse_function_sequence(sequence_str):
     """FunctionSequenceの番号付きリストをパースする"""
-    if not sequence_str:
-        return []
     # "1. go to..." "2. pick up..." などを抽出
-    actions = re.findall(r'^\s*\d+\.\s*(.*)', sequence_str, re.MULTILINE)
-    return [action.strip() for action in actions]
+    return parse_steps(sequence_str)
+
+def _handle_reply_tag(
+    esm: ExternalStateManager, tag: str, content: str, checked_steps: list[dict] | None = None
+) -> None:
+    """応答中のタグを処理する（ストリーミング時は受信の完了後に呼ばれる）。
+    checked_steps は受信しながら事前確認した手順の結果（_queue_plan を参照）"""
+    # (F) [フェーズ1] Goalが設定されたかパース
+    if tag == "TaskGoalDefinition":
+        if content and "Goal:" in content and not st.session_state.goal_set:
+            if esm.set_task_goal_from_llm(content):
+                st.session_state.goal_set = True
+                st.success("タスク目標を設定しました！")
+            else:
+                st.error("LLMが生成したタスク目標のパースに失敗しました。")
+
+    # (G) [フェーズ2] 行動計画が生成されたかパース
+    elif tag == "FunctionSequence":
+        # [変更点] 介入時に古い計画がクリアされているため、extendでOK
+        actions = parse_function_sequence(content)
+        if actions:
+            _queue_plan(esm, actions, checked_steps)
+
+def _queue_plan(esm: ExternalStateManager, actions: list[str], checked_steps: list[dict] | None = None) -> None:
+    """受信した行動計画をキューに積む。
+    PLAN_PRECHECK のときは先に ESM のコピー上で試し、実行できない手順があれば積まずに
+    まとめて修正を依頼する（同じ計画の修正依頼は 1 回だけで、修正後の計画はそのまま積む）。
+    ストリーミング中に 1 手順ずつ確かめた結果（checked_steps）があれば、試し直さずにそれを使う"""
+    queue = st.session_state.action_plan_queue
+    if PLAN_PRECHECK and not st.session_state.get("plan_check_retried"):
+        if checked_steps is not None and [step["action"] for step in checked_steps[: len(actions)]] == actions:
+            steps = checked_steps[: len(actions)]
+        else:
+            steps = esm.check_plan(queue + actions)["steps"][len(queue):]
+        issues = [(number, step) for number, step in enumerate(steps, start=1) if step["status"] != "ok"]
+        if issues:
+            st.session_state.plan_check_retried = True
+            # 応答を会話履歴に追加した後で送る（(E) を参照）
+            st.session_state.pending_plan_check = plan_check_message(issues)
+            st.warning(f"計画のうち{len(issues)}ステップが現在の状態では実行できないため、修正を依頼します。")
+            return
+    st.session_state.plan_check_retried = False
+    queue.extend(actions)
+    st.info(f"{len(actions)}ステップの計画を受信しました。")
+
+def _handle_reply_tags(esm: ExternalStateManager, reply: str) -> None:
+    parsed = parse_reply(reply)
+    for tag in ("TaskGoalDefinition", "FunctionSequence"):
+        tag_content = parsed.tag(tag)
+        if tag_content:
+            _handle_reply_tag(esm, tag, tag_content)
+
+def _build_messages_for_api(context: list[dict], current_state_xml: str, payload) -> list[dict]:
+    """システムプロンプトは毎ターン同一のバイト列にしてプロンプトキャッシュを効かせ、
+    変化する状態XMLは末尾のメッセージで渡す
+    (古い実行ログは要約に畳み込み、直近のターンだけ原文で送る)"""
+    house = (payload.get("house") if isinstance(payload, dict) else "") or ""
+    room = (payload.get("room") if isinstance(payload, dict) else "") or ""
+    messages = build_planner_messages(
+        st.session_state.system_prompt_template,
+        build_context_window(context),
+        current_state_xml,
+        house=house,
+        room=room,
+    )
+    if STRUCTURED_OUTPUT:
+        messages.insert(1, {"role": "system", "content": STRUCTURED_OUTPUT_INSTRUCTION})
+    return messages
+
+def _apply_structured_reply(esm: ExternalStateManager, data: dict) -> None:
+    """構造化出力の task_goal / function_sequence を正規表現を介さずに反映する"""
+    # (F) [フェーズ1] Goalが設定されたか
+    goal = data.get("task_goal")
+    if goal and not st.session_state.goal_set:
+        esm.set_task_goal(goal["target_location"], items_needed_to_dict(goal.get("items_needed")))
+        st.session_state.goal_set = True
+        st.success("タスク目標を設定しました！")
+
+    # (G) [フェーズ2] 行動計画が生成されたか
+    actions = data.get("function_sequence") or []
+    if actions:
+        _queue_plan(esm, actions)
+
+def _consume_completion(response, esm: ExternalStateManager) -> str:
+    """ChatCompletion を処理し、会話履歴に残す XML 形式の応答を返す"""
+    content = (response.choices[0].message.content or "").strip()
+    if STRUCTURED_OUTPUT:
+        data = parse_structured_reply(content)
+        _apply_structured_reply(esm, data)
+        # 保存処理や履歴表示は XML を前提にしているので同等の XML で残す
+        return structured_reply_to_xml(data)
+    _handle_reply_tags(esm, content)
+    return content
+
+def _request_reply(messages_for_api: list[dict], esm: ExternalStateManager) -> str | None:
+    """LLMに応答を要求する。再試行しても失敗した場合はエラーを表示して None を返す"""
+    try:
+        # 先読みした計画とメッセージが一致すれば、その応答をそのまま使う
+        prefetched = take_speculative_reply(messages_for_api) if SPECULATIVE_PREFETCH else None
+        if prefetched is not None:
+            return _consume_completion(prefetched, esm)
+
+        if STREAM_REPLY and not STRUCTURED_OUTPUT:
+            # 受信しながら SpokenResponse を表示する。閉じたタグは溜めておき、
+            # 受信が最後まで成功してから反映する（途中で失敗したら目標も計画も変えない）
+            stream = stream_chat_completion(messages_for_api, page=PROMPT_GROUP)
+            spoken_placeholder, step_placeholder = st.empty(), st.empty()
+            closed_tags: list[tuple[str, str]] = []
+            # 計画の事前確認は受信を待たず、1 ステップ受信するたびに ESM のコピー上で行う
+            plan_check = (
+                esm.start_plan_check(after=st.session_state.action_plan_queue)
+                if PLAN_PRECHECK and not st.session_state.get("plan_check_retried")
+                else None
+            )
+            received_steps: list[dict] = []
 
-def safe_format_prompt(template: str, **kwargs) -> str:
-    # {current_state_xml},{house},{room} だけを置換し、他の { ... } は触らない
-    pattern = re.compile(r"\{(current_state_xml|house|room)\}")
-    return pattern.sub(lambda m: str(kwargs.get(m.group(1), m.group(0))), template)
+            def _check_step(step: str) -> None:
+                # キューに積むのは受信の完了後
+                received_steps.append(plan_check.add(step) if plan_check else {"action": step, "status": "ok"})
+                blocked = sum(1 for checked in received_steps if checked["status"] != "ok")
+                note = f"（うち実行できない手順: {blocked}）" if blocked else ""
+                step_placeholder.caption(f"計画を受信中: {len(received_steps)}. {step}{note}")
 
+            try:
+                reply = stream_chat_reply(
+                    stream,
+                    spoken_placeholder,
+                    on_tag_closed=lambda tag, content: closed_tags.append((tag, content)),
+                    on_step=_check_step,
+                )
+            finally:
+                step_placeholder.empty()
+            for tag, content in closed_tags:
+                _handle_reply_tag(esm, tag, content, plan_check.steps if plan_check else None)
+            return reply.strip()
+
+        response = chat_completion(messages_for_api, page=PROMPT_GROUP, **PLANNER_REQUEST_PARAMS)
+        return _consume_completion(response, esm)
+    except LLMGatewayError as exc:
+        print(f"[LLM] {exc}")
+        st.error("ロボットとの通信に失敗しました。少し時間をおいてから、もう一度送信してください。")
+        return None
 
 def _append_context_message(context: list[dict], message: dict) -> None:
     stamped = dict(message)
@@ -361,9 +508,10 @@ def app():
                 st.write(msg["content"])
                 # 既存のヘルパー関数をそのまま利用
                 if msg["role"] == "assistant":
-                    reply_xml = msg.get("full_reply", msg.get("content", ""))
-                    show_function_sequence(reply_xml)
-                    # show_spoken_response(reply_xml)
+                    # 解析結果はメッセージに保持されるので、再描画のたびに解析し直さない
+                    parsed_reply = parsed_message(msg)
+                    show_function_sequence(parsed_reply)
+                    # show_spoken_response(parsed_reply)
 
         # 3. [フェーズ2: 実行ループ] 実行すべき行動計画（キュー）があるか？
         if queue:
@@ -381,13 +529,9 @@ def app():
                     execution_log = esm.update_state_from_action(action_to_run)
 
                 # 実行結果を会話履歴（コンテキスト）に追加
-                exec_details = execution_log or "ロボットの状態を更新しました。"
-                exec_msg = f"（実行完了: {action_to_run}。\n{exec_details}）"
-                _append_context_message(
-                    context,
-                    {"role": "user", "content": exec_msg},
-                )  # 実行結果をLLMに伝える
-                st.chat_message("user").write(exec_msg)
+                exec_msg = execution_log_message(action_to_run, execution_log)
+                _append_context_message(context, exec_msg)  # 実行結果をLLMに伝える
+                st.chat_message("user").write(exec_msg["content"])
 
                 # キューが空になったら、LLMに次の計画を尋ねる
                 if not queue:
@@ -397,6 +541,35 @@ def app():
                     st.session_state.trigger_llm_call = True
                 st.rerun() # 画面を再描画して次のステップを表示
 
+            # 残りの計画をまとめて実行（履歴には 1 件として記録し、再描画も 1 回で済ませる）
+            if len(queue) > 1 and st.button(f"⏩ 残り{len(queue)}ステップをすべて実行", key="run_all_steps"):
+                actions_to_run = list(queue)
+                st.session_state.action_plan_queue = []
+                queue = []
+                with st.spinner(f"実行中: {len(actions_to_run)}ステップ..."):
+                    step_results = esm.apply_actions(actions_to_run)
+                for step in step_results:
+                    exec_msg = execution_log_message(step["action"], step["log"])
+                    _append_context_message(context, exec_msg)  # 実行結果をLLMに伝える
+                    st.chat_message("user").write(exec_msg["content"])
+
+                st.info("サブタスクが完了しました。LLMに次の計画を問い合わせます...")
+                st.session_state.next_plan_request = "現在のタスク目標に基づき、現在の状態から次のサブタスクの行動計画（FunctionSequence）を生成してください。"
+                st.session_state.trigger_llm_call = True
+                st.rerun()
+
+            # 残りの計画を ESM のコピー上で実行した結果をもとに、次の計画を先に要求しておく
+            if SPECULATIVE_PREFETCH and not st.session_state.get("force_end"):
+                ensure_speculation(
+                    esm,
+                    context,
+                    queue,
+                    lambda ctx, state_xml: _build_messages_for_api(ctx, state_xml, payload),
+                    page=PROMPT_GROUP,
+                    params=PLANNER_REQUEST_PARAMS,
+                    state_encoding=STATE_ENCODING,
+                )
+
         # 4. LLM呼び出しのトリガー（ユーザー入力 or 計画完了）
         user_input = None
         if not st.session_state.get("force_end"):
@@ -407,6 +580,7 @@ def app():
             if user_input:
                 st.session_state["chat_input_history"].append(user_input)
                 st.session_state.trigger_llm_call = True
+                discard_speculation()
 
                 # ユーザーが入力した=既存の計画に介入した→したがって古い行動計画（キュー）を破棄する
                 if queue:
@@ -429,69 +603,40 @@ def app():
             with st.chat_message("assistant"):
                 with st.spinner("ロボットが考えています..."):
                     # (A) ESMから最新の状態XMLを取得
-                    current_state_xml = esm.get_state_as_xml_prompt()
-                    # (B) 最新の状態でシステムプロンプトを構築
-                    house = (payload.get("house") if isinstance(payload, dict) else "") or ""
-                    room = (payload.get("room") if isinstance(payload, dict) else "") or ""
-                    system_prompt_content = safe_format_prompt(
-                        st.session_state.system_prompt_template,
-                        current_state_xml=current_state_xml,
-                        house=house,
-                        room=room,
-                    )
-                    system_message = {"role": "system", "content": system_prompt_content}
-
-                    # (C) APIに渡すメッセージリストを作成
-                    messages_for_api = [system_message] + context
+                    current_state_xml = esm.get_state_as_xml_prompt(STATE_ENCODING)
+                    # (B)(C) APIに渡すメッセージリストを作成
+                    messages_for_api = _build_messages_for_api(context, current_state_xml, payload)
 
                     # (D) LLM API 呼び出し
                     if not st.session_state.get("task_timer_started_at"):
                         st.session_state["task_timer_started_at"] = datetime.now(timezone.utc).isoformat()
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",  # または "gpt-4-turbo"
-                        messages=messages_for_api,
-                    )
-                    reply = response.choices[0].message.content.strip()
-
-                    # (E) 応答をコンテキストに追加
-                    spoken_response = extract_xml_tag(reply, "SpokenResponse")
-                    if not spoken_response:
-                        spoken_response = strip_tags(reply) or "(...)"
-
-                    _append_context_message(
-                        context,
-                        {
-                            "role": "assistant",
-                            "content": spoken_response,
-                            "full_reply": reply,
-                        },
-                    )
-                    st.session_state.turn_count += 1
-
-                    # (F) [フェーズ1] Goalが設定されたかパース
-                    goal_def_str = extract_xml_tag(reply, "TaskGoalDefinition")
-                    if (
-                        goal_def_str
-                        and "Goal:" in goal_def_str
-                        and not st.session_state.goal_set
-                    ):
-                        if esm.set_task_goal_from_llm(goal_def_str):
-                            st.session_state.goal_set = True
-                            st.success("タスク目標を設定しました！")
-                        else:
-                            st.error("LLMが生成したタスク目標のパースに失敗しました。")
-
-                    # (G) [フェーズ2] 行動計画が生成されたかパース
-                    plan_str = extract_xml_tag(reply, "FunctionSequence")
-                    if plan_str:
-                        # [変更点] 介入時に古い計画がクリアされているため、extendでOK
-                        actions = parse_function_sequence(plan_str)
-                        if actions:
-                            st.session_state.action_plan_queue.extend(actions)
-                            st.info(f"{len(actions)}ステップの計画を受信しました。")
-
-                    # (H) 画面を再描画
-                    st.rerun()
+                    reply = _request_reply(messages_for_api, esm)
+                    if reply is not None:
+                        # (E) 応答をコンテキストに追加
+                        parsed_reply = parse_reply(reply)
+                        spoken_response = parsed_reply.spoken_response
+                        if not spoken_response:
+                            spoken_response = parsed_reply.plain_text or "(...)"
+
+                        _append_context_message(
+                            context,
+                            {
+                                "role": "assistant",
+                                "content": spoken_response,
+                                "full_reply": reply,
+                                PARSED_REPLY_KEY: parsed_reply,
+                            },
+                        )
+                        st.session_state.turn_count += 1
+
+                        # 計画の事前確認で見つかった問題は、まとめて 1 回の依頼で直してもらう
+                        plan_check = st.session_state.pop("pending_plan_check", None)
+                        if plan_check:
+                            _append_context_message(context, plan_check)
+                            st.session_state.trigger_llm_call = True
+
+                        # (H) 画面を再描画
+                        st.rerun()
 
     if st.session_state.get("force_end"):
         should_stop = True
@@ -595,6 +740,17 @@ def app():
         with st.expander("詳細な状態（JSON）"):
             st.json(current_state)
 
+        llm_calls = session_calls()
+        if llm_calls:
+            summary = summarize_calls(llm_calls)
+            cost = summary["estimated_cost_usd"]
+            st.caption(
+                f"LLM 呼び出し {summary['calls']} 回: プロンプト {summary['prompt_tokens']} トークン"
+                f"（キャッシュ済み {summary['cached_tokens']}）、出力 {summary['completion_tokens']} トークン、"
+                f"p50 {summary['latency_p50_s'] or 0:.2f} 秒 / p95 {summary['latency_p95_s'] or 0:.2f} 秒"
+                + (f"、概算 ${cost:.4f}" if cost is not None else "")
+            )
+
     # 7. 評価フォームの表示（should_stop判定ロジックは変更済み）  
     end_message = ""
     if st.session_state.get("force_end"):
@@ -7,7 +7,7 @@ from datetime import date, datetime, timezone
 
 import streamlit as st
 
-from utils.firebase_utils import save_document
+from utils.firestore_writer import submit_set
 
 from dotenv import load_dotenv
 
@@ -148,12 +148,13 @@ def _save_consent_record_to_firestore(entry: dict) -> bool:
     print(f"[Consent] using credential source: {source}")
 
     try:
-        save_document(collection, entry, credentials_source)
+        # スプールに記録した時点で戻る（Firestore への書き込みは裏のスレッドで行う）
+        submit_set(collection, entry, credentials_source)
     except Exception as exc:
         print(f"[Consent] ERROR saving consent record: {exc}")
         return False
 
-    print(f"[Consent] saved consent record to {collection}")
+    print(f"[Consent] queued consent record for {collection}")
     return True
 
 
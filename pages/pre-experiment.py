@@ -6,7 +6,8 @@ from difflib import SequenceMatcher
 from pathlib import Path
 from dotenv import load_dotenv
 
-from utils.api import client, SYSTEM_PROMPT, build_bootstrap_user_message
+from utils.api import SYSTEM_PROMPT, build_bootstrap_user_message
+from utils.llm_gateway import LLMGatewayError, chat_completion
 from archive.jsonl import (
     predict_with_model,
     save_conversation_history_to_firestore,
@@ -22,6 +23,17 @@ from tasks.ui import render_random_room_task, reset_random_room_task
 
 load_dotenv()
 
+
+def request_reply(messages: list[dict]) -> str:
+    """LLMに応答を要求する。再試行しても失敗した場合はエラーを表示して処理を止める"""
+    try:
+        response = chat_completion(messages, page="pre_experiment")
+    except LLMGatewayError as exc:
+        print(f"[LLM] {exc}")
+        st.error("ロボットとの通信に失敗しました。少し時間をおいてから、もう一度送信してください。")
+        st.stop()
+    return response.choices[0].message.content.strip()
+
 @st.cache_data
 def load_ground_truth_map():
     """Load instruction to function_sequence mapping from dataset."""
@@ -249,11 +261,7 @@ def app():
                     local_image_paths=selected_paths,
                 )
             )
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=context
-        )
-        reply = response.choices[0].message.content.strip()
+        reply = request_reply(context)
         print("Assistant:", reply)
         context.append({"role": "assistant", "content": reply})
         print("context: ", context)
@@ -6,7 +6,8 @@ import streamlit as st
 from pages.consent import require_consent
 from dotenv import load_dotenv
 
-from utils.api import client, build_bootstrap_user_message, CREATING_DATA_SYSTEM_PROMPT
+from utils.api import build_bootstrap_user_message, CREATING_DATA_SYSTEM_PROMPT
+from utils.llm_gateway import LLMGatewayError, chat_completion
 from archive.jsonl import (
     remove_last_jsonl_entry,
     save_conversation_history_to_firestore,
@@ -14,11 +15,23 @@ from archive.jsonl import (
     show_jsonl_block,
 )
 from utils.run_and_show import run_plan_and_show, show_spoken_response, show_function_sequence, show_information
+from utils.reply_parser import parsed_message
 from tasks.ui import render_random_room_task, reset_random_room_task
 
 load_dotenv()
 
 
+def request_reply(messages: list[dict], **params) -> str:
+    """LLMに応答を要求する。再試行しても失敗した場合はエラーを表示して処理を止める"""
+    try:
+        response = chat_completion(messages, page="save_data", **params)
+    except LLMGatewayError as exc:
+        print(f"[LLM] {exc}")
+        st.error("ロボットとの通信に失敗しました。少し時間をおいてから、もう一度送信してください。")
+        st.stop()
+    return response.choices[0].message.content.strip()
+
+
 def accumulate_information(reply: str) -> str:
     info_match = re.search(r"<Information>([\s\S]*?)</Information>", reply, re.IGNORECASE)
     if not info_match:
@@ -168,11 +181,7 @@ def app():
                 )
 
             # 2) 最初のアシスタント応答を取得（画像を添えた状態で）
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=st.session_state["context"]
-            )
-            reply = (response.choices[0].message.content).strip()
+            reply = request_reply(st.session_state["context"])
             reply = accumulate_information(reply)
             st.session_state["context"].append({"role": "assistant", "content": reply})
             save_jsonl_entry("insufficient")
@@ -191,11 +200,7 @@ def app():
                     local_image_paths=selected_paths,
                 )
             )
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=context
-        )
-        reply = response.choices[0].message.content.strip()
+        reply = request_reply(context)
         reply = accumulate_information(reply)
         print("Assistant:", reply)
         context.append({"role": "assistant", "content": reply})
@@ -211,11 +216,13 @@ def app():
         with st.chat_message(msg["role"]):
             st.write(msg["content"])
             if msg["role"] == "assistant":
+                # 1 つの応答を 1 回だけ解析し、結果をメッセージに保持して使い回す
+                parsed_reply = parsed_message(msg)
                 if i == last_assistant_idx and "<FunctionSequence>" in msg["content"]:
-                    run_plan_and_show(msg["content"])
-                show_function_sequence(msg["content"])
-                show_spoken_response(msg["content"])
-                show_information(msg["content"])
+                    run_plan_and_show(parsed_reply)
+                show_function_sequence(parsed_reply)
+                show_spoken_response(parsed_reply)
+                show_information(parsed_reply)
         # 最後のアシスタント直後にボタンを出す（計画があるときのみ）
         if i == last_assistant_idx and "<FunctionSequence>" in msg["content"]:
             st.write("この計画はロボットが実行するのに十分ですか？")
@@ -233,11 +240,8 @@ def app():
                         "role": "system",
                         "content": "The previous plan was insufficient. Ask a clarifying question to the user to improve it."
                     }
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=context + [clarify_prompt]
-                    )
-                    question = response.choices[0].message.content.strip()
+                    # 同じ文脈での再質問は応答キャッシュから返す
+                    question = request_reply(context + [clarify_prompt], cache=True)
                     context.append({"role": "assistant", "content": question})
                     save_jsonl_entry("insufficient")
                     st.rerun()
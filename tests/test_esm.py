@@ -0,0 +1,125 @@
+from utils.context_window import TOKEN_COUNTER
+from utils.esm import (
+    HISTORY_CHECKPOINT_INTERVAL,
+    STATE_ENCODINGS,
+    ExternalStateManager,
+    history_state_keys,
+    materialize_state_history,
+    snapshot_key,
+)
+
+PLAN = [
+    "go to the キッチンの棚",
+    "pick up the 皿",
+    "go to the ダイニングテーブル",
+    "put 皿 in the ダイニングテーブル",
+]
+
+
+def _esm():
+    return ExternalStateManager(verbose=False)
+
+
+def test_batch_matches_step_by_step_updates():
+    stepwise, batched = _esm(), _esm()
+    for action in PLAN:
+        stepwise.update_state_from_action(action)
+    results = batched.apply_actions(PLAN)
+
+    assert [r["status"] for r in results] == ["ok"] * len(PLAN)
+    assert batched.current_state == stepwise.current_state
+    assert batched.state_key() == stepwise.state_key()
+    assert batched.current_state["robot_status"] == {"location": "ダイニングテーブル", "holding": []}
+
+
+def test_history_snapshots_match_materialized_export():
+    esm = _esm()
+    # チェックポイントを跨ぐだけの履歴を作る
+    for _ in range(HISTORY_CHECKPOINT_INTERVAL + 5):
+        for action in PLAN:
+            esm.update_state_from_action(action)
+        esm.update_state_from_action("pick up the 皿")
+        esm.update_state_from_action("go to the キッチンの棚")
+        esm.update_state_from_action("put 皿 in the キッチンの棚")
+
+    exported = esm.export_state_history()
+    materialized = materialize_state_history(exported)
+    assert len(materialized) == len(esm._history_entries)
+    for index in (0, 1, HISTORY_CHECKPOINT_INTERVAL, HISTORY_CHECKPOINT_INTERVAL + 1, len(materialized) - 1):
+        assert esm.snapshot_at(index) == materialized[index]
+    assert history_state_keys(exported) == [snapshot_key(s) for s in materialized]
+    assert snapshot_key(materialized[-1]) == esm.state_key()
+
+
+def test_fork_is_isolated_and_equivalent():
+    parent = _esm()
+    parent.update_state_from_action("go to the キッチンの棚")
+    before = parent.current_state
+
+    child = parent.fork()
+    child.apply_actions(PLAN[1:])
+    assert parent.current_state == before
+
+    parent.apply_actions(PLAN[1:])
+    assert parent.current_state == child.current_state
+
+    # 分岐後の変更は互いに見えない
+    child.update_state_from_action("pick up the 皿")
+    assert parent.current_state != child.current_state
+
+
+def test_atomic_failure_rolls_back_everything():
+    esm = _esm()
+    esm.update_state_from_action("go to the キッチンの棚")
+    key, history = esm.state_key(), len(esm._history_entries)
+    xml = esm.get_state_as_xml_prompt()
+
+    results = esm.apply_actions(PLAN[1:] + ["pick up the 象", "done"], atomic=True)
+
+    assert [r["status"] for r in results] == ["rolled_back"] * 3 + ["failed", "skipped"]
+    assert esm.state_key() == key
+    assert len(esm._history_entries) == history
+    assert esm.get_state_as_xml_prompt() == xml
+
+
+def test_atomic_unparsable_plan_executes_nothing():
+    esm = _esm()
+    key = esm.state_key()
+
+    results = esm.apply_actions(["go to the キッチンの棚", "fly to the moon"], atomic=True)
+
+    assert [r["status"] for r in results] == ["skipped", "unrecognized"]
+    assert esm.state_key() == key
+
+
+def test_check_plan_does_not_change_state():
+    esm = _esm()
+    key = esm.state_key()
+
+    report = esm.check_plan(["pick up the 皿"] + PLAN)
+
+    assert report["feasible"] is False
+    assert report["first_failure"] == 0
+    assert esm.state_key() == key
+
+
+def test_incremental_plan_check_matches_check_plan():
+    esm = _esm()
+    queued = PLAN[:2]
+    plan = PLAN[2:] + ["pick up the 象", "go to the キッチンの棚"]
+    key = esm.state_key()
+
+    check = esm.start_plan_check(after=queued)
+    streamed = [check.add(action) for action in plan]
+
+    assert streamed == esm.check_plan(queued + plan)["steps"][len(queued):]
+    assert check.report()["first_failure"] == 2
+    assert esm.state_key() == key
+
+
+def test_state_encoding_comparison_reports_its_token_counter():
+    report = _esm().compare_state_encodings()
+
+    assert report["token_counter"] == TOKEN_COUNTER
+    assert set(report["encodings"]) == set(STATE_ENCODINGS)
+    assert report["encodings"]["delimited"]["chars"] < report["encodings"]["repr"]["chars"]
@@ -0,0 +1,76 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("firebase_admin")
+pytest.importorskip("streamlit")
+
+import utils.firebase_utils as firebase_utils
+
+
+class _FakeClient:
+    def __init__(self, credentials=None, project=None):
+        self.project = project
+        self.closed = False
+        self.fail = False
+
+    def collection(self, name):
+        return self
+
+    def document(self, name):
+        return self
+
+    def get(self, timeout=None):
+        if self.fail:
+            raise ConnectionError("unavailable")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    apps = []
+
+    def get_app(key, credentials_source):
+        app = SimpleNamespace(credential=SimpleNamespace(get_credential=lambda: "credential"), project_id=key)
+        apps.append(app)
+        return app
+
+    monkeypatch.setattr(firebase_utils, "_get_app", get_app)
+    monkeypatch.setattr(firebase_utils.firestore, "Client", _FakeClient)
+    monkeypatch.setattr(firebase_utils, "_CLIENTS", {})
+    monkeypatch.setattr(firebase_utils, "RETIRED_CLIENT_GRACE_SECONDS", 0.05)
+    return apps
+
+
+def test_clients_are_cached_per_credentials_source(clients):
+    default = firebase_utils.get_firestore_client()
+    inline = firebase_utils.get_firestore_client('{"type": "service_account"}')
+
+    assert firebase_utils.get_firestore_client(None) is default
+    assert firebase_utils.get_firestore_client('{"type": "service_account"}') is inline
+    assert inline is not default
+    assert len(clients) == 2
+
+
+def test_failed_health_check_rebuilds_the_client_and_closes_the_old_one_later(clients, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(firebase_utils.firebase_admin, "delete_app", deleted.append, raising=False)
+    old = firebase_utils.get_firestore_client()
+    old.fail = True
+
+    assert firebase_utils.check_firestore_health()["ok"] is False
+    new = firebase_utils.get_firestore_client()
+
+    assert new is not old
+    assert not old.closed  # 使用中の呼び出しが終わるまでは閉じない
+    for _ in range(100):
+        if old.closed:
+            break
+        time.sleep(0.01)
+    assert old.closed
+    assert deleted == []  # アプリは削除しない
+    assert firebase_utils.check_firestore_health()["ok"] is True
+
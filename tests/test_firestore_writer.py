@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("firebase_admin")
+pytest.importorskip("streamlit")
+
+import utils.firestore_writer as firestore_writer
+from utils.firestore_writer import SET, UPDATE, FirestoreQueueFullError, FirestoreWriter, WriteOp
+
+
+class _FakeFirestore:
+    """collection().document() の set / update と batch だけを持つ Firestore の代わり"""
+
+    def __init__(self):
+        self.documents = {}
+        self.rejected = set()  # 書き込むと恒久的なエラーになる document_id
+        self.unavailable = False  # True の間は一時的なエラーになる
+        self.gate = threading.Event()  # セットされるまでコミットを待たせる
+        self.gate.set()
+
+    def collection(self, collection):
+        db = self
+
+        class _Collection:
+            def document(self, document_id):
+                return _Ref(db, (collection, document_id))
+
+        return _Collection()
+
+    def batch(self):
+        return _Batch()
+
+
+class _Ref:
+    def __init__(self, db, key):
+        self.db, self.key = db, key
+
+    def set(self, data):
+        if self.db.unavailable:
+            raise ConnectionError("unavailable")
+        if self.key[1] in self.db.rejected:
+            raise ValueError("invalid argument")
+        self.db.documents[self.key] = dict(data)
+
+    def update(self, data):
+        self.db.documents[self.key].update(data)
+
+
+class _Batch:
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref, "set", data))
+
+    def update(self, ref, data):
+        self.writes.append((ref, "update", data))
+
+    def commit(self):
+        if self.writes:
+            db = self.writes[0][0].db
+            db.gate.wait()
+            if db.unavailable:
+                raise ConnectionError("unavailable")
+        # 1 件でも不正な書き込みがあればバッチ全体が反映されない
+        for ref, _, _ in self.writes:
+            if ref.key[1] in ref.db.rejected:
+                raise ValueError("invalid argument")
+        for ref, method, data in self.writes:
+            getattr(ref, method)(data)
+
+
+@pytest.fixture
+def firestore(monkeypatch):
+    db = _FakeFirestore()
+    monkeypatch.setattr(firestore_writer, "get_firestore_client", lambda credentials_source=None: db)
+    monkeypatch.setattr(firestore_writer, "check_firestore_health", lambda credentials_source=None: {"ok": True})
+    return db
+
+
+def test_unacknowledged_writes_are_recovered_from_the_spool(tmp_path, firestore, monkeypatch):
+    spool = tmp_path / "spool.jsonl"
+    monkeypatch.setenv("FIREBASE_CREDENTIALS", '{"type": "service_account"}')
+
+    # 前回のプロセス: 3 件を記録し、1 件だけ書き込み完了を記録して落ちた
+    crashed = FirestoreWriter(spool)
+    crashed._spool_put(WriteOp(SET, "results", "doc1", {"v": 1}, '{"type": "service_account"}', op_id="op1"))
+    crashed._spool_put(WriteOp(SET, "results", "doc2", {"v": 2}, op_id="op2"))
+    crashed._spool_put(WriteOp(UPDATE, "results", "doc1", {"score": 0.5}, '{"type": "service_account"}', op_id="op3"))
+    crashed._spool_ack([WriteOp(SET, "results", "doc2", {}, op_id="op2")])
+    assert '"service_account"' not in spool.read_text(encoding="utf-8")  # インラインの資格情報は書かない
+    with spool.open("a", encoding="utf-8") as f:
+        f.write('{"spool": "put", "op_id": "torn"')  # 書き込み途中で落ちた行
+
+    writer = FirestoreWriter(spool)
+    writer._ensure_started()
+    assert writer.flush(timeout=5)
+
+    assert firestore.documents == {("results", "doc1"): {"v": 1, "score": 0.5}}
+    assert not spool.exists()
+
+
+def test_permanent_failures_go_to_the_dead_letter_file(tmp_path, firestore):
+    firestore.rejected.add("bad")
+
+    writer = FirestoreWriter(tmp_path / "spool.jsonl")
+    writer.submit(WriteOp(SET, "results", "ok", {"v": 1}))
+    writer.submit(WriteOp(SET, "results", "bad", {"v": 2}))
+    assert writer.flush(timeout=5)
+
+    dead = [json.loads(line) for line in writer.dead_letter_path.read_text(encoding="utf-8").splitlines()]
+    assert [record["document_id"] for record in dead] == ["bad"]
+    assert firestore.documents == {("results", "ok"): {"v": 1}}
+    assert not writer.spool_path.exists()
+
+
+def test_overflow_is_rejected_instead_of_written_out_of_order(tmp_path, firestore, monkeypatch):
+    monkeypatch.setattr(firestore_writer, "ENQUEUE_TIMEOUT_SECONDS", 0.05)
+    firestore.gate.clear()
+    writer = FirestoreWriter(tmp_path / "spool.jsonl", max_queue_size=1, batch_max_size=1)
+    writer.submit(WriteOp(SET, "results", "doc1", {"v": 1}))
+    for _ in range(50):  # 書き込みスレッドが 1 件目を取り出してコミット待ちになるまで
+        if writer._queue.qsize() == 0:
+            break
+        time.sleep(0.01)
+    writer.submit(WriteOp(SET, "results", "doc2", {"v": 2}))
+
+    with pytest.raises(FirestoreQueueFullError):
+        writer.submit(WriteOp(UPDATE, "results", "doc2", {"score": 0.5}))
+
+    firestore.gate.set()
+    assert writer.flush(timeout=5)
+    assert firestore.documents == {("results", "doc1"): {"v": 1}, ("results", "doc2"): {"v": 2}}
+    assert not writer.spool_path.exists()
+
+
+def test_transient_failures_are_dead_lettered_after_giving_up(tmp_path, firestore, monkeypatch):
+    monkeypatch.setattr(firestore_writer, "RETRY_GIVE_UP_SECONDS", 0.2)
+    monkeypatch.setattr(firestore_writer, "RETRY_BASE_DELAY_SECONDS", 0.01)
+    firestore.unavailable = True
+
+    writer = FirestoreWriter(tmp_path / "spool.jsonl")
+    writer.submit(WriteOp(SET, "results", "doc1", {"v": 1}))
+    writer.submit(WriteOp(SET, "results", "doc2", {"v": 2}))
+    assert writer.flush(timeout=5)
+
+    dead = [json.loads(line) for line in writer.dead_letter_path.read_text(encoding="utf-8").splitlines()]
+    assert sorted(record["document_id"] for record in dead) == ["doc1", "doc2"]
+    assert all(record["error"].startswith("ConnectionError") for record in dead)
+    assert not writer.spool_path.exists()
+
+
+def test_spool_is_compacted_under_steady_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(firestore_writer, "SPOOL_COMPACT_THRESHOLD", 10)
+    writer = FirestoreWriter(tmp_path / "spool.jsonl")
+    pending = WriteOp(SET, "results", "pending", {"v": 0}, op_id="pending")
+    writer._spool_put(pending)  # 書き込みが途切れず、スプールが空にならない状態
+
+    for index in range(100):
+        op = WriteOp(SET, "results", f"doc{index}", {"v": index}, op_id=f"op{index}")
+        writer._spool_put(op)
+        writer._spool_ack([op])
+
+    lines = writer.spool_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) <= 2 * 10 + 1
+    recovered = FirestoreWriter(writer.spool_path)._recover_spool()
+    assert [op.op_id for op in recovered] == ["pending"]
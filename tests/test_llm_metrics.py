@@ -0,0 +1,27 @@
+import utils.llm_metrics as llm_metrics
+from utils.llm_metrics import (
+    record_llm_call,
+    reset_session_metrics,
+    session_calls,
+    session_metrics_sink,
+)
+
+
+def test_sinks_captured_before_a_reset_still_reach_the_session(monkeypatch):
+    session_state = {}
+    in_script = [True]
+    monkeypatch.setattr(
+        llm_metrics, "_script_session_state", lambda: session_state if in_script[0] else None
+    )
+
+    record_llm_call({"page": "logical", "wall_time_s": 1.0})
+    sink = session_metrics_sink()  # 先読みなどの投入時に取っておく
+    reset_session_metrics()
+    assert session_calls() == []
+
+    # 別スレッドで完了した呼び出しは sink に記録される
+    in_script[0] = False
+    record_llm_call({"page": "logical", "wall_time_s": 2.0}, sink=sink)
+    in_script[0] = True
+
+    assert [call["wall_time_s"] for call in session_calls()] == [2.0]
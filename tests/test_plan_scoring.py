@@ -0,0 +1,59 @@
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("joblib")
+pytest.importorskip("dotenv")
+pytest.importorskip("streamlit")
+pytest.importorskip("firebase_admin")
+
+import archive.jsonl as jsonl
+
+
+def _read(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+
+def test_score_is_patched_into_the_local_record_without_firestore(tmp_path, monkeypatch):
+    monkeypatch.setattr(jsonl, "evaluate_plan_success_probability", lambda instruction, sequence: 80.0)
+    path = tmp_path / "results.jsonl"
+    entry = {"document_id": "doc1", "instruction": "皿を片付けて"}
+    jsonl._append_jsonl_entry(path, entry)
+    jsonl._append_jsonl_entry(path, {"document_id": "doc2"})
+
+    future = jsonl.enqueue_plan_success_scoring(
+        "doc1", "皿を片付けて", "1. go to the キッチンの棚",
+        local_entry=entry, jsonl_path=path, saved_to_firestore=False,
+    )
+
+    assert future.result(timeout=5) == 80.0
+    assert entry["plan_success_probability"] == 80.0
+    assert _read(path) == [
+        {"document_id": "doc1", "instruction": "皿を片付けて", "plan_success_probability": 80.0},
+        {"document_id": "doc2"},
+    ]
+
+
+def test_appends_are_not_lost_while_scores_are_patched(tmp_path):
+    path = tmp_path / "results.jsonl"
+    jsonl._append_jsonl_entry(path, {"document_id": "scored"})
+
+    def append(worker):
+        for index in range(50):
+            jsonl._append_jsonl_entry(path, {"document_id": f"{worker}-{index}"})
+
+    def patch():
+        for index in range(50):
+            jsonl._patch_jsonl_entry(path, "scored", {"plan_success_probability": index})
+
+    threads = [threading.Thread(target=append, args=(worker,)) for worker in range(4)]
+    threads.append(threading.Thread(target=patch))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = _read(path)
+    assert len(records) == 1 + 4 * 50
+    assert records[0] == {"document_id": "scored", "plan_success_probability": 49}
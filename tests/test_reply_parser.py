@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+from utils.reply_parser import (
+    STEP_COMPLETED,
+    TAG_CLOSED,
+    StreamingTagParser,
+    parse_reply,
+    parse_steps,
+)
+
+REPLY = (
+    "<SpokenResponse>\nお皿を運びます。\n</SpokenResponse>\n"
+    "<TaskGoalDefinition>\nGoal: {'target_location': 'ダイニングテーブル', 'items_needed': {'皿': 1}}\n"
+    "</TaskGoalDefinition>\n"
+    "<FunctionSequence>\n1. go to the キッチンの棚\n2. pick up the 皿\n"
+    "3. go to the ダイニングテーブル\n4. put 皿 in the ダイニングテーブル\n</FunctionSequence>"
+)
+
+PARTS = [
+    "<SpokenResponse>", "</SpokenResponse>", "<FunctionSequence>", "</FunctionSequence>",
+    "<TaskGoalDefinition>", "</TaskGoalDefinition>", "<Updated>", "</Updated>",
+    "1. go to kitchen\n", "2. pick up cup\n", " 3. put cup on table", "\n", "hello ",
+    "こんにちは", "<b", "<", "x>", "<functionsequence>", "Goal: {'a': 1}",
+]
+TAGS = ("SpokenResponse", "TaskGoalDefinition", "FunctionSequence", "Updated")
+
+
+def _random_chunks(text, rng):
+    if len(text) < 2:
+        return [text]
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 10))))
+    return [text[a:b] for a, b in zip([0, *cuts], [*cuts, len(text)])]
+
+
+def _stream(chunks, **kwargs):
+    parser = StreamingTagParser(**kwargs)
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+
+def test_parse_reply_extracts_tags():
+    parsed = parse_reply(REPLY)
+
+    assert parsed.spoken_response == "お皿を運びます。"
+    assert "Goal:" in parsed.task_goal_definition
+    assert parsed.steps == [
+        "go to the キッチンの棚",
+        "pick up the 皿",
+        "go to the ダイニングテーブル",
+        "put 皿 in the ダイニングテーブル",
+    ]
+    assert parse_reply(REPLY) is parsed  # 同じ文字列はキャッシュから返す
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_streaming_matches_parse_reply_on_random_chunking(seed):
+    rng = random.Random(seed)
+    for _ in range(400):
+        text = "".join(rng.choice(PARTS) for _ in range(rng.randint(1, 14)))
+        events = _stream(_random_chunks(text, rng), capture_tags=TAGS)
+        parsed = parse_reply(text)
+
+        for tag in TAGS:
+            closed = [e.text for e in events if e.kind == TAG_CLOSED and e.tag.lower() == tag.lower()]
+            span = parsed.span(tag)
+            if span is None:
+                assert closed == [], (text, tag)
+            else:
+                assert closed[0] == span.inner, (text, tag)
+
+        sequence = parsed.span("FunctionSequence")
+        if sequence is not None:
+            steps = [e.text for e in events if e.kind == STEP_COMPLETED]
+            expected = parse_steps(sequence.inner)
+            assert steps[: len(expected)] == expected, text
+
+
+def test_steps_are_emitted_as_soon_as_each_line_completes():
+    parser = StreamingTagParser()
+
+    events = parser.feed("<FunctionSequence>\n1. go to the キッチンの棚")
+    assert [e for e in events if e.kind == STEP_COMPLETED] == []
+    events = parser.feed("\n2. pick up")
+    assert [e.text for e in events if e.kind == STEP_COMPLETED] == ["go to the キッチンの棚"]
+    events = parser.feed(" the 皿</FunctionSequence>")
+    assert [e.text for e in events if e.kind == STEP_COMPLETED] == ["pick up the 皿"]
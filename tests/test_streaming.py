@@ -0,0 +1,153 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils.llm_gateway import LLMGateway, LLMGatewayError
+from utils.streaming import stream_chat_reply
+
+
+def _chunk(content):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content))],
+        model="gpt-4o-mini",
+        usage=None,
+    )
+
+
+class _Placeholder:
+    def __init__(self):
+        self.shown = []
+
+    def markdown(self, text):
+        self.shown.append(text)
+
+
+class _ChunkStream:
+    """stream_chat_completion が返すイテレータの代わり（close されたかを記録する）"""
+
+    def __init__(self, contents):
+        self._chunks = iter(_chunk(content) for content in contents)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_spoken_response_is_shown_while_streaming_and_tags_reported():
+    stream = _ChunkStream([
+        "<SpokenResponse>お皿を", "運びます。</Spoken", "Response>\n<FunctionSequence>\n1. go to the キッチンの棚\n",
+        "2. pick up the 皿\n</FunctionSequence>",
+    ])
+    placeholder = _Placeholder()
+    closed_tags, steps = [], []
+
+    reply = stream_chat_reply(
+        stream,
+        placeholder,
+        on_tag_closed=lambda tag, content: closed_tags.append((tag, content)),
+        on_step=steps.append,
+    )
+
+    assert reply.startswith("<SpokenResponse>お皿を運びます。</SpokenResponse>")
+    assert placeholder.shown == ["お皿を", "お皿を運びます。"]
+    assert steps == ["go to the キッチンの棚", "pick up the 皿"]
+    assert closed_tags == [("FunctionSequence", "1. go to the キッチンの棚\n2. pick up the 皿")]
+    assert stream.closed
+
+
+def test_stream_is_closed_when_rendering_stops_early():
+    class _BrokenPlaceholder:
+        def markdown(self, text):
+            raise RuntimeError("rerun")
+
+    stream = _ChunkStream(["<SpokenResponse>こんにちは", "</SpokenResponse>"])
+    with pytest.raises(RuntimeError):
+        stream_chat_reply(stream, _BrokenPlaceholder())
+    assert stream.closed
+
+
+class _AsyncStream:
+    """AsyncOpenAI のストリーム応答の代わり"""
+
+    def __init__(self, fail_at=None):
+        self.received = 0
+        self.fail_at = fail_at
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0.01)
+        self.received += 1
+        if self.received == self.fail_at:
+            raise ValueError("connection reset")
+        return _chunk("x")
+
+    async def close(self):
+        self.closed = True
+
+
+class _FakeCompletions:
+    """chat.completions.create(stream=True) だけを持つ AsyncOpenAI の代わり"""
+
+    def __init__(self):
+        self.fail_at = None
+        self.streams = []
+
+    async def create(self, **request):
+        stream = _AsyncStream(fail_at=self.fail_at)
+        self.streams.append(stream)
+        return stream
+
+
+@pytest.fixture
+def completions():
+    return _FakeCompletions()
+
+
+@pytest.fixture
+def gateway(monkeypatch, completions):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    gateway = LLMGateway(max_concurrent_requests=1, retry_max_attempts=1)
+    gateway._ensure_started()
+    gateway._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return gateway
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_abandoned_stream_is_cancelled_and_its_slot_released(gateway, completions):
+    chunks = gateway.stream_chat_completion([{"role": "user", "content": "こんにちは"}])
+    next(chunks)
+    next(chunks)
+    chunks.close()
+
+    assert _wait_for(lambda: completions.streams[0].closed)
+    assert _wait_for(lambda: gateway._semaphore._value == 1)
+    received = completions.streams[0].received
+    time.sleep(0.05)
+    assert completions.streams[0].received == received  # 受信は止まっている
+
+
+def test_errors_during_streaming_surface_as_gateway_errors(gateway, completions):
+    completions.fail_at = 3
+
+    with pytest.raises(LLMGatewayError) as excinfo:
+        list(gateway.stream_chat_completion([{"role": "user", "content": "こんにちは"}]))
+
+    assert isinstance(excinfo.value.__cause__, ValueError)
+    assert _wait_for(lambda: gateway._semaphore._value == 1)
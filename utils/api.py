@@ -1,5 +1,4 @@
 import streamlit as st
-from openai import OpenAI
 import re
 import os
 import base64
@@ -12,23 +11,7 @@ try:
 except Exception:
     pass
 
-def _get_streamlit_secret():
-    try:
-        import streamlit as st
-        return st.secrets.get("OPENAI_API_KEY")
-    except Exception:
-        return None
-
-api_key = os.getenv("OPENAI_API_KEY") or _get_streamlit_secret()
-
-if not api_key:
-    raise RuntimeError(
-        "OPENAI_API_KEY が見つかりません。\n"
-        "・通常実行なら .env に OPENAI_API_KEY=... を書く\n"
-        "・Streamlit 実行なら .streamlit/secrets.toml に OPENAI_API_KEY=\"...\" を書く"
-    )
-
-client = OpenAI(api_key=api_key)
+# OpenAI クライアントは utils/llm_gateway.py で一元管理する
 
 SYSTEM_PROMPT = """
 <System>
@@ -0,0 +1,182 @@
+"""LLM に送る会話コンテキストの窓を管理する。
+
+st.session_state.context は会話が続く限り伸び続けるが、ロボットの状態は毎回
+<CurrentState>（get_state_as_xml_prompt）で渡しているため、古い実行ログは冗長。
+そこで直近 N ターンだけを原文のまま残し、それより古い実行ログは
+「実行済みの行動一覧」1 件に畳み込んでから API に渡す。
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Optional
+
+TOKEN_ENCODING_NAME = "o200k_base"  # gpt-4o 系のトークナイザ
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding(TOKEN_ENCODING_NAME)
+except Exception:  # tiktoken が無い環境では概算で数える
+    _ENCODING = None
+
+# count_text_tokens が使う数え方（トークン数を比べる結果と一緒に残す）
+TOKEN_COUNTER = f"tiktoken:{TOKEN_ENCODING_NAME}" if _ENCODING is not None else "approximate"
+
+EXECUTION_LOG_KIND = "execution_log"
+EXECUTION_LOG_PREFIX = "（実行完了:"
+PLAN_CHECK_KIND = "plan_check"
+PLAN_CHECK_PREFIX = "（計画の事前確認:"
+DEFAULT_KEEP_TURNS = 6
+DEFAULT_MAX_CONTEXT_TOKENS = 8000
+
+# メッセージごとのロール等のオーバーヘッド、画像 1 枚あたりの概算トークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 85
+
+_EXECUTION_ACTION_RE = re.compile(r"^（実行完了:\s*(.*?)。", re.MULTILINE)
+
+
+def count_text_tokens(text: str) -> int:
+    """テキストのトークン数を返す（tiktoken が無い場合は文字種から概算。TOKEN_COUNTER を参照）。"""
+
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def count_message_tokens(message: dict[str, Any]) -> int:
+    """メッセージ 1 件のトークン数。内容は変わらないので message 上にキャッシュする。"""
+
+    cached = message.get("token_count")
+    if isinstance(cached, int):
+        return cached
+
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens = count_text_tokens(content)
+    elif isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_text_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    else:
+        tokens = 0
+    tokens += MESSAGE_OVERHEAD_TOKENS
+    message["token_count"] = tokens
+    return tokens
+
+
+def count_messages_tokens(messages: list[dict[str, Any]]) -> int:
+    return sum(count_message_tokens(message) for message in messages)
+
+
+def is_execution_log(message: dict[str, Any]) -> bool:
+    if message.get("kind") == EXECUTION_LOG_KIND:
+        return True
+    content = message.get("content")
+    return (
+        message.get("role") == "user"
+        and isinstance(content, str)
+        and content.startswith(EXECUTION_LOG_PREFIX)
+    )
+
+
+def execution_log_message(action: str, execution_log: Optional[str]) -> dict[str, Any]:
+    """行動を 1 つ実行したことを LLM に伝えるユーザーメッセージ。"""
+
+    details = execution_log or "ロボットの状態を更新しました。"
+    return {
+        "role": "user",
+        "content": f"{EXECUTION_LOG_PREFIX} {action}。\n{details}）",
+        "kind": EXECUTION_LOG_KIND,
+        "action": action,
+    }
+
+
+def plan_check_message(issues: list[tuple[int, dict[str, Any]]]) -> dict[str, Any]:
+    """計画の事前確認（ESM.check_plan）で実行できなかった手順をまとめて伝えるユーザーメッセージ。
+
+    issues は (計画内の番号, check_plan の steps の要素) のリスト。
+    """
+
+    lines = "\n".join(
+        f"{number}. {step['action']} → {step['reason'] or step['status']}" for number, step in issues
+    )
+    return {
+        "role": "user",
+        "content": (
+            f"{PLAN_CHECK_PREFIX} 次の手順は現在の状態では実行できません。\n{lines}\n"
+            "これらを直した行動計画（FunctionSequence）を最初から出力し直してください。）"
+        ),
+        "kind": PLAN_CHECK_KIND,
+    }
+
+
+def execution_log_action(message: dict[str, Any]) -> str:
+    action = message.get("action")
+    if isinstance(action, str) and action:
+        return action
+    match = _EXECUTION_ACTION_RE.search(message.get("content") or "")
+    return match.group(1).strip() if match else ""
+
+
+def _summarize_execution_logs(messages: list[dict[str, Any]]) -> dict[str, str]:
+    actions = [action for action in map(execution_log_action, messages) if action]
+    lines = "\n".join(f"{idx}. {action}" for idx, action in enumerate(actions, start=1))
+    return {
+        "role": "user",
+        "content": (
+            "（これまでに実行済みの行動の要約。結果は CurrentState に反映済みです。\n"
+            f"{lines}）"
+        ),
+    }
+
+
+def build_context_window(
+    context: list[dict[str, Any]],
+    *,
+    keep_turns: int = DEFAULT_KEEP_TURNS,
+    max_tokens: Optional[int] = DEFAULT_MAX_CONTEXT_TOKENS,
+) -> list[dict[str, Any]]:
+    """API に送るメッセージ列（role/content のみ）を組み立てる。
+
+    - 直近 keep_turns ターン（ユーザー発話を起点とする区切り）は原文のまま残す
+    - それより古い実行ログは要約メッセージ 1 件に畳み込む
+    - それでも max_tokens を超える場合は、最初の指示を残して古い発話から落とす
+    """
+
+    turn_starts = [
+        idx
+        for idx, message in enumerate(context)
+        if message.get("role") == "user" and not is_execution_log(message)
+    ]
+    if keep_turns > 0 and len(turn_starts) > keep_turns:
+        cutoff = turn_starts[-keep_turns]
+    else:
+        cutoff = 0
+
+    older: list[dict[str, Any]] = []
+    folded_logs: list[dict[str, Any]] = []
+    summary_position: Optional[int] = None
+    for message in context[:cutoff]:
+        if is_execution_log(message):
+            if summary_position is None:
+                summary_position = len(older)
+            folded_logs.append(message)
+        else:
+            older.append(message)
+    if folded_logs:
+        older.insert(summary_position, _summarize_execution_logs(folded_logs))
+
+    recent = context[cutoff:]
+    if max_tokens is not None:
+        total = count_messages_tokens(older) + count_messages_tokens(recent)
+        # 先頭（最初の指示）は残し、その次から古い順に落とす
+        while total > max_tokens and len(older) > 1:
+            total -= count_message_tokens(older.pop(1))
+
+    return [{"role": m["role"], "content": m["content"]} for m in older + recent]
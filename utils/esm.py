@@ -1,12 +1,448 @@
+import argparse
 import ast
+import json
 import re
+import sys
+import threading
+from array import array
 from copy import deepcopy
 from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+
+from utils.context_window import TOKEN_COUNTER, count_text_tokens
+
+# 何件の差分ごとに全体のスナップショット（チェックポイント）を持つか
+HISTORY_CHECKPOINT_INTERVAL = 20
+
+# <CurrentState> の <Environment> で先に並べる場所（この順）。ここに無い場所はその後ろに続ける
+XML_LOCATION_ORDER = (
+    # --- キッチン・ダイニング ---
+    "キッチンの棚", "キッチンの引き出し", "ダイニングテーブル", "キッチンシンク", "冷蔵庫",
+    # --- 居住スペース ---
+    "リビングルーム", "寝室", "デスク",
+    # --- 収納 ---
+    "一番上の棚", "クローゼット", "物置",
+    # --- 水回り・その他 ---
+    "玄関", "洗面所", "浴室", "トイレ", "ベランダ",
+)
+
+# get_state_as_xml_prompt の書式
+#   repr: 従来どおり Python のリスト表記（['皿', 'コップ']）
+#   delimited: 「、」区切り（皿、コップ）
+#   goal_pruned: delimited に加え、タスク目標に関係せず初期状態から変わっていない場所の中身を省く
+#   known_pruned: delimited に加え、タスク目標にも KnownItemLocations にも出てこない場所の中身を省く
+STATE_ENCODINGS = ("repr", "delimited", "goal_pruned", "known_pruned")
+STATE_LIST_DELIMITER = "、"
+
+
+def _join_names(names):
+    return STATE_LIST_DELIMITER.join(names)
+
+
+def _apply_state_op(state, op):
+    """
+    状態の差分 1 件（{"op": 種類, ...}）を state（current_state と同じ形の辞書）に適用する。
+    履歴の再生と、ESM 自身の状態更新の両方でこの関数を通す。
+    （Firestore は配列の入れ子を保存できないので、差分は辞書で表す）
+    """
+    kind = op["op"]
+    robot_status = state.setdefault("robot_status", {})
+    if kind == "location":
+        robot_status["location"] = op["location"]
+    elif kind == "env_remove":
+        state["environment"][op["location"]].remove(op["item"])
+    elif kind == "env_append":
+        state["environment"].setdefault(op["location"], []).append(op["item"])
+    elif kind == "hold_set":
+        robot_status["holding"] = list(op["items"])
+    elif kind == "hold_append":
+        robot_status.setdefault("holding", []).append(op["item"])
+    elif kind == "hold_remove":
+        robot_status["holding"].remove(op["item"])
+    elif kind == "known_set":
+        state.setdefault("known_item_locations", {})[op["item"]] = op["location"]
+    elif kind == "known_pop":
+        state.setdefault("known_item_locations", {}).pop(op["item"], None)
+    elif kind == "open":
+        state.setdefault("open_locations", []).append(op["location"])
+    elif kind == "close":
+        state.setdefault("open_locations", []).remove(op["location"])
+    else:
+        raise ValueError(f"Unknown state op: {op!r}")
+
+
+def _snapshot_of(state):
+    """state_history の 1 件と同じ形（event / time を除く）の深いコピー"""
+    return {
+        "robot_status": deepcopy(state.get("robot_status", {})),
+        "environment": deepcopy(state.get("environment", {})),
+        "known_locations": deepcopy(state.get("known_item_locations", {})),
+        "open_locations": list(state.get("open_locations", [])),
+    }
+
+
+def _state_from_snapshot(snapshot):
+    return {
+        "robot_status": deepcopy(snapshot.get("robot_status", {})),
+        "environment": deepcopy(snapshot.get("environment", {})),
+        "known_item_locations": deepcopy(snapshot.get("known_locations", {})),
+        "open_locations": list(snapshot.get("open_locations", [])),
+    }
+
+
+def _history_snapshot(state, entry):
+    snapshot = {"event": entry["event"], "time": entry["time"]}
+    snapshot.update(_snapshot_of(state))
+    if entry.get("metadata"):
+        snapshot["metadata"] = entry["metadata"]
+    return snapshot
+
+
+def materialize_state_history(exported):
+    """
+    export_state_history() の出力（初期状態 + 差分列）から、
+    各時点のスナップショットのリストを復元する。
+    """
+    initial = exported.get("initial") or {}
+    state = _state_from_snapshot(initial)
+    history = [_history_snapshot(state, initial)]
+    for entry in exported.get("changes") or []:
+        for op in entry.get("delta", []):
+            _apply_state_op(state, op)
+        history.append(_history_snapshot(state, entry))
+    return history
+
+
+class _NameTable:
+    """
+    場所名・アイテム名と整数 ID の対応表。
+    プロセス内の全セッション（全 ESM）で共有するので、同じ名前の文字列は 1 つだけ持てばよい。
+    """
+
+    __slots__ = ("_ids", "_names", "_lock")
 
-class ExternalStateManager:
     def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._names: list[str] = []
+        self._lock = threading.Lock()
+
+    def intern(self, name: str) -> int:
+        name_id = self._ids.get(name)
+        if name_id is None:
+            with self._lock:
+                name_id = self._ids.get(name)
+                if name_id is None:
+                    name_id = len(self._names)
+                    self._names.append(sys.intern(name))
+                    self._ids[name] = name_id
+        return name_id
+
+    def lookup(self, name: str):
+        """登録済みならその ID、未登録なら None（検索では表を増やさない）"""
+        return self._ids.get(name)
+
+    def name(self, name_id: int) -> str:
+        return self._names[name_id]
+
+
+_NAMES = _NameTable()
+
+
+class _WorldState:
+    """
+    ESM の状態本体。名前はすべて _NAMES の ID で持つ。
+    場所ごとの中身は順序と重複を保つ array（"I"）で持つ
+    （XML の表示順や「最初に見つかった物」を選ぶ挙動がリストの順序に依存するため、集合にはしない）。
+    copy() は場所ごとの array をコピー元と共有し（copy-on-write）、
+    どちらかがその場所を変更するときに初めて複製する。
+    """
+
+    __slots__ = ("location", "holding", "environment", "known", "open", "owned")
+
+    def __init__(self):
+        self.location = None                            # 場所 ID（未設定なら None）
+        self.holding = array("I")                       # 持っている物の ID
+        self.environment: dict[int, array] = {}         # 場所 ID -> 物の ID（environment の順）
+        self.known: dict[int, int] = {}                 # 物の ID -> 場所 ID
+        self.open = array("I")                          # 開いている場所の ID
+        self.owned: set[int] = set()                    # 自分だけが持っている（そのまま変更してよい）場所 ID
+
+    @classmethod
+    def from_dict(cls, state):
+        world = cls()
+        intern = _NAMES.intern
+        robot_status = state.get("robot_status", {})
+        location = robot_status.get("location")
+        world.location = intern(location) if location is not None else None
+        holding = robot_status.get("holding", [])
+        if not isinstance(holding, list):
+            holding = [holding] if holding else []
+        world.holding = array("I", map(intern, holding))
+        world.environment = {
+            intern(loc): array("I", map(intern, items))
+            for loc, items in state.get("environment", {}).items()
+        }
+        world.owned = set(world.environment)
+        world.known = {
+            intern(item): intern(loc)
+            for item, loc in state.get("known_item_locations", {}).items()
+        }
+        world.open = array("I", map(intern, state.get("open_locations", [])))
+        return world
+
+    def copy(self):
+        """
+        場所ごとの中身は共有したままのコピー（コストは場所の数に比例し、物の数にはよらない）。
+        共有した array は双方とも所有しない扱いにし、変更するときは _own_location で複製する
+        """
+        world = _WorldState()
+        world.location = self.location
+        world.holding = array("I", self.holding)
+        world.environment = dict(self.environment)
+        world.known = dict(self.known)
+        world.open = array("I", self.open)
+        self.owned.clear()
+        return world
+
+    def _own_location(self, location_id: int) -> array:
+        items = self.environment.get(location_id)
+        if items is None:
+            items = self.environment[location_id] = array("I")
+        elif location_id not in self.owned:
+            items = self.environment[location_id] = array("I", items)
+        self.owned.add(location_id)
+        return items
+
+    def freeze(self) -> tuple:
+        """内容を表す（ハッシュ可能な）タプル。同じ状態かどうかの判定と共有に使う"""
+        return (
+            self.location,
+            tuple(self.holding),
+            tuple((loc, tuple(items)) for loc, items in self.environment.items()),
+            tuple(self.known.items()),
+            tuple(self.open),
+        )
+
+    def location_name(self):
+        return None if self.location is None else _NAMES.name(self.location)
+
+    def holding_names(self) -> list[str]:
+        return [_NAMES.name(item) for item in self.holding]
+
+    def to_dict(self, task_goal) -> dict:
+        """従来の current_state と同じ形の辞書（UI・保存用の読み取りビュー）"""
+        name = _NAMES.name
+        return {
+            "robot_status": {
+                "location": self.location_name(),
+                "holding": self.holding_names(),
+            },
+            "environment": {
+                name(loc): [name(item) for item in items]
+                for loc, items in self.environment.items()
+            },
+            "known_item_locations": {name(item): name(loc) for item, loc in self.known.items()},
+            "open_locations": [name(loc) for loc in self.open],
+            "task_goal": task_goal,
+        }
+
+    def apply(self, op) -> None:
+        """_apply_state_op と同じ差分を、ID 表現の状態に適用する"""
+        kind = op["op"]
+        intern = _NAMES.intern
+        if kind == "location":
+            self.location = intern(op["location"])
+        elif kind == "env_remove":
+            location_id = intern(op["location"])
+            if location_id not in self.environment:
+                raise KeyError(op["location"])
+            self._own_location(location_id).remove(intern(op["item"]))
+        elif kind == "env_append":
+            self._own_location(intern(op["location"])).append(intern(op["item"]))
+        elif kind == "hold_set":
+            self.holding = array("I", map(intern, op["items"]))
+        elif kind == "hold_append":
+            self.holding.append(intern(op["item"]))
+        elif kind == "hold_remove":
+            self.holding.remove(intern(op["item"]))
+        elif kind == "known_set":
+            self.known[intern(op["item"])] = intern(op["location"])
+        elif kind == "known_pop":
+            self.known.pop(intern(op["item"]), None)
+        elif kind == "open":
+            self.open.append(intern(op["location"]))
+        elif kind == "close":
+            self.open.remove(intern(op["location"]))
+        else:
+            raise ValueError(f"Unknown state op: {op!r}")
+
+
+def _comparable_key(world: _WorldState) -> tuple:
+    # 保存先（Firestore など）で辞書のキー順が変わっても一致するよう、場所と既知の位置は並べ替える
+    # （array は tobytes() にすると、要素のタプルを作るより速く比較できる）
+    return (
+        world.location,
+        world.holding.tobytes(),
+        tuple(sorted((loc, items.tobytes()) for loc, items in world.environment.items())),
+        tuple(sorted(world.known.items())),
+        world.open.tobytes(),
+    )
+
+
+def _snapshot_state_view(snapshot):
+    # from_dict は中身を ID の array に写すので、ここでは深いコピーを取らずに参照だけ渡す
+    return {
+        "robot_status": snapshot.get("robot_status", {}),
+        "environment": snapshot.get("environment", {}),
+        "known_item_locations": snapshot.get("known_locations", {}),
+        "open_locations": snapshot.get("open_locations", []),
+    }
+
+
+def snapshot_key(snapshot) -> tuple:
+    """
+    state_history の 1 件（保存済みの 4_current_state の各時点でもよい）の状態を
+    比較用のタプルにする。ExternalStateManager.state_key() と比較できる
+    """
+    return _comparable_key(_WorldState.from_dict(_snapshot_state_view(snapshot)))
+
+
+def history_state_keys(exported) -> list[tuple]:
+    """
+    export_state_history() の出力から、各時点の状態の比較用タプル（snapshot_key と同じ形）を順に返す。
+    スナップショットの辞書は作らずに、ID 表現の状態へ差分を直接適用する
+    """
+    world = _WorldState.from_dict(_snapshot_state_view(exported.get("initial") or {}))
+    keys = [_comparable_key(world)]
+    for entry in exported.get("changes") or []:
+        for op in entry.get("delta", []):
+            world.apply(op)
+        keys.append(_comparable_key(world))
+    return keys
+
+
+_SHARED_WORLDS: dict[tuple, _WorldState] = {}
+_SHARED_WORLDS_LIMIT = 8
+
+
+def _shared_world(world: _WorldState) -> _WorldState:
+    """
+    同じ内容の状態（主に初期状態）はセッション間で 1 つを共有する。
+    返した _WorldState は読み取り専用として扱い、変更するときは copy() すること。
+    """
+    key = world.freeze()
+    shared = _SHARED_WORLDS.get(key)
+    if shared is None:
+        if len(_SHARED_WORLDS) >= _SHARED_WORLDS_LIMIT:
+            _SHARED_WORLDS.clear()
+        shared = _SHARED_WORLDS.setdefault(key, world)
+    return shared
+
+
+@lru_cache(maxsize=32)
+def _build_indexes(environment_key):
+    """
+    environment（((場所 ID, (物の ID, ...)), ...)）から名前解決の索引を作る。
+    初期状態はどのセッションでも同じなので、結果はプロセス内で共有する（変更してはいけない）。
+    戻り値: (正規化した場所名 -> 場所 ID, 場所 ID -> 順番, 正規化した物の名前 -> ((場所 ID, 物の ID), ...))
+    """
+    location_index: dict[str, int] = {}
+    location_order: dict[int, int] = {}
+    item_index: dict[str, tuple] = {}
+    for location_id, items in environment_key:
+        location_order.setdefault(location_id, len(location_order))
+        location_index.setdefault(_NAMES.name(location_id).casefold(), location_id)
+        for item_id in items:
+            folded = _NAMES.name(item_id).casefold()
+            item_index[folded] = item_index.get(folded, ()) + ((location_id, item_id),)
+    return location_index, location_order, item_index
+
+
+# <AvailableSkills> の pattern（"take <object> from <location>" など）-> 状態更新の処理
+_SKILL_HANDLERS: dict = {}
+_SLOT_RE = re.compile(r"<(\w+)>")
+
+
+def skill(pattern):
+    """ExternalStateManager のメソッドを、pattern のスキルの処理として登録するデコレータ"""
+    def register(handler):
+        _SKILL_HANDLERS[pattern] = handler
+        return handler
+    return register
+
+
+def compile_skill_grammar(patterns):
+    """
+    スキルの pattern 群を 1 本の正規表現（選択）にまとめる。
+    各スキルは名前付きグループ s0, s1, ...（宣言順）になり、
+    一致したスキルは match.lastgroup で分かる。
+    戻り値: (正規表現, グループ名 -> pattern, グループ名 -> {スロット名: グループ名})
+    """
+    alternatives = []
+    groups = {}
+    slot_groups = {}
+    for index, pattern in enumerate(patterns):
+        group = f"s{index}"
+        slots = {}
+        parts = []
+        position = 0
+        for slot_match in _SLOT_RE.finditer(pattern):
+            parts.append(re.escape(pattern[position:slot_match.start()]))
+            slot = slot_match.group(1)
+            slots[slot] = f"{group}_{slot}"
+            parts.append(f"(?P<{group}_{slot}>.+)")
+            position = slot_match.end()
+        parts.append(re.escape(pattern[position:]))
+        alternatives.append(f"(?P<{group}>{''.join(parts)})")
+        groups[group] = pattern
+        slot_groups[group] = slots
+    return re.compile("|".join(alternatives), re.IGNORECASE), groups, slot_groups
+
+
+def register_skill(pattern, handler):
+    """
+    スキルを追加する（既存の pattern なら置き換え）。
+    handler(esm, log, **slots) の形で呼ばれ、前提を満たさず失敗したときは False を返す。
+    """
+    global _SKILL_GRAMMAR, _SKILL_GROUPS, _SKILL_SLOT_GROUPS
+    _SKILL_HANDLERS[pattern] = handler
+    _SKILL_GRAMMAR, _SKILL_GROUPS, _SKILL_SLOT_GROUPS = compile_skill_grammar(_SKILL_HANDLERS)
+
+
+class PlanCheck:
+    """ESM のコピー上で手順を 1 つずつ試し実行し、結果を溜める（ExternalStateManager.start_plan_check）"""
+
+    def __init__(self, scratch):
+        self._scratch = scratch
+        self.steps = []
+
+    def add(self, action):
+        """手順を試し実行し、{"action", "status", "reason"} を返す"""
+        action = str(action)
+        messages = []
+        status = self._scratch._execute_action(action, messages.append)
+        # 先頭の "Action Executed" と末尾の "State Updated" を除いた行が理由
+        step = {"action": action, "status": status, "reason": "\n".join(messages[1:-1])}
+        self.steps.append(step)
+        return step
+
+    def report(self):
+        """これまでの手順の結果を check_plan と同じ形で返す"""
+        steps = list(self.steps)
+        first_failure = next((index for index, step in enumerate(steps) if step["status"] != "ok"), None)
+        return {"feasible": first_failure is None, "first_failure": first_failure, "steps": steps}
+
+
+class ExternalStateManager:
+    def __init__(self, initial_state=None, *, verbose=True):
+        """
+        initial_state: 初期状態（current_state と同じ形）。省略すると下の既定の家の状態から始める
+        verbose: False にすると実行ログなどを標準出力に出さない（リプレイなどの一括処理用）
+        """
+        self.verbose = verbose
         # 1. 既知の初期状態
-        self.current_state = {
+        default_state = {
             "robot_status": {
                 "location": "リビングルーム",
                 "holding": []
@@ -226,113 +662,360 @@ class ExternalStateManager:
                 "items_needed": {}
             }
         }
-        self.state_history: list[dict] = []
+        # 状態本体は ID と array で持ち、current_state は従来の形の辞書として都度組み立てる
+        # 状態履歴は「初期状態 + 行動ごとの差分」で持ち、スナップショットは必要なときに復元する
+        # （初期状態はどのセッションでも同じなので共有する）
+        if initial_state is None:
+            initial_state = default_state
+        self._history_base = _shared_world(_WorldState.from_dict(initial_state))
+        self._world = self._history_base.copy()
+        self.task_goal = deepcopy(initial_state.get("task_goal") or default_state["task_goal"])
+        self._rebuild_indexes()
+        self._reset_xml_cache()
+        self._history_entries: list[dict] = []
+        self._history_checkpoints: dict[int, _WorldState] = {}
+        self._pending_delta: list[dict] = []
         self._record_state_snapshot("initialized")
 
+    @property
+    def current_state(self) -> dict:
+        """
+        従来どおりの形の状態（robot_status / environment / known_item_locations /
+        open_locations / task_goal）。呼び出すたびに組み立てる読み取り用のビューで、
+        変更は update_state_from_action などを通して行う。
+        """
+        return self._world.to_dict(self.task_goal)
+
+    def state_key(self) -> tuple:
+        """現在の状態（task_goal を除く）を比較用のタプルにする（snapshot_key と比較できる）"""
+        return _comparable_key(self._world)
+
+    def _print(self, message) -> None:
+        if self.verbose:
+            print(message)
+
+    def _apply(self, kind: str, **fields) -> None:
+        """状態を 1 件更新し、次に記録する履歴の差分に積む"""
+        op = {"op": kind, **fields}
+        self._world.apply(op)
+        self._pending_delta.append(op)
+        if kind == "env_remove":
+            location_id = _NAMES.intern(op["location"])
+            self._unindex_item(location_id, _NAMES.intern(op["item"]))
+            # 中身が変わった場所の XML 断片だけを捨てる（次の get_state_as_xml_prompt で作り直す）
+            self._xml_fragments.pop(location_id, None)
+        elif kind == "env_append":
+            location_id = _NAMES.intern(op["location"])
+            self._index_location(location_id)
+            self._index_item(location_id, _NAMES.intern(op["item"]))
+            self._xml_fragments.pop(location_id, None)
+
+    # ------------------------------------------------------------------
+    # 名前の解決（大文字小文字を区別しない索引）
+    # ------------------------------------------------------------------
+    def _rebuild_indexes(self) -> None:
+        """
+        environment から索引を作り直す（いずれも ID で持つ）。
+        _location_index: 正規化した場所名 -> 場所 ID（environment の順で最初のもの）
+        _location_order: 場所 ID -> environment 内での順番
+        _item_index_base: 正規化した物の名前 -> ((場所 ID, 物の ID), ...)（並び順。共有・読み取り専用）
+        _item_index: 上記のうち、このセッションで変わった名前だけを持つ上書き分
+        """
+        environment_key = self._world.freeze()[2]
+        self._location_index, self._location_order, self._item_index_base = _build_indexes(environment_key)
+        self._owns_location_index = False
+        self._item_index: dict[str, tuple] = {}
+
+    def _item_entries(self, folded: str) -> tuple:
+        if folded in self._item_index:
+            return self._item_index[folded]
+        return self._item_index_base.get(folded, ())
+
+    def _index_location(self, location_id: int) -> None:
+        if location_id not in self._location_order:
+            if not self._owns_location_index:
+                # 共有している索引を書き換えないよう、最初の追加時に自分用に複製する
+                self._location_index = dict(self._location_index)
+                self._location_order = dict(self._location_order)
+                self._owns_location_index = True
+            self._location_order[location_id] = len(self._location_order)
+            self._location_index.setdefault(_NAMES.name(location_id).casefold(), location_id)
+            self._xml_order = None
+
+    def _index_item(self, location_id: int, item_id: int) -> None:
+        folded = _NAMES.name(item_id).casefold()
+        self._item_index[folded] = self._item_entries(folded) + ((location_id, item_id),)
+
+    def _unindex_item(self, location_id: int, item_id: int) -> None:
+        folded = _NAMES.name(item_id).casefold()
+        entries = list(self._item_entries(folded))
+        entries.remove((location_id, item_id))
+        self._item_index[folded] = tuple(entries)
+
+    def resolve_location(self, name: str) -> str:
+        """既存の場所名に大文字小文字を無視して一致すればその表記を、無ければ name を返す"""
+        location_id = self._location_index.get(name.casefold())
+        return name if location_id is None else _NAMES.name(location_id)
+
+    def find_item(self, name: str, location: str | None = None):
+        """
+        アイテムを探して (表記, 場所) を返す。見つからなければ None。
+        location にあればそれを優先し、無ければ environment の順で最初の場所を返す。
+        """
+        entries = self._item_entries(name.casefold())
+        if not entries:
+            return None
+        location_id = _NAMES.lookup(location) if location is not None else None
+        for entry_location, item_id in entries:
+            if entry_location == location_id:
+                return _NAMES.name(item_id), _NAMES.name(location_id)
+        # min は最初の最小要素を返すので、その場所の中では並び順で最初の物になる
+        location_id, item_id = min(entries, key=lambda entry: self._location_order[entry[0]])
+        return _NAMES.name(item_id), _NAMES.name(location_id)
+
+    def has_item_at(self, item: str, location: str | None) -> bool:
+        """location に item（表記どおり）があるか"""
+        if not location:
+            return False
+        item_id = _NAMES.lookup(item)
+        location_id = _NAMES.lookup(location)
+        if item_id is None or location_id is None:
+            return False
+        return (location_id, item_id) in self._item_entries(item.casefold())
+
     def _record_state_snapshot(self, event: str, metadata: dict | None = None) -> None:
-        snapshot = {
+        """
+        直前の記録以降の差分を履歴 1 件として確定する。
+        差分が無い（状態が変わっていない）場合は記録しない。
+        """
+        if self._history_entries and not self._pending_delta:
+            return
+
+        entry = {
             "event": event,
             "time": datetime.now(timezone.utc).isoformat(),
-            "robot_status": deepcopy(self.current_state.get("robot_status", {})),
-            "environment": deepcopy(self.current_state.get("environment", {})),
-            "known_locations": deepcopy(self.current_state.get("known_item_locations", {})),
-            "open_locations": list(self.current_state.get("open_locations", [])),
+            "delta": self._pending_delta,
         }
         if metadata:
-            snapshot["metadata"] = metadata
-
-        if self.state_history:
-            last = self.state_history[-1]
-            if (
-                last.get("robot_status") == snapshot["robot_status"]
-                and last.get("environment") == snapshot["environment"]
-                and last.get("known_locations") == snapshot["known_locations"]
-                and last.get("open_locations") == snapshot["open_locations"]
-            ):
-                return
-
-        self.state_history.append(snapshot)
+            entry["metadata"] = metadata
+        self._pending_delta = []
+        self._history_entries.append(entry)
+
+        index = len(self._history_entries) - 1
+        if index and index % HISTORY_CHECKPOINT_INTERVAL == 0:
+            self._history_checkpoints[index] = self._world.copy()
+
+    def snapshot_at(self, index: int) -> dict:
+        """
+        index 番目の履歴時点の状態を復元する。
+        直前のチェックポイントから差分を再生するので、履歴全体は辿らない。
+        """
+        entries = self._history_entries
+        if index < 0:
+            index += len(entries)
+        if not 0 <= index < len(entries):
+            raise IndexError("state history index out of range")
+
+        base_index = max((i for i in self._history_checkpoints if i <= index), default=0)
+        base = self._history_checkpoints.get(base_index, self._history_base)
+        state = base.to_dict(None)
+        for entry in entries[base_index + 1:index + 1]:
+            for op in entry["delta"]:
+                _apply_state_op(state, op)
+        return _history_snapshot(state, entries[index])
+
+    @property
+    def state_history(self) -> list[dict]:
+        """従来どおりの形（各時点の完全なスナップショット）で履歴を復元する"""
+        return materialize_state_history(self.export_state_history())
+
+    def export_state_history(self) -> dict:
+        """保存用のコンパクトな履歴（初期状態 + 差分列）"""
+        initial_entry = self._history_entries[0]
+        initial = {"event": initial_entry["event"], "time": initial_entry["time"]}
+        initial.update(_snapshot_of(self._history_base.to_dict(None)))
+        return {
+            "initial": initial,
+            "changes": deepcopy(self._history_entries[1:]),
+        }
     
+    def set_task_goal(self, target_location, items_needed, raw=None):
+        """
+        [フェーズ1: サブゴール設定]
+        パース済みのタスク目標（構造化出力など）をそのまま self.task_goal に格納する。
+        items_needed は {'plate': 2} のような アイテム名 -> 個数 の辞書
+        """
+        self.task_goal['target_location'] = target_location
+        self.task_goal['items_needed'] = dict(items_needed or {})
+        self._print(f"Goal Set: {self.task_goal}")
+        self._record_state_snapshot(
+            "task_goal_updated",
+            metadata={"raw": raw} if raw is not None else None,
+        )
+
     def set_task_goal_from_llm(self, goal_description_from_llm):
         """
         [フェーズ1: サブゴール設定]
-        LLMとの対話で決定した「タスク目標」をパースして、self.current_state に格納する。
+        LLMとの対話で決定した「タスク目標」をパースして、self.task_goal に格納する。
         LLMが "Goal: {target: 'dining_table', items: {'plate': 2}}" のようなJSONを出力
         """
         try:
             # "Goal: " の後の辞書部分 {...} を正規表現で抽出
             match = re.search(r'Goal:\s*(\{.*\})', goal_description_from_llm, re.DOTALL)
             if not match:
-                print(f"Error: Could not find 'Goal: {{...}}' pattern in: {goal_description_from_llm}")
+                self._print(f"Error: Could not find 'Goal: {{...}}' pattern in: {goal_description_from_llm}")
                 return False
 
             goal_str = match.group(1)
             # 文字列を安全にPythonの辞書に変換
             goal_dict = ast.literal_eval(goal_str) 
             
-            self.current_state['task_goal']['target_location'] = goal_dict.get('target_location')
-            self.current_state['task_goal']['items_needed'] = goal_dict.get('items_needed', {})
-            print(f"Goal Set: {self.current_state['task_goal']}")
-            self._record_state_snapshot(
-                "task_goal_updated",
-                metadata={"raw": goal_description_from_llm},
+            self.set_task_goal(
+                goal_dict.get('target_location'),
+                goal_dict.get('items_needed', {}),
+                raw=goal_description_from_llm,
             )
             return True # パース成功
         except Exception as e:
-            print(f"Error parsing task goal: {e}")
-            print(f"Received string: {goal_description_from_llm}")
+            self._print(f"Error parsing task goal: {e}")
+            self._print(f"Received string: {goal_description_from_llm}")
             return False # パース失敗
 
-    def get_state_as_xml_prompt(self):
+    def get_state_as_xml_prompt(self, encoding="repr"):
         """
         [フェーズ2: 計画]
-        現在の self.current_state を、LLMのプロンプトに埋め込むためのXML形式に変換する
+        現在の状態を、LLMのプロンプトに埋め込むためのXML形式に変換する
+        場所ごとの断片はキャッシュしておき、前回から中身が変わった場所だけ作り直す
+        encoding は STATE_ENCODINGS のいずれか（"repr" が従来どおりの Python のリスト表記）
         """
-        state = self.current_state
+        if encoding not in STATE_ENCODINGS:
+            raise ValueError(f"Unknown state encoding: {encoding!r}")
+        compact = encoding != "repr"
+        world = self._world
+        location_ids = self._xml_location_ids()
+        relevant = self._relevant_location_ids(encoding)
+        if relevant is None:
+            shown, omitted = location_ids, ()
+        else:
+            shown = [location_id for location_id in location_ids if location_id in relevant]
+            omitted = [_NAMES.name(location_id) for location_id in location_ids if location_id not in relevant]
+        style = "delimited" if compact else "repr"
+        environment_xml = "".join(self._location_xml(location_id, style) for location_id in shown)
+
+        if compact:
+            holding = _join_names(world.holding_names())
+            known = _join_names(f"{_NAMES.name(item)}: {_NAMES.name(loc)}" for item, loc in world.known.items())
+            open_locations = _join_names(_NAMES.name(loc) for loc in world.open)
+        else:
+            holding = world.holding_names()
+            known = {_NAMES.name(item): _NAMES.name(loc) for item, loc in world.known.items()}
+            open_locations = [_NAMES.name(loc) for loc in world.open]
+
         xml_prompt = "<CurrentState>\n"
         xml_prompt += f"  <RobotStatus>\n"
-        xml_prompt += f"    <Location>{state['robot_status']['location']}</Location>\n"
-        xml_prompt += f"    <Holding>{state['robot_status']['holding']}</Holding>\n"
+        xml_prompt += f"    <Location>{world.location_name()}</Location>\n"
+        xml_prompt += f"    <Holding>{holding}</Holding>\n"
         xml_prompt += f"  </RobotStatus>\n"
         xml_prompt += f"  <Environment>\n"
-
-        # --- キッチン・ダイニング ---
-        xml_prompt += f"    <キッチンの棚>{state['environment']['キッチンの棚']}</キッチンの棚>\n"
-        xml_prompt += f"    <キッチンの引き出し>{state['environment']['キッチンの引き出し']}</キッチンの引き出し>\n"
-        xml_prompt += f"    <ダイニングテーブル>{state['environment']['ダイニングテーブル']}</ダイニングテーブル>\n"
-        xml_prompt += f"    <キッチンシンク>{state['environment']['キッチンシンク']}</キッチンシンク>\n"
-        xml_prompt += f"    <冷蔵庫>{state['environment']['冷蔵庫']}</冷蔵庫>\n"
-
-        # --- 居住スペース ---
-        xml_prompt += f"    <リビングルーム>{state['environment']['リビングルーム']}</リビングルーム>\n"
-        xml_prompt += f"    <寝室>{state['environment']['寝室']}</寝室>\n"
-        xml_prompt += f"    <デスク>{state['environment']['デスク']}</デスク>\n"
-
-        # --- 収納 ---
-        xml_prompt += f"    <一番上の棚>{state['environment']['一番上の棚']}</一番上の棚>\n"
-        xml_prompt += f"    <クローゼット>{state['environment']['クローゼット']}</クローゼット>\n"
-        xml_prompt += f"    <物置>{state['environment']['物置']}</物置>\n"
-
-        # --- 水回り・その他 ---
-        xml_prompt += f"    <玄関>{state['environment']['玄関']}</玄関>\n"
-        xml_prompt += f"    <洗面所>{state['environment']['洗面所']}</洗面所>\n"
-        xml_prompt += f"    <浴室>{state['environment']['浴室']}</浴室>\n"
-        xml_prompt += f"    <トイレ>{state['environment']['トイレ']}</トイレ>\n"
-        xml_prompt += f"    <ベランダ>{state['environment']['ベランダ']}</ベランダ>\n"
-
+        xml_prompt += environment_xml
         xml_prompt += f"  </Environment>\n"
-        xml_prompt += f"  <KnownItemLocations>{state.get('known_item_locations', {})}</KnownItemLocations>\n"
-        xml_prompt += f"  <OpenLocations>{state.get('open_locations', [])}</OpenLocations>\n"
+        if omitted:
+            xml_prompt += f"  <OmittedLocations>{_join_names(omitted)}</OmittedLocations>\n"
+        xml_prompt += f"  <KnownItemLocations>{known}</KnownItemLocations>\n"
+        xml_prompt += f"  <OpenLocations>{open_locations}</OpenLocations>\n"
         xml_prompt += f"  <TaskGoal>\n"
-        xml_prompt += f"    <TargetLocation>{state['task_goal']['target_location']}</TargetLocation>\n"
-        xml_prompt += f"    <ItemsNeeded>{state['task_goal']['items_needed']}</ItemsNeeded>\n"
+        xml_prompt += f"    <TargetLocation>{self.task_goal['target_location']}</TargetLocation>\n"
+        xml_prompt += f"    <ItemsNeeded>{self.task_goal['items_needed']}</ItemsNeeded>\n"
         xml_prompt += f"  </TaskGoal>\n"
         xml_prompt += "  <PlanningHint>\n"
         xml_prompt += "    行動計画（FunctionSequence）で場所やアイテムを指定するときは、current_stateに記載された名称の中から最も似ている語を探して使用してください。\n"
         xml_prompt += "    current_stateに類似した名称が見つからない場合は、その場所やアイテムは環境にないと発話してください。\n"
+        if omitted:
+            xml_prompt += "    OmittedLocations の場所は中身を省略しています。そこにある物が必要なときは find <object> で探してください。\n"
         xml_prompt += "  </PlanningHint>\n"
         xml_prompt += "</CurrentState>"
         return xml_prompt
+
+    def _reset_xml_cache(self) -> None:
+        """<Environment> の場所ごとの断片（場所 ID -> {書式: XML 1 行}）と表示順のキャッシュを捨てる"""
+        self._xml_fragments: dict[int, dict[str, str]] = {}
+        self._xml_order: tuple | None = None
+
+    def _xml_location_ids(self) -> tuple:
+        """
+        <Environment> に並べる場所 ID。XML_LOCATION_ORDER の場所を先に（その順で）、
+        それ以外（put で新しく出来た場所など）を environment の順で後ろに並べる
+        """
+        if self._xml_order is None:
+            environment = self._world.environment
+            preferred = []
+            for name in XML_LOCATION_ORDER:
+                location_id = _NAMES.lookup(name)
+                if location_id is not None and location_id in environment:
+                    preferred.append(location_id)
+            others = [location_id for location_id in environment if location_id not in preferred]
+            self._xml_order = tuple(preferred + others)
+        return self._xml_order
+
+    def _location_xml(self, location_id: int, style: str) -> str:
+        fragments = self._xml_fragments.setdefault(location_id, {})
+        fragment = fragments.get(style)
+        if fragment is None:
+            name = _NAMES.name(location_id)
+            items = [_NAMES.name(item) for item in self._world.environment[location_id]]
+            content = _join_names(items) if style == "delimited" else items
+            fragment = f"    <{name}>{content}</{name}>\n"
+            fragments[style] = fragment
+        return fragment
+
+    def _relevant_location_ids(self, encoding: str):
+        """
+        中身を省略せずに出す場所 ID の集合。省略しない書式、またはタスク目標が未設定なら None（全部出す）。
+        どちらのモードでも、ロボットの現在地・目標の場所・必要な物がある場所は残す。
+        goal_pruned: 加えて、初期状態から中身が変わった場所
+        known_pruned: 加えて、KnownItemLocations に出てくる場所と開いている場所
+        """
+        if encoding not in ("goal_pruned", "known_pruned"):
+            return None
+        target = self.task_goal.get("target_location")
+        needed = self.task_goal.get("items_needed") or {}
+        if not target and not needed:
+            # 目標が決まるまでは、ユーザーとの確認に環境全体が要る
+            return None
+
+        world = self._world
+        relevant = set()
+        if world.location is not None:
+            relevant.add(world.location)
+        if target:
+            target_id = self._location_index.get(str(target).casefold())
+            if target_id is not None:
+                relevant.add(target_id)
+        for item in needed:
+            relevant.update(location_id for location_id, _ in self._item_entries(str(item).casefold()))
+        if encoding == "goal_pruned":
+            initial = self._history_base.environment
+            relevant.update(
+                location_id for location_id, items in world.environment.items()
+                if initial.get(location_id) != items
+            )
+        else:
+            relevant.update(world.known.values())
+            relevant.update(world.open)
+        return relevant
+
+    def compare_state_encodings(self, encodings=None) -> dict:
+        """
+        現在の状態を各書式で出力したときの大きさ
+        （{"token_counter": 数え方, "encodings": {書式: {"tokens", "chars"}}}）。
+        トークン数は utils.context_window.count_text_tokens で数える。tiktoken が無い環境では
+        概算になるので、token_counter（utils.context_window.TOKEN_COUNTER）で区別する
+        """
+        sizes = {}
+        for encoding in encodings or STATE_ENCODINGS:
+            xml_prompt = self.get_state_as_xml_prompt(encoding)
+            sizes[encoding] = {"tokens": count_text_tokens(xml_prompt), "chars": len(xml_prompt)}
+        return {"token_counter": TOKEN_COUNTER, "encodings": sizes}
     
     def update_state_from_action(self, executed_action_string):
         """
@@ -344,210 +1027,344 @@ class ExternalStateManager:
         log_messages = []
 
         def log(message):
-            print(message)
+            self._print(message)
             log_messages.append(message)
 
+        self._execute_action(executed_action_string, log)
+        self._record_state_snapshot(
+            "action_update",
+            metadata={"action": executed_action_string},
+        )
+
+        return "\n".join(log_messages)
+
+    def _execute_action(self, executed_action_string, log):
+        """
+        行動 1 つを状態に反映し、結果を返す（履歴の確定は呼び出し側で行う）。
+        "ok" / "failed"（前提を満たさず何もしなかった）/ "unrecognized" / "error"
+        """
         log(f"Action Executed: {executed_action_string}")
         action = executed_action_string.strip()
-        normalized_action = action.lower()
-        state = self.current_state
-        robot_status = state.setdefault("robot_status", {})
-        environment = state.setdefault("environment", {})
-        known_locations = state.setdefault("known_item_locations", {})
-        open_locations = state.setdefault("open_locations", [])
-
-        def ensure_holding_list():
-            holding = robot_status.get("holding", [])
-            if isinstance(holding, list):
-                return holding
-            if holding:
-                robot_status["holding"] = [holding]
-            else:
-                robot_status["holding"] = []
-            return robot_status["holding"]
-
-        def resolve_location(name):
-            for existing_location in environment.keys():
-                if existing_location.lower() == name.lower():
-                    return existing_location
-            return name
-
-        def resolve_item(name, location_key=None):
-            if location_key:
-                for existing_item in environment.get(location_key, []):
-                    if existing_item.lower() == name.lower():
-                        return existing_item
-            for loc, items in environment.items():
-                for existing_item in items:
-                    if existing_item.lower() == name.lower():
-                        return existing_item
-            for held_item in ensure_holding_list():
-                if held_item.lower() == name.lower():
-                    return held_item
-            return name
-
-        def remove_from_holding(name):
-            holding_items = ensure_holding_list()
-            for idx, held_item in enumerate(holding_items):
-                if held_item.lower() == name.lower():
-                    return holding_items.pop(idx)
-            return None
+        status = "ok"
 
         try:
-            if normalized_action.startswith("go to the "):
-                match = re.match(r"go to the (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_location = match.group(1).strip()
-                    resolved_location = resolve_location(requested_location)
-                    robot_status["location"] = resolved_location
-                    log(f"Robot moved to {resolved_location}")
-                else:
-                    log(f"Could not parse location in action: {action}")
-
-            elif normalized_action.startswith("find "):
-                match = re.match(r"find (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_item = match.group(1).strip()
-                    resolved_item = None
-                    resolved_location = None
-                    for loc, items in environment.items():
-                        for candidate in items:
-                            if candidate.lower() == requested_item.lower():
-                                resolved_item = candidate
-                                resolved_location = loc
-                                break
-                        if resolved_item:
-                            break
-                    if resolved_item:
-                        known_locations[resolved_item] = resolved_location
-                        log(f"Found {resolved_item} at {resolved_location}")
-                    else:
-                        log(f"{requested_item} not found in the environment")
-                else:
-                    log(f"Could not parse item to find in action: {action}")
-
-            elif normalized_action.startswith("pick up the "):
-                match = re.match(r"pick up the (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_item = match.group(1).strip()
-                    current_location = robot_status.get("location")
-                    resolved_location = resolve_location(current_location) if current_location else None
-                    resolved_item = resolve_item(requested_item, resolved_location)
-                    if resolved_location and resolved_item in environment.get(resolved_location, []):
-                        environment[resolved_location].remove(resolved_item)
-                        ensure_holding_list().append(resolved_item)
-                        known_locations.pop(resolved_item, None)
-                        log(f"Robot picked up {resolved_item} from {resolved_location}")
-                    else:
-                        log(f"Item {requested_item} not found at {current_location}")
-                else:
-                    log(f"Could not parse item to pick up in action: {action}")
-
-            elif normalized_action.startswith("take ") and " from " in normalized_action:
-                match = re.match(r"take (.+) from (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_item = match.group(1).strip()
-                    requested_location = match.group(2).strip()
-                    resolved_location = resolve_location(requested_location)
-                    resolved_item = resolve_item(requested_item, resolved_location)
-                    current_location = robot_status.get("location")
-                    if current_location and resolved_location.lower() != current_location.lower():
-                        log(
-                            f"Robot is at {current_location} and cannot take items from {requested_location}"
-                        )
-                    elif resolved_item in environment.get(resolved_location, []):
-                        environment[resolved_location].remove(resolved_item)
-                        ensure_holding_list().append(resolved_item)
-                        known_locations.pop(resolved_item, None)
-                        log(f"Robot took {resolved_item} from {resolved_location}")
-                    else:
-                        log(f"Item {requested_item} not found in {requested_location}")
-                else:
-                    log(f"Could not parse take action: {action}")
-
-            elif normalized_action.startswith("put ") and " in the " in normalized_action:
-                match = re.match(r"put (.+) in the (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_item = match.group(1).strip()
-                    requested_location = match.group(2).strip()
-                    resolved_location = resolve_location(requested_location)
-                    current_location = robot_status.get("location")
-                    if current_location and resolved_location.lower() != current_location.lower():
-                        log(
-                            f"Robot is at {current_location} and cannot put items in {requested_location}"
-                        )
-                    else:
-                        resolved_item = resolve_item(requested_item)
-                        removed_item = remove_from_holding(resolved_item)
-                        if removed_item:
-                            environment.setdefault(resolved_location, []).append(removed_item)
-                            known_locations[removed_item] = resolved_location
-                            log(f"Robot put {removed_item} in the {resolved_location}")
-                        else:
-                            log(f"Robot is not holding {requested_item}")
-                else:
-                    log(f"Could not parse put action: {action}")
-
-            elif normalized_action.startswith("open the "):
-                match = re.match(r"open the (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_location = match.group(1).strip()
-                    resolved_location = resolve_location(requested_location)
-                    if resolved_location not in open_locations:
-                        open_locations.append(resolved_location)
-                    log(f"Robot opened the {resolved_location}")
-                else:
-                    log(f"Could not parse location to open in action: {action}")
-
-            elif normalized_action.startswith("close the "):
-                match = re.match(r"close the (.+)", action, re.IGNORECASE)
-                if match:
-                    requested_location = match.group(1).strip()
-                    resolved_location = resolve_location(requested_location)
-                    if resolved_location in open_locations:
-                        open_locations.remove(resolved_location)
-                    log(f"Robot closed the {resolved_location}")
-                else:
-                    log(f"Could not parse location to close in action: {action}")
-
-            elif normalized_action.startswith("hand over ") and " to user" in normalized_action:
-                match = re.match(r"hand over (.+) to user", action, re.IGNORECASE)
-                if match:
-                    requested_item = match.group(1).strip()
-                    removed_item = remove_from_holding(requested_item)
-                    if removed_item:
-                        log(f"Robot handed over {removed_item} to the user")
-                    else:
-                        log(f"Robot is not holding {requested_item}")
-                else:
-                    log(f"Could not parse hand over action: {action}")
-
-            elif normalized_action.startswith("push "):
-                match = re.match(r"push (.+)", action, re.IGNORECASE)
-                if match:
-                    pushed_object = match.group(1).strip()
-                    log(f"Robot pushed {pushed_object}")
-                else:
-                    log(f"Could not parse push action: {action}")
-
-            elif normalized_action.startswith("done"):
-                log("Task completed.")
-
+            # 全スキルを 1 本にまとめた正規表現で一度だけ照合し、一致したスキルの処理を呼ぶ
+            match = _SKILL_GRAMMAR.match(action)
+            if match:
+                pattern = _SKILL_GROUPS[match.lastgroup]
+                slots = {
+                    slot: match.group(group).strip()
+                    for slot, group in _SKILL_SLOT_GROUPS[match.lastgroup].items()
+                }
+                if _SKILL_HANDLERS[pattern](self, log, **slots) is False:
+                    status = "failed"
             else:
                 log(f"Unrecognized action: {action}")
+                status = "unrecognized"
 
         except Exception as e:
             log(f"State Update Error: {e} on action: {action}")
             # (失敗した場合の処理)
+            status = "error"
 
-        holding_display = robot_status.get("holding", [])
+        holding_display = self._world.holding_names()
         log(
-            f"State Updated: Robot at {robot_status.get('location')}, holding {holding_display}"
+            f"State Updated: Robot at {self._world.location_name()}, holding {holding_display}"
         )
+        return status
+
+    def apply_actions(self, actions, atomic=False):
+        """
+        行動計画（FunctionSequence の各行）をまとめて実行し、履歴には 1 件として記録する。
+        戻り値は各ステップの {"action", "status", "log"} のリスト。
+        log は update_state_from_action が返す文字列と同じ形式。
+
+        atomic=True のときは、先に全行をスキルの文法で検証し、1 行でも解釈できなければ
+        何も実行しない。実行中に失敗したステップがあれば、それまでの変更をすべて取り消す。
+        """
+        actions = [str(action) for action in actions]
+        results = []
+
+        if atomic:
+            unparsable = {
+                index for index, action in enumerate(actions)
+                if not _SKILL_GRAMMAR.match(action.strip())
+            }
+            if unparsable:
+                for index, action in enumerate(actions):
+                    status = "unrecognized" if index in unparsable else "skipped"
+                    results.append({"action": action, "status": status, "log": ""})
+                return results
+
+        pending_before = len(self._pending_delta)
+        for index, action in enumerate(actions):
+            step_logs = []
+
+            def log(message):
+                self._print(message)
+                step_logs.append(message)
+
+            status = self._execute_action(action, log)
+            results.append({"action": action, "status": status, "log": "\n".join(step_logs)})
+
+            if atomic and status != "ok":
+                self._rollback_pending(pending_before)
+                for result in results[:-1]:
+                    result["status"] = "rolled_back"
+                for skipped in actions[index + 1:]:
+                    results.append({"action": skipped, "status": "skipped", "log": ""})
+                return results
 
         self._record_state_snapshot(
-            "action_update",
-            metadata={"action": executed_action_string},
+            "batch_update",
+            metadata={
+                "actions": actions,
+                "statuses": [result["status"] for result in results],
+            },
         )
+        return results
 
-        return "\n".join(log_messages)
+    def check_plan(self, actions):
+        """
+        行動計画を、実際の状態は変えずに fork() したコピーの上で試し実行する（キューに積む前の確認用）。
+        失敗した手順があっても止めずに最後まで試すので、実行できない手順をまとめて調べられる。
+        戻り値: {"feasible", "first_failure"（最初に ok でなかった手順の番号。0 始まり、無ければ None）,
+                 "steps": [{"action", "status", "reason"}]}
+        reason はスキルが出したログ（"Robot is not holding ..." など）
+        """
+        check = self.start_plan_check()
+        for action in actions:
+            check.add(action)
+        return check.report()
+
+    def start_plan_check(self, after=()):
+        """
+        check_plan を 1 手順ずつ行う PlanCheck を返す（ストリーミング中、手順を受信するたびに確かめる用）。
+        after の行動（キューに残っている計画など）は先に試し実行し、結果には含めない。
+        """
+        check = PlanCheck(self.fork(verbose=False))
+        for action in after:
+            check.add(action)
+        check.steps.clear()
+        return check
+
+    def fork(self, *, verbose=None):
+        """
+        この ESM の現在の状態から分岐したコピーを返す（what-if の計画評価・先読み・事前確認用）。
+        状態は copy-on-write で共有し、分岐後にどちらかが変更した場所だけを複製するので、
+        コストは環境の大きさではなく分岐後の変更量に比例する。
+        分岐元と分岐先は互いに影響しない。履歴は分岐時点までを引き継ぎ、その後は別々に記録する。
+        verbose を省略すると分岐元の設定を引き継ぐ。
+        """
+        forked = object.__new__(type(self))
+        forked.__dict__.update(self.__dict__)
+        if verbose is not None:
+            forked.verbose = verbose
+        forked._world = self._world.copy()
+        forked.task_goal = deepcopy(self.task_goal)
+        # 共有している場所の索引は、次に場所が増えたほうが自分用に複製する
+        self._owns_location_index = False
+        forked._owns_location_index = False
+        forked._item_index = dict(self._item_index)
+        forked._history_entries = list(self._history_entries)
+        forked._history_checkpoints = dict(self._history_checkpoints)
+        forked._pending_delta = list(self._pending_delta)
+        # XML の断片は、変更した側が自分の辞書からその場所を外すだけなので共有してよい
+        forked._xml_fragments = dict(self._xml_fragments)
+        return forked
+
+    def _rollback_pending(self, keep):
+        """
+        まだ履歴に確定していない差分のうち、先頭 keep 件より後を取り消す。
+        最後に確定した時点の状態を復元して、残す差分だけを再適用する。
+        """
+        kept_ops = self._pending_delta[:keep]
+        restored = _state_from_snapshot(self.snapshot_at(-1))
+        for op in kept_ops:
+            _apply_state_op(restored, op)
+        self._world = _WorldState.from_dict(restored)
+        self._pending_delta = kept_ops
+        self._rebuild_indexes()
+        self._reset_xml_cache()
+
+    # ------------------------------------------------------------------
+    # スキルごとの状態更新（pattern は <AvailableSkills> の書式そのまま）
+    # ------------------------------------------------------------------
+    def _resolve_item(self, name, location_key=None):
+        found = self.find_item(name, location_key)
+        if found:
+            return found[0]
+        folded = name.casefold()
+        for held_item in self._world.holding_names():
+            if held_item.casefold() == folded:
+                return held_item
+        return name
+
+    def _remove_from_holding(self, name):
+        folded = name.casefold()
+        for held_item in self._world.holding_names():
+            if held_item.casefold() == folded:
+                self._apply("hold_remove", item=held_item)
+                return held_item
+        return None
+
+    def _known_location(self, item):
+        item_id = _NAMES.lookup(item)
+        location_id = self._world.known.get(item_id) if item_id is not None else None
+        return None if location_id is None else _NAMES.name(location_id)
+
+    def _is_open(self, location):
+        location_id = _NAMES.lookup(location)
+        return location_id is not None and location_id in self._world.open
+
+    def _take_item(self, item, location):
+        self._apply("env_remove", location=location, item=item)
+        self._apply("hold_append", item=item)
+        if self._known_location(item) is not None:
+            self._apply("known_pop", item=item)
+
+    @skill("go to the <location>")
+    def _skill_go_to(self, log, location):
+        resolved_location = self.resolve_location(location)
+        if self._world.location_name() != resolved_location:
+            self._apply("location", location=resolved_location)
+        log(f"Robot moved to {resolved_location}")
+
+    @skill("find <object>")
+    def _skill_find(self, log, object):
+        resolved_item, resolved_location = self.find_item(object) or (None, None)
+        if resolved_item:
+            if self._known_location(resolved_item) != resolved_location:
+                self._apply("known_set", item=resolved_item, location=resolved_location)
+            log(f"Found {resolved_item} at {resolved_location}")
+        else:
+            log(f"{object} not found in the environment")
+            return False
+
+    @skill("pick up the <object>")
+    def _skill_pick_up(self, log, object):
+        current_location = self._world.location_name()
+        resolved_location = self.resolve_location(current_location) if current_location else None
+        resolved_item = self._resolve_item(object, resolved_location)
+        if self.has_item_at(resolved_item, resolved_location):
+            self._take_item(resolved_item, resolved_location)
+            log(f"Robot picked up {resolved_item} from {resolved_location}")
+        else:
+            log(f"Item {object} not found at {current_location}")
+            return False
+
+    @skill("take <object> from <location>")
+    def _skill_take(self, log, object, location):
+        resolved_location = self.resolve_location(location)
+        resolved_item = self._resolve_item(object, resolved_location)
+        current_location = self._world.location_name()
+        if current_location and resolved_location.lower() != current_location.lower():
+            log(f"Robot is at {current_location} and cannot take items from {location}")
+            return False
+        elif self.has_item_at(resolved_item, resolved_location):
+            self._take_item(resolved_item, resolved_location)
+            log(f"Robot took {resolved_item} from {resolved_location}")
+        else:
+            log(f"Item {object} not found in {location}")
+            return False
+
+    @skill("put <object> in the <location>")
+    def _skill_put(self, log, object, location):
+        resolved_location = self.resolve_location(location)
+        current_location = self._world.location_name()
+        if current_location and resolved_location.lower() != current_location.lower():
+            log(f"Robot is at {current_location} and cannot put items in {location}")
+            return False
+        removed_item = self._remove_from_holding(self._resolve_item(object))
+        if removed_item:
+            self._apply("env_append", location=resolved_location, item=removed_item)
+            if self._known_location(removed_item) != resolved_location:
+                self._apply("known_set", item=removed_item, location=resolved_location)
+            log(f"Robot put {removed_item} in the {resolved_location}")
+        else:
+            log(f"Robot is not holding {object}")
+            return False
+
+    @skill("open the <location>")
+    def _skill_open(self, log, location):
+        resolved_location = self.resolve_location(location)
+        if not self._is_open(resolved_location):
+            self._apply("open", location=resolved_location)
+        log(f"Robot opened the {resolved_location}")
+
+    @skill("close the <location>")
+    def _skill_close(self, log, location):
+        resolved_location = self.resolve_location(location)
+        if self._is_open(resolved_location):
+            self._apply("close", location=resolved_location)
+        log(f"Robot closed the {resolved_location}")
+
+    @skill("hand over <object> to user")
+    def _skill_hand_over(self, log, object):
+        removed_item = self._remove_from_holding(object)
+        if removed_item:
+            log(f"Robot handed over {removed_item} to the user")
+        else:
+            log(f"Robot is not holding {object}")
+            return False
+
+    @skill("push <object>")
+    def _skill_push(self, log, object):
+        log(f"Robot pushed {object}")
+
+    @skill("done")
+    def _skill_done(self, log):
+        log("Task completed.")
+
+
+_SKILL_GRAMMAR, _SKILL_GROUPS, _SKILL_SLOT_GROUPS = compile_skill_grammar(_SKILL_HANDLERS)
+
+
+class PlanCheck:
+    """ESM のコピー上で手順を 1 つずつ試し実行し、結果を溜める（ExternalStateManager.start_plan_check）"""
+
+    def __init__(self, scratch):
+        self._scratch = scratch
+        self.steps = []
+
+    def add(self, action):
+        """手順を試し実行し、{"action", "status", "reason"} を返す"""
+        action = str(action)
+        messages = []
+        status = self._scratch._execute_action(action, messages.append)
+        # 先頭の "Action Executed" と末尾の "State Updated" を除いた行が理由
+        step = {"action": action, "status": status, "reason": "\n".join(messages[1:-1])}
+        self.steps.append(step)
+        return step
+
+    def report(self):
+        """これまでの手順の結果を check_plan と同じ形で返す"""
+        steps = list(self.steps)
+        first_failure = next((index for index, step in enumerate(steps) if step["status"] != "ok"), None)
+        return {"feasible": first_failure is None, "first_failure": first_failure, "steps": steps}
+
+
+def main(argv=None) -> int:
+    """
+    <CurrentState> の書式ごとのトークン数を比較する。
+        python -m utils.esm --goal "Goal: {'target_location': 'ダイニングテーブル', 'items_needed': {'皿': 2}}"
+    """
+    parser = argparse.ArgumentParser(description="<CurrentState> の書式ごとのトークン数比較")
+    parser.add_argument("--goal", help="タスク目標（\"Goal: {...}\" 形式）")
+    parser.add_argument("--actions", type=Path, help="比較の前に実行する行動（1 行 1 ステップ）のファイル")
+    args = parser.parse_args(argv)
+
+    # ESM の実行ログは比較結果に混ぜない
+    esm = ExternalStateManager(verbose=False)
+    if args.goal:
+        esm.set_task_goal_from_llm(args.goal)
+    if args.actions:
+        lines = args.actions.read_text(encoding="utf-8").splitlines()
+        esm.apply_actions([line.strip() for line in lines if line.strip()])
+    json.dump(esm.compare_state_encodings(), sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
+import hashlib
 import json
 import os
+import threading
+import time
 from typing import Any, Dict, Optional
 
 import firebase_admin
@@ -7,13 +10,6 @@ from firebase_admin import credentials, firestore
 import streamlit as st
 
 
-def _initialize_firebase_app(cred: credentials.Base) -> None:
-    """Firebase Admin SDKを初期化する。既に初期化済みの場合は何もしない。"""
-
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(cred)
-
-
 def _get_credentials_from_streamlit() -> Optional[credentials.Certificate]:
     """Streamlit secretsからサービスアカウント資格情報を取得する。"""
 
@@ -85,31 +81,148 @@ def _get_default_credentials() -> credentials.Base:
         ) from exc
 
 
-def _get_db_from_secrets() -> firestore.Client:
-    """Streamlit secretsからGCPサービスアカウント情報を取得してFirestore接続"""
+DEFAULT_CLIENT_KEY = "default"
+HEALTH_CHECK_COLLECTION = "_health"
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_HEALTH_CHECK_TIMEOUT", "5"))
+# 捨てたクライアントを閉じるまでの猶予。使用中の呼び出しが終わるのを待つ
+RETIRED_CLIENT_GRACE_SECONDS = float(os.getenv("FIRESTORE_RETIRED_CLIENT_GRACE", "120"))
+
+# 資格情報の指定 -> Firestore クライアント。プロセスで 1 つずつ持ち、gRPC チャネルも使い回す
+_CLIENTS: Dict[str, firestore.Client] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _client_key(credentials_source: Optional[str]) -> str:
+    source = (credentials_source or "").strip()
+    if not source:
+        return DEFAULT_CLIENT_KEY
+    # インライン JSON をそのまま辞書のキーやアプリ名にしない
+    return "source-" + hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+def _get_app(key: str, credentials_source: Optional[str]) -> firebase_admin.App:
+    if key == DEFAULT_CLIENT_KEY:
+        # 既定のアプリは他のモジュールが初期化していることもあるので、あればそれを使う
+        try:
+            return firebase_admin.get_app()
+        except ValueError:
+            return firebase_admin.initialize_app(_get_default_credentials())
+    # 資格情報ごとに名前付きのアプリを作り、別の資格情報のアプリを取り違えないようにする
+    try:
+        return firebase_admin.get_app(key)
+    except ValueError:
+        return firebase_admin.initialize_app(_load_certificate_from_source(credentials_source), name=key)
+
+
+def _create_client(key: str, credentials_source: Optional[str]) -> firestore.Client:
+    app = _get_app(key, credentials_source)
+    # firestore.client(app) はアプリに付いた 1 つのクライアントを返し続けるので、作り直せるよう自前で作る。
+    # アプリは資格情報の入れ物として残し、削除しない（既定のアプリは他のモジュールのものかもしれない）
+    return firestore.Client(credentials=app.credential.get_credential(), project=app.project_id)
+
+
+def get_firestore_client(credentials_source: Optional[str] = None) -> firestore.Client:
+    """資格情報の指定ごとにキャッシュした Firestore クライアントを返す。
+
+    資格情報の解析とクライアントの生成は最初の 1 回だけで、以降の保存は RPC 1 回で済む。
+    """
+
+    key = _client_key(credentials_source)
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = _create_client(key, credentials_source)
+            _CLIENTS[key] = client
+            print(f"[Firestore] created client ({key})")
+        return client
+
+
+def _close_retired_client(key: str, client: firestore.Client) -> None:
+    try:
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+    except Exception as exc:
+        print(f"[Firestore] error closing retired client ({key}): {exc}")
 
-    cred = _get_default_credentials()
-    _initialize_firebase_app(cred)
-    return firestore.client()
 
+def _discard_client(key: str) -> None:
+    client = _CLIENTS.pop(key, None)
+    if client is None:
+        return
+    # 他のスレッドがまだ使っているかもしれないので、すぐには閉じず猶予を置いて閉じる
+    timer = threading.Timer(RETIRED_CLIENT_GRACE_SECONDS, _close_retired_client, args=(key, client))
+    timer.daemon = True
+    timer.start()
+    print(f"[Firestore] discarded client ({key})")
 
-def _get_db_from_credentials_source(credentials_source: str) -> firestore.Client:
-    """ファイルパスまたはJSON文字列で指定されたサービスアカウント情報からFirestoreへ接続"""
 
-    cred = _load_certificate_from_source(credentials_source)
-    _initialize_firebase_app(cred)
-    return firestore.client()
+def reset_firestore_clients(credentials_source: Optional[str] = None) -> None:
+    """キャッシュしたクライアントを捨てる（credentials_source を省略するとすべて）。
+
+    次回の取得で新しいクライアントと gRPC チャネルを作る。捨てたクライアントは
+    RETIRED_CLIENT_GRACE_SECONDS 後に閉じる（使用中の呼び出しはそのまま終われる）。
+    """
+
+    with _CLIENTS_LOCK:
+        keys = list(_CLIENTS) if credentials_source is None else [_client_key(credentials_source)]
+        for key in keys:
+            _discard_client(key)
+
+
+def check_firestore_health(
+    credentials_source: Optional[str] = None,
+    timeout: float = HEALTH_CHECK_TIMEOUT_SECONDS,
+) -> Dict[str, Any]:
+    """存在しないドキュメントを 1 回読み、接続できるかを確かめる（起動時の接続の温め直しも兼ねる）。
+
+    失敗したときはそのクライアントを捨て、次回の取得で作り直す。
+    """
+
+    started = time.monotonic()
+    try:
+        client = get_firestore_client(credentials_source)
+        client.collection(HEALTH_CHECK_COLLECTION).document("ping").get(timeout=timeout)
+    except Exception as exc:
+        reset_firestore_clients(credentials_source or "")
+        print(f"[Firestore] health check failed ({_client_key(credentials_source)}): {exc}")
+        return {"ok": False, "latency_s": round(time.monotonic() - started, 4), "error": str(exc)}
+    return {"ok": True, "latency_s": round(time.monotonic() - started, 4), "error": None}
+
+
+def _get_db(credentials_source: Optional[str] = None) -> firestore.Client:
+    return get_firestore_client(credentials_source)
 
 
 def save_document(
     collection: str,
     data: Dict[str, Any],
     credentials_source: Optional[str] = None,
+    document_id: Optional[str] = None,
+) -> str:
+    """Firestoreコレクションにドキュメントを保存し、ドキュメントIDを返す
+
+    document_id を指定すると、そのIDで保存する（後から update_document で追記できる）。
+    """
+
+    db = _get_db(credentials_source)
+    if document_id:
+        db.collection(collection).document(document_id).set(data)
+        return document_id
+    _, doc_ref = db.collection(collection).add(data)
+    return doc_ref.id
+
+
+def update_document(
+    collection: str,
+    document_id: str,
+    data: Dict[str, Any],
+    credentials_source: Optional[str] = None,
 ) -> None:
-    """Firestoreコレクションにドキュメントを保存"""
+    """既存ドキュメントの指定フィールドだけを更新する"""
 
-    if credentials_source:
-        db = _get_db_from_credentials_source(credentials_source)
-    else:
-        db = _get_db_from_secrets()
-    db.collection(collection).add(data)
+    db = _get_db(credentials_source)
+    db.collection(collection).document(document_id).update(data)
@@ -0,0 +1,443 @@
+"""Firestore への書き込みを裏のスレッドでまとめて行う（write-behind）。
+
+保存処理（実験結果・同意記録・採点結果の追記など）は Streamlit のスクリプトスレッドから
+submit するだけにし、Firestore との通信は専用スレッドが WriteBatch でまとめて行う。
+
+- キューは上限付き。空くまで少し待っても溢れたままなら、その書き込みは FirestoreQueueFullError で断る
+  （呼び出し元で直接書き込むと、キューに残っている同じドキュメントへの書き込みと順序が入れ替わるため）
+- 一時的なエラー（UNAVAILABLE・DEADLINE_EXCEEDED など）は指数バックオフ＋ジッターで再試行する。
+  RETRY_GIVE_UP_SECONDS を過ぎても成功しなければ諦めて dead letter ファイルに移す
+- 恒久的なエラーのバッチは 1 件ずつ書き込み直し、それでも失敗する書き込みは dead letter ファイルに移す
+- submit した書き込みはまずローカルのスプールファイル（JSONL）に追記し、
+  書き込み完了を記録するまで残す。プロセスが落ちても次回起動時に書き直す。
+  スプールは完了済みの記録が溜まったら未完了の書き込みだけに詰め直す
+- プロセス終了時（atexit）にキューを書き切る
+
+ドキュメント ID は submit の時点で決める（Firestore の自動 ID と同じ 20 文字）ので、
+保存直後に ID を使う処理（採点結果の追記など）もそのまま動く。
+同じ ID への set と update は submit した順に書き込まれる。
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import queue
+import random
+import secrets
+import string
+import threading
+import time
+import uuid
+from copy import deepcopy
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+from utils.firebase_utils import check_firestore_health, get_firestore_client
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SPOOL_PATH = Path(os.getenv("FIRESTORE_SPOOL_PATH", str(REPO_ROOT / ".cache" / "firestore_spool.jsonl")))
+WRITE_BEHIND_ENABLED = os.getenv("FIRESTORE_WRITE_BEHIND", "1") == "1"
+QUEUE_MAX_SIZE = int(os.getenv("FIRESTORE_QUEUE_MAX_SIZE", "1000"))
+# キューが空くまで待つ上限。超えたら書き込みを断る
+ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_ENQUEUE_TIMEOUT", "5"))
+# 1 回のコミットにまとめる件数（Firestore の WriteBatch の上限は 500）
+BATCH_MAX_SIZE = int(os.getenv("FIRESTORE_BATCH_MAX_SIZE", "100"))
+# 最初の 1 件を受け取ってから、同じバッチに入れる書き込みを待つ時間
+BATCH_LINGER_SECONDS = float(os.getenv("FIRESTORE_BATCH_LINGER", "0.05"))
+# 待ち時間を倍にしていく回数。この回数続けて失敗するたびに接続を確かめる
+RETRY_MAX_ATTEMPTS = int(os.getenv("FIRESTORE_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("FIRESTORE_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("FIRESTORE_RETRY_MAX_DELAY", "30"))
+# 一時的なエラーの再試行を諦めるまでの時間（1 件の書き込みが後続と flush() を止め続けないように）
+RETRY_GIVE_UP_SECONDS = float(os.getenv("FIRESTORE_RETRY_GIVE_UP", "300"))
+# スプールの行数が未完了の書き込みの件数よりこれだけ多くなったら詰め直す
+SPOOL_COMPACT_THRESHOLD = int(os.getenv("FIRESTORE_SPOOL_COMPACT_THRESHOLD", "1000"))
+SHUTDOWN_FLUSH_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_SHUTDOWN_FLUSH_TIMEOUT", "10"))
+
+SET = "set"
+UPDATE = "update"
+
+# 再試行する一時的なエラー。それ以外（不正な引数・権限が無いなど）は再試行しない
+TRANSIENT_ERRORS: tuple[type[BaseException], ...] = (ConnectionError, TimeoutError)
+try:
+    from google.api_core import exceptions as google_exceptions
+
+    TRANSIENT_ERRORS += (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.Aborted,
+        google_exceptions.InternalServerError,
+        google_exceptions.TooManyRequests,
+        google_exceptions.GatewayTimeout,
+    )
+except ImportError:
+    pass
+
+_AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+# インライン JSON の資格情報はスプールに書かず、復旧時に環境変数から読み直す
+_INLINE_CREDENTIALS = "inline"
+
+
+class FirestoreQueueFullError(RuntimeError):
+    """書き込みキューが溢れていて、書き込みを受け付けられなかった"""
+
+
+def new_document_id() -> str:
+    """Firestore の自動 ID と同じ形式（英数字 20 文字）の ID"""
+
+    return "".join(secrets.choice(_AUTO_ID_ALPHABET) for _ in range(20))
+
+
+@dataclass
+class WriteOp:
+    kind: str                         # SET / UPDATE
+    collection: str
+    document_id: str
+    data: dict[str, Any]
+    credentials_source: Optional[str] = None
+    op_id: str = ""
+
+    def commit(self, db) -> None:
+        ref = db.collection(self.collection).document(self.document_id)
+        if self.kind == UPDATE:
+            ref.update(self.data)
+        else:
+            ref.set(self.data)
+
+    def add_to(self, batch, db) -> None:
+        ref = db.collection(self.collection).document(self.document_id)
+        if self.kind == UPDATE:
+            batch.update(ref, self.data)
+        else:
+            batch.set(ref, self.data)
+
+
+def _spooled_credentials(source: Optional[str]) -> Optional[str]:
+    if source and source.lstrip().startswith("{"):
+        return _INLINE_CREDENTIALS
+    return source
+
+
+def _recovered_credentials(source: Optional[str]) -> Optional[str]:
+    if source == _INLINE_CREDENTIALS:
+        return os.getenv("FIREBASE_CREDENTIALS") or os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or None
+    return source
+
+
+def _is_transient(exc: Exception) -> bool:
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+def _backoff_delay(attempt: int) -> float:
+    delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    return random.uniform(0, delay)
+
+
+class FirestoreWriter:
+    """プロセスで 1 つの、Firestore への書き込みスレッド。"""
+
+    def __init__(
+        self,
+        spool_path: Path = SPOOL_PATH,
+        *,
+        dead_letter_path: Optional[Path] = None,
+        max_queue_size: int = QUEUE_MAX_SIZE,
+        batch_max_size: int = BATCH_MAX_SIZE,
+    ) -> None:
+        self.spool_path = Path(spool_path)
+        self.dead_letter_path = Path(dead_letter_path) if dead_letter_path else self.spool_path.with_name(
+            self.spool_path.stem + "_dead_letter.jsonl"
+        )
+        self.batch_max_size = max(1, min(batch_max_size, 500))
+        self._queue: "queue.Queue[WriteOp]" = queue.Queue(maxsize=max_queue_size)
+        self._spool_lock = threading.Lock()
+        # 未完了の書き込みの op_id → スプールの put 記録（詰め直しに使う）
+        self._unacked: dict[str, dict[str, Any]] = {}
+        self._spool_lines = 0
+        self._checked_sources: set[Optional[str]] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    # ---- 呼び出し側（スクリプトスレッド） ----
+
+    def submit(self, op: WriteOp) -> str:
+        """書き込みをスプールに記録してキューに積み、ドキュメント ID を返す。"""
+
+        self._ensure_started()
+        op.op_id = op.op_id or uuid.uuid4().hex
+        # 書き込みまでに呼び出し元が辞書を書き換えても影響しないようにする
+        op.data = deepcopy(op.data)
+        self._spool_put(op)
+        try:
+            self._queue.put(op, timeout=ENQUEUE_TIMEOUT_SECONDS)
+        except queue.Full:
+            # 書き込まないのでスプールからも外す（次回起動時に書き直さない）
+            self._spool_ack([op])
+            raise FirestoreQueueFullError(
+                f"書き込みキューが一杯のため {op.collection}/{op.document_id} を保存できませんでした"
+            ) from None
+        return op.document_id
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """キューに積んだ書き込みが終わるまで待つ。timeout 内に終われば True"""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            recovered = self._recover_spool()
+            self._thread = threading.Thread(target=self._run, name="firestore-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self._flush_at_exit)
+        for op in recovered:
+            self._queue.put(op)
+        if recovered:
+            print(f"[FirestoreWriter] resubmitted {len(recovered)} spooled write(s)")
+
+    def _flush_at_exit(self) -> None:
+        if self.pending() and not self.flush(SHUTDOWN_FLUSH_TIMEOUT_SECONDS):
+            print(f"[FirestoreWriter] {self.pending()} write(s) left in {self.spool_path}")
+
+    # ---- スプール ----
+
+    def _append_spool(self, records: list[dict[str, Any]], *, sync: bool, path: Optional[Path] = None) -> None:
+        path = path or self.spool_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _spool_put(self, op: WriteOp) -> None:
+        record = {"spool": "put", **asdict(op)}
+        record["credentials_source"] = _spooled_credentials(op.credentials_source)
+        with self._spool_lock:
+            self._append_spool([record], sync=True)
+            self._spool_lines += 1
+            self._unacked[op.op_id] = record
+
+    def _spool_ack(self, ops: list[WriteOp]) -> None:
+        with self._spool_lock:
+            for op in ops:
+                self._unacked.pop(op.op_id, None)
+            if not self._unacked:
+                # 未完了の書き込みが無ければスプールは空にしてよい
+                self.spool_path.unlink(missing_ok=True)
+                self._spool_lines = 0
+                return
+            if self._spool_lines - len(self._unacked) >= SPOOL_COMPACT_THRESHOLD:
+                # 書き込みが途切れないとスプールが空にならないので、未完了の書き込みだけに詰め直す
+                self._rewrite_spool(list(self._unacked.values()))
+                return
+            self._append_spool([{"spool": "ack", "op_id": op.op_id} for op in ops], sync=False)
+            self._spool_lines += len(ops)
+
+    def _rewrite_spool(self, records: list[dict[str, Any]]) -> None:
+        """スプールを records だけに置き換える（_spool_lock を持って呼ぶ）"""
+
+        temp_path = self.spool_path.with_suffix(".tmp")
+        temp_path.unlink(missing_ok=True)
+        self._append_spool(records, sync=True, path=temp_path)
+        os.replace(temp_path, self.spool_path)
+        self._spool_lines = len(records)
+
+    def _recover_spool(self) -> list[WriteOp]:
+        """前回のプロセスで完了しなかった書き込みを読み出し、スプールをそれだけに詰め直す"""
+
+        if not self.spool_path.exists():
+            return []
+        puts: dict[str, dict[str, Any]] = {}
+        with self.spool_path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で落ちた行
+                if record.get("spool") == "put":
+                    puts[record["op_id"]] = record
+                elif record.get("spool") == "ack":
+                    puts.pop(record.get("op_id"), None)
+
+        ops = []
+        for record in puts.values():
+            op = WriteOp(**{key: value for key, value in record.items() if key != "spool"})
+            op.credentials_source = _recovered_credentials(op.credentials_source)
+            ops.append(op)
+        with self._spool_lock:
+            self._rewrite_spool(list(puts.values()))
+            self._unacked.update(puts)
+        return ops
+
+    # ---- 書き込みスレッド ----
+
+    def _next_batch(self) -> list[WriteOp]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + BATCH_LINGER_SECONDS
+        while len(batch) < self.batch_max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                # 資格情報（接続先）ごとに、submit した順のままコミットする
+                groups: dict[Optional[str], list[WriteOp]] = {}
+                for op in batch:
+                    groups.setdefault(op.credentials_source, []).append(op)
+                for credentials_source, ops in groups.items():
+                    self._commit_group(credentials_source, ops)
+            except Exception as exc:
+                print(f"[FirestoreWriter] unexpected error: {exc}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _commit_group(self, credentials_source: Optional[str], ops: list[WriteOp]) -> None:
+        if credentials_source not in self._checked_sources:
+            # 接続先ごとに最初の 1 回だけ、接続を確かめてクライアントを温めておく
+            self._checked_sources.add(credentials_source)
+            check_firestore_health(credentials_source)
+
+        def commit_batch() -> None:
+            db = get_firestore_client(credentials_source)
+            batch = db.batch()
+            for op in ops:
+                op.add_to(batch, db)
+            batch.commit()
+
+        error = self._with_retry(commit_batch, f"batch of {len(ops)}", credentials_source)
+        if error is None:
+            self._spool_ack(ops)
+            print(f"[FirestoreWriter] committed {len(ops)} write(s)")
+            return
+        if _is_transient(error):
+            # 再試行を諦めた。1 件ずつ試しても同じだけ待つことになるので、まとめて移す
+            for op in ops:
+                self._dead_letter(op, error)
+            return
+
+        # 恒久的なエラー。1 件の不正な書き込みでバッチ全体が失敗している場合に備え、1 件ずつ書き込む
+        print(f"[FirestoreWriter] batch of {len(ops)} rejected: {error}; writing one by one")
+        gave_up: Optional[Exception] = None  # 途中で再試行を諦めたら、残りは試さずに移す
+        for op in ops:
+            error = gave_up or self._with_retry(
+                lambda: op.commit(get_firestore_client(credentials_source)),
+                f"{op.collection}/{op.document_id}",
+                credentials_source,
+            )
+            if error is None:
+                self._spool_ack([op])
+                continue
+            if _is_transient(error):
+                gave_up = error
+            self._dead_letter(op, error)
+
+    def _with_retry(self, commit, label: str, credentials_source: Optional[str]) -> Optional[Exception]:
+        """commit を実行する。成功すれば None、恒久的なエラーか再試行を諦めた一時的なエラーならそれを返す。
+
+        一時的な障害の間は後続の書き込みも待たせる（同じドキュメントへの set と update の順序を保つため）。
+        その間に終了した場合、未完了の書き込みはスプールに残り、次回起動時に書き直される。
+        RETRY_MAX_ATTEMPTS 回続けて失敗するたびに接続を確かめ、駄目ならクライアントを作り直してから再開する。
+        RETRY_GIVE_UP_SECONDS を過ぎたら再試行をやめる。
+        """
+
+        attempt = 0
+        give_up_at = time.monotonic() + RETRY_GIVE_UP_SECONDS
+        while True:
+            try:
+                commit()
+                return None
+            except Exception as exc:
+                if not _is_transient(exc):
+                    return exc
+                if time.monotonic() >= give_up_at:
+                    print(f"[FirestoreWriter] {label} still failing after {RETRY_GIVE_UP_SECONDS:.0f}s: {exc}; giving up")
+                    return exc
+                delay = _backoff_delay(min(attempt, RETRY_MAX_ATTEMPTS))
+                delay = max(0.0, min(delay, give_up_at - time.monotonic()))
+                attempt += 1
+                print(f"[FirestoreWriter] {label} failed (attempt {attempt}): {exc}; retrying in {delay:.2f}s")
+                time.sleep(delay)
+                if attempt % RETRY_MAX_ATTEMPTS == 0:
+                    check_firestore_health(credentials_source)
+
+    def _dead_letter(self, op: WriteOp, error: Exception) -> None:
+        """恒久的に失敗した書き込みを dead letter ファイルに移し、スプールからは外す"""
+
+        record = asdict(op)
+        record["credentials_source"] = _spooled_credentials(op.credentials_source)
+        record["error"] = f"{type(error).__name__}: {error}"
+        record["failed_at"] = time.time()
+        with self._spool_lock:
+            self._append_spool([record], sync=True, path=self.dead_letter_path)
+        self._spool_ack([op])
+        print(
+            f"[FirestoreWriter] ERROR writing {op.collection}/{op.document_id}: {error} "
+            f"(moved to {self.dead_letter_path})"
+        )
+
+
+_WRITER: Optional[FirestoreWriter] = None
+_WRITER_LOCK = threading.Lock()
+
+
+def get_firestore_writer() -> FirestoreWriter:
+    """プロセス共有の書き込みスレッドを返す。"""
+
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = FirestoreWriter()
+        return _WRITER
+
+
+def submit_set(
+    collection: str,
+    data: dict[str, Any],
+    credentials_source: Optional[str] = None,
+    document_id: Optional[str] = None,
+) -> str:
+    """ドキュメントの保存を依頼し、ドキュメント ID を返す（save_document の write-behind 版）"""
+
+    document_id = document_id or new_document_id()
+    if not WRITE_BEHIND_ENABLED:
+        WriteOp(SET, collection, document_id, data, credentials_source).commit(get_firestore_client(credentials_source))
+        return document_id
+    return get_firestore_writer().submit(WriteOp(SET, collection, document_id, data, credentials_source))
+
+
+def submit_update(
+    collection: str,
+    document_id: str,
+    data: dict[str, Any],
+    credentials_source: Optional[str] = None,
+) -> None:
+    """既存ドキュメントの更新を依頼する（update_document の write-behind 版）"""
+
+    op = WriteOp(UPDATE, collection, document_id, data, credentials_source)
+    if not WRITE_BEHIND_ENABLED:
+        op.commit(get_firestore_client(credentials_source))
+        return
+    get_firestore_writer().submit(op)
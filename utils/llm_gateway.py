@@ -0,0 +1,555 @@
+"""全セッションで共有する LLM ゲートウェイ。
+
+Streamlit の各スクリプトスレッドから同期的に呼び出せるように、専用スレッドで
+イベントループを回し、そこで 1 つの ``AsyncOpenAI`` クライアントを共有する。
+
+- モデル名・タイムアウト・接続数はこのモジュールだけで設定する
+- プロセス全体の同時リクエスト数をセマフォで制限する（超過分は待機）
+- 同一パラメータで実行中のリクエストは 1 本にまとめる（coalescing）
+- 429 / 5xx / 接続エラーは指数バックオフ＋ジッターで再試行し、Retry-After を尊重する
+- 任意で、p95 レイテンシを超えたリクエストに 2 本目を投げて早い方を採用する（hedging）
+- temperature=0 などの決定的な呼び出しは応答キャッシュ（utils/llm_cache.py）から返す
+- 同期 API の呼び出しごとにトークン数と所要時間を記録する（utils/llm_metrics.py）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from typing import Any, Iterator, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.chat import ChatCompletion
+
+from utils.llm_cache import CACHE_DISABLED, get_response_cache
+from utils.llm_metrics import build_call_record, record_llm_call, session_metrics_sink
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "60"))
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "16"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", "16"))
+# 同時実行枠が空くまで待つ上限。超えたら混雑としてエラーにする（backpressure）
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("OPENAI_QUEUE_TIMEOUT", "30"))
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("OPENAI_RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "20"))
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+
+HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = 0.95
+# p95 を信頼できるだけのサンプルが集まるまでは hedging しない
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# OpenAI API に渡してよいメッセージのキー（timestamp や full_reply などは送らない）
+_MESSAGE_KEYS = ("role", "content", "name", "tool_calls", "tool_call_id")
+_STREAM_END = object()
+
+
+class LLMGatewayError(RuntimeError):
+    """ゲートウェイ経由の LLM 呼び出しに失敗したときの例外。"""
+
+
+def _get_streamlit_secret():
+    try:
+        import streamlit as st
+        return st.secrets.get("OPENAI_API_KEY")
+    except Exception:
+        return None
+
+
+def _get_api_key() -> str:
+    api_key = os.getenv("OPENAI_API_KEY") or _get_streamlit_secret()
+    if not api_key:
+        raise RuntimeError(
+            "OPENAI_API_KEY が見つかりません。\n"
+            "・通常実行なら .env に OPENAI_API_KEY=... を書く\n"
+            "・Streamlit 実行なら .streamlit/secrets.toml に OPENAI_API_KEY=\"...\" を書く"
+        )
+    return api_key
+
+
+def _sanitize_messages(messages: list[dict]) -> list[dict]:
+    return [
+        {key: message[key] for key in _MESSAGE_KEYS if key in message}
+        for message in messages
+    ]
+
+
+def _request_key(params: dict[str, Any]) -> str:
+    payload = json.dumps(params, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _should_cache(request: dict[str, Any], cache: Optional[bool]) -> bool:
+    """cache=None のときは temperature=0 の決定的な呼び出しだけをキャッシュする。"""
+
+    if CACHE_DISABLED:
+        return False
+    if cache is not None:
+        return cache
+    return request.get("temperature") == 0
+
+
+def _store_in_cache(key: str, future: Future) -> None:
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        get_response_cache().set(key, future.result().model_dump_json())
+    except Exception as exc:
+        print(f"[LLMGateway] failed to write response cache: {exc}")
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, openai.APIConnectionError):  # APITimeoutError を含む
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS_CODES or exc.status_code >= 500
+    return False
+
+
+def _retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """レスポンスヘッダの Retry-After（秒数または HTTP 日付）を秒で返す。"""
+
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _backoff_delay(attempt: int, exc: BaseException) -> float:
+    retry_after = _retry_after_seconds(exc)
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY_SECONDS * 3)
+    # full jitter: 0〜base*2^attempt の一様乱数
+    ceiling = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+class LLMGateway:
+    """AsyncOpenAI クライアントとイベントループをプロセス内で共有するゲートウェイ。"""
+
+    def __init__(
+        self,
+        *,
+        model: str = DEFAULT_MODEL,
+        request_timeout: float = REQUEST_TIMEOUT_SECONDS,
+        connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+        queue_timeout: float = QUEUE_TIMEOUT_SECONDS,
+        retry_max_attempts: int = RETRY_MAX_ATTEMPTS,
+        hedge: bool = HEDGE_ENABLED,
+    ) -> None:
+        self.model = model
+        self.request_timeout = request_timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_concurrent_requests = max_concurrent_requests
+        self.queue_timeout = queue_timeout
+        self.retry_max_attempts = max(1, retry_max_attempts)
+        self.hedge = hedge
+
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[AsyncOpenAI] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    # ------------------------------------------------------------------
+    # 起動
+    # ------------------------------------------------------------------
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is not None:
+                return self._loop
+
+            api_key = _get_api_key()
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever,
+                name="llm-gateway-loop",
+                daemon=True,
+            )
+            thread.start()
+
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                ),
+                timeout=httpx.Timeout(self.request_timeout, connect=self.connect_timeout),
+            )
+            self._client = AsyncOpenAI(
+                api_key=api_key,
+                http_client=http_client,
+                timeout=self.request_timeout,
+                max_retries=0,  # 再試行はこのゲートウェイで行う
+            )
+
+            async def _make_semaphore() -> asyncio.Semaphore:
+                return asyncio.Semaphore(self.max_concurrent_requests)
+
+            self._semaphore = asyncio.run_coroutine_threadsafe(_make_semaphore(), loop).result()
+            self._loop = loop
+            return loop
+
+    def _build_params(self, messages: list[dict], model: Optional[str], params: dict) -> dict:
+        request = dict(params)
+        request["model"] = model or self.model
+        request["messages"] = _sanitize_messages(messages)
+        return request
+
+    # ------------------------------------------------------------------
+    # イベントループ上で動くコルーチン
+    # ------------------------------------------------------------------
+    async def _acquire_slot(self) -> None:
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError as exc:
+            raise LLMGatewayError(
+                "LLM リクエストが混雑しています。しばらくしてから再度お試しください。"
+            ) from exc
+
+    def hedge_threshold(self) -> Optional[float]:
+        """直近の成功レイテンシの p95（秒）。サンプル不足なら None。"""
+
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))
+        return ordered[index]
+
+    async def _create(self, request: dict):
+        await self._acquire_slot()
+        try:
+            started = time.monotonic()
+            response = await self._client.chat.completions.create(**request)
+            self._latencies.append(time.monotonic() - started)
+            return response
+        finally:
+            self._semaphore.release()
+
+    async def _create_hedged(self, request: dict, hedge: bool):
+        threshold = self.hedge_threshold() if hedge else None
+        if threshold is None:
+            return await self._create(request)
+
+        primary = asyncio.ensure_future(self._create(request))
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done:
+            return primary.result()
+
+        # p95 を超えたので 2 本目を投げ、先に成功した方を採用する
+        secondary = asyncio.ensure_future(self._create(request))
+        pending = {primary, secondary}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _create_with_retry(self, request: dict, hedge: bool):
+        for attempt in range(self.retry_max_attempts):
+            try:
+                return await self._create_hedged(request, hedge)
+            except openai.OpenAIError as exc:
+                if not _is_retryable(exc) or attempt + 1 >= self.retry_max_attempts:
+                    raise LLMGatewayError(f"LLM の呼び出しに失敗しました: {exc}") from exc
+                delay = _backoff_delay(attempt, exc)
+                print(
+                    f"[LLMGateway] retry {attempt + 1}/{self.retry_max_attempts - 1} "
+                    f"in {delay:.1f}s: {exc.__class__.__name__}"
+                )
+                await asyncio.sleep(delay)
+
+    async def _coalesced_create(self, request: dict, hedge: bool):
+        key = _request_key(request)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create_with_retry(request, hedge))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        # 先行リクエストの待機者がキャンセルされても本体は止めない
+        return await asyncio.shield(task)
+
+    async def _pump_stream(self, request: dict, sink: "queue.Queue[Any]") -> None:
+        try:
+            for attempt in range(self.retry_max_attempts):
+                delivered = False
+                await self._acquire_slot()
+                stream = None
+                try:
+                    stream = await self._client.chat.completions.create(stream=True, **request)
+                    async for chunk in stream:
+                        delivered = True
+                        sink.put(chunk)
+                    return
+                except openai.OpenAIError as exc:
+                    # 一部でも表示済みなら途中から再送はできないので再試行しない
+                    if delivered or not _is_retryable(exc) or attempt + 1 >= self.retry_max_attempts:
+                        raise LLMGatewayError(f"LLM の呼び出しに失敗しました: {exc}") from exc
+                    delay = _backoff_delay(attempt, exc)
+                finally:
+                    # 読み手がいなくなって取り消された場合も、HTTP 接続と同時実行枠をすぐに返す
+                    if stream is not None:
+                        await stream.close()
+                    self._semaphore.release()
+                await asyncio.sleep(delay)
+        except BaseException as exc:  # 呼び出し元スレッドで再送出する
+            sink.put(exc)
+        finally:
+            sink.put(_STREAM_END)
+
+    # ------------------------------------------------------------------
+    # 同期 API（Streamlit スクリプトスレッドから呼ぶ）
+    # ------------------------------------------------------------------
+    def submit_chat_completion(
+        self,
+        messages: list[dict],
+        *,
+        model: Optional[str] = None,
+        hedge: Optional[bool] = None,
+        cache: Optional[bool] = None,
+        page: Optional[str] = None,
+        **params: Any,
+    ) -> Future:
+        """チャット補完を非同期に投入し、concurrent.futures.Future を返す。
+
+        hedge を省略するとゲートウェイの既定（OPENAI_HEDGE_REQUESTS）に従う。
+        cache を省略すると temperature=0 の呼び出しだけ応答キャッシュを使う。
+        呼び出し側で cache=False を渡せばキャッシュを使わない。
+        成功した呼び出しの記録は呼び出し側で行う。失敗は page を付けてここで記録する。
+        """
+
+        request = self._build_params(messages, model, params)
+        started = time.monotonic()
+        # 完了はイベントループのスレッドなので、セッションのメトリクスは投入時に取っておく
+        sink = session_metrics_sink()
+        future, _ = self._submit(request, hedge, cache)
+
+        def _record_failure(done: Future) -> None:
+            if done.cancelled() or done.exception() is None:
+                return
+            record_llm_call(build_call_record(
+                model=request["model"], usage=None, wall_time_s=time.monotonic() - started,
+                page=page, error=str(done.exception()),
+            ), sink=sink)
+
+        future.add_done_callback(_record_failure)
+        return future
+
+    def _submit(self, request: dict, hedge: Optional[bool], cache: Optional[bool]) -> tuple[Future, bool]:
+        """(Future, 応答キャッシュから返したか) を返す。"""
+
+        cache_key = _request_key(request) if _should_cache(request, cache) else None
+        if cache_key:
+            try:
+                cached = get_response_cache().get(cache_key)
+            except Exception as exc:
+                print(f"[LLMGateway] failed to read response cache: {exc}")
+                cached = None
+            if cached is not None:
+                future: Future = Future()
+                future.set_result(ChatCompletion.model_validate_json(cached))
+                return future, True
+
+        loop = self._ensure_started()
+        use_hedge = self.hedge if hedge is None else hedge
+        future = asyncio.run_coroutine_threadsafe(
+            self._coalesced_create(request, use_hedge), loop
+        )
+        if cache_key:
+            future.add_done_callback(lambda f, k=cache_key: _store_in_cache(k, f))
+        return future, False
+
+    def chat_completion(
+        self,
+        messages: list[dict],
+        *,
+        model: Optional[str] = None,
+        hedge: Optional[bool] = None,
+        cache: Optional[bool] = None,
+        page: Optional[str] = None,
+        **params: Any,
+    ):
+        """チャット補完をブロッキングで実行し、ChatCompletion を返す。
+
+        再試行しても失敗した場合は LLMGatewayError を送出する。
+        トークン数と所要時間は utils/llm_metrics.py に記録する（page 省略時は prompt_group）。
+        """
+
+        request = self._build_params(messages, model, params)
+        started = time.monotonic()
+        future, cache_hit = self._submit(request, hedge, cache)
+        try:
+            response = future.result()
+        except LLMGatewayError as exc:
+            record_llm_call(build_call_record(
+                model=request["model"], usage=None, wall_time_s=time.monotonic() - started,
+                page=page, error=str(exc),
+            ))
+            raise
+        record_llm_call(build_call_record(
+            model=getattr(response, "model", None) or request["model"],
+            usage=getattr(response, "usage", None),
+            wall_time_s=time.monotonic() - started,
+            page=page,
+            cache_hit=cache_hit,
+        ))
+        return response
+
+    def stream_chat_completion(
+        self,
+        messages: list[dict],
+        *,
+        model: Optional[str] = None,
+        page: Optional[str] = None,
+        **params: Any,
+    ) -> Iterator[Any]:
+        """ストリーミングでチャット補完を実行し、チャンクを順に返すイテレータ。
+
+        最初のチャンクを受け取る前の失敗だけを再試行する（hedging は行わない）。
+        usage を記録するため、既定で stream_options={"include_usage": True} を付ける。
+        """
+
+        params.setdefault("stream_options", {"include_usage": True})
+        loop = self._ensure_started()
+        request = self._build_params(messages, model, params)
+        sink: "queue.Queue[Any]" = queue.Queue()
+        started = time.monotonic()
+        first_token_at: Optional[float] = None
+        usage = None
+        response_model = request["model"]
+        error: Optional[str] = None
+        pump = asyncio.run_coroutine_threadsafe(self._pump_stream(request, sink), loop)
+        try:
+            while True:
+                item = sink.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, BaseException):
+                    error = str(item)
+                    if isinstance(item, LLMGatewayError):
+                        raise item
+                    # 呼び出し側は LLMGatewayError だけを扱えばよいようにする
+                    raise LLMGatewayError(f"LLM の呼び出しに失敗しました: {item}") from item
+                if first_token_at is None and getattr(item, "choices", None):
+                    first_token_at = time.monotonic()
+                usage = getattr(item, "usage", None) or usage
+                response_model = getattr(item, "model", None) or response_model
+                yield item
+        finally:
+            # 途中で読むのをやめた（再実行・例外など）場合は受信を打ち切る
+            pump.cancel()
+            record_llm_call(build_call_record(
+                model=response_model,
+                usage=usage,
+                wall_time_s=time.monotonic() - started,
+                page=page,
+                streamed=True,
+                time_to_first_token_s=None if first_token_at is None else first_token_at - started,
+                error=error,
+            ))
+
+
+_GATEWAY: Optional[LLMGateway] = None
+_GATEWAY_LOCK = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """プロセス共有のゲートウェイを返す。"""
+
+    global _GATEWAY
+    with _GATEWAY_LOCK:
+        if _GATEWAY is None:
+            _GATEWAY = LLMGateway()
+        return _GATEWAY
+
+
+def chat_completion(
+    messages: list[dict],
+    *,
+    model: Optional[str] = None,
+    hedge: Optional[bool] = None,
+    cache: Optional[bool] = None,
+    page: Optional[str] = None,
+    **params: Any,
+):
+    return get_gateway().chat_completion(
+        messages, model=model, hedge=hedge, cache=cache, page=page, **params
+    )
+
+
+def submit_chat_completion(
+    messages: list[dict],
+    *,
+    model: Optional[str] = None,
+    hedge: Optional[bool] = None,
+    cache: Optional[bool] = None,
+    page: Optional[str] = None,
+    **params: Any,
+) -> Future:
+    return get_gateway().submit_chat_completion(
+        messages, model=model, hedge=hedge, cache=cache, page=page, **params
+    )
+
+
+def stream_chat_completion(
+    messages: list[dict],
+    *,
+    model: Optional[str] = None,
+    page: Optional[str] = None,
+    **params: Any,
+) -> Iterator[Any]:
+    return get_gateway().stream_chat_completion(messages, model=model, page=page, **params)
@@ -0,0 +1,248 @@
+"""LLM 呼び出しごとのトークン数・レイテンシの記録と集計。
+
+ゲートウェイ（utils/llm_gateway.py）が呼び出し 1 回ごとに
+モデル・prompt/completion/cached トークン・所要時間・ページ（PROMPT_GROUP）を記録する。
+Streamlit のスクリプトスレッドから呼ばれた場合は st.session_state["llm_call_metrics"] にも積み、
+実験結果と一緒に保存する。保存済み JSONL からは条件別のレイテンシ／コストを集計できる。
+
+    python -m utils.llm_metrics archive/json/experiment_2_results.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from utils.prompt_builder import prompt_cache_usage
+
+SESSION_METRICS_KEY = "llm_call_metrics"
+RECENT_CALLS_LIMIT = 1000
+
+# 100 万トークンあたりの USD（入力 / キャッシュ済み入力 / 出力）
+MODEL_PRICES_PER_MILLION: dict[str, tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+
+_RECENT_CALLS: "deque[dict[str, Any]]" = deque(maxlen=RECENT_CALLS_LIMIT)
+_RECENT_LOCK = threading.Lock()
+
+
+def _script_session_state():
+    """Streamlit のスクリプトスレッド内なら session_state を、それ以外は None を返す。"""
+
+    try:
+        import streamlit as st
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except Exception:
+        return None
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state
+
+
+def build_call_record(
+    *,
+    model: str,
+    usage: Any,
+    wall_time_s: float,
+    page: Optional[str] = None,
+    streamed: bool = False,
+    cache_hit: bool = False,
+    time_to_first_token_s: Optional[float] = None,
+    error: Optional[str] = None,
+) -> dict[str, Any]:
+    """呼び出し 1 回分の記録（JSON にそのまま保存できる dict）を作る。"""
+
+    tokens = prompt_cache_usage(usage) or {"prompt_tokens": 0, "cached_tokens": 0}
+    record: dict[str, Any] = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "page": page or "",
+        "model": model,
+        "prompt_tokens": tokens["prompt_tokens"],
+        "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+        "cached_tokens": tokens["cached_tokens"],
+        "wall_time_s": round(wall_time_s, 4),
+        "streamed": streamed,
+        "cache_hit": cache_hit,
+    }
+    if time_to_first_token_s is not None:
+        record["time_to_first_token_s"] = round(time_to_first_token_s, 4)
+    if error:
+        record["error"] = error
+    return record
+
+
+def session_metrics_sink() -> Optional[list[dict[str, Any]]]:
+    """スクリプトスレッドで呼ぶと、このセッションのメトリクスのリストを返す（それ以外は None）。
+
+    別スレッド（ゲートウェイのイベントループなど）で完了する呼び出しは session_state に
+    触れられないので、投入時にこれを取っておき record_llm_call(sink=...) に渡す。
+    """
+
+    session_state = _script_session_state()
+    if session_state is None:
+        return None
+    return session_state.setdefault(SESSION_METRICS_KEY, [])
+
+
+def record_llm_call(
+    record: dict[str, Any],
+    *,
+    sink: Optional[list[dict[str, Any]]] = None,
+) -> dict[str, Any]:
+    """記録をプロセス内の直近ログと（あれば）セッションのメトリクスに追加する。
+
+    page が空なら session_state["prompt_group"] を使う。
+    スクリプトスレッドの外では、sink（session_metrics_sink の戻り値）があればそこに追加する。
+    """
+
+    session_state = _script_session_state()
+    if session_state is not None:
+        if not record.get("page"):
+            record["page"] = session_state.get("prompt_group") or ""
+        session_state.setdefault(SESSION_METRICS_KEY, []).append(record)
+    elif sink is not None:
+        sink.append(record)
+    with _RECENT_LOCK:
+        _RECENT_CALLS.append(record)
+    return record
+
+
+def recent_calls() -> list[dict[str, Any]]:
+    """このプロセスで記録された直近の呼び出し（セッション外の呼び出しも含む）。"""
+
+    with _RECENT_LOCK:
+        return list(_RECENT_CALLS)
+
+
+def session_calls() -> list[dict[str, Any]]:
+    session_state = _script_session_state()
+    if session_state is None:
+        return []
+    return list(session_state.get(SESSION_METRICS_KEY) or [])
+
+
+def reset_session_metrics() -> None:
+    """セッションのメトリクスを空にする。
+
+    session_metrics_sink で取っておいたリストに、完了した呼び出しが後から追加されるので、
+    リストを差し替えずにその場で空にする（差し替えると、その記録はどこにも表示されなくなる）。
+    """
+
+    session_state = _script_session_state()
+    if session_state is not None:
+        session_state.setdefault(SESSION_METRICS_KEY, []).clear()
+
+
+def estimate_cost_usd(record: dict[str, Any]) -> Optional[float]:
+    """価格表にあるモデルなら 1 回分の概算コスト（USD）を返す。キャッシュ応答は 0。"""
+
+    if record.get("cache_hit"):
+        return 0.0
+    model = record.get("model") or ""
+    prices = MODEL_PRICES_PER_MILLION.get(model)
+    if prices is None:
+        # "gpt-4o-mini-2024-07-18" のような日付付きのモデル名は最長一致で引く
+        matches = [name for name in MODEL_PRICES_PER_MILLION if model.startswith(name)]
+        if not matches:
+            return None
+        prices = MODEL_PRICES_PER_MILLION[max(matches, key=len)]
+    input_price, cached_price, output_price = prices
+    cached = record.get("cached_tokens", 0)
+    uncached = max(0, record.get("prompt_tokens", 0) - cached)
+    completion = record.get("completion_tokens", 0)
+    return (uncached * input_price + cached * cached_price + completion * output_price) / 1_000_000
+
+
+def _percentile(values: list[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize_calls(records: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """呼び出し記録の合計・レイテンシ分位点・概算コストをまとめる。"""
+
+    records = list(records)
+    latencies = [r["wall_time_s"] for r in records if not r.get("cache_hit") and not r.get("error")]
+    first_token = [r["time_to_first_token_s"] for r in records if "time_to_first_token_s" in r]
+    costs = [estimate_cost_usd(r) for r in records]
+    known_costs = [c for c in costs if c is not None]
+    summary: dict[str, Any] = {
+        "calls": len(records),
+        "errors": sum(1 for r in records if r.get("error")),
+        "cache_hits": sum(1 for r in records if r.get("cache_hit")),
+        "prompt_tokens": sum(r.get("prompt_tokens", 0) for r in records),
+        "completion_tokens": sum(r.get("completion_tokens", 0) for r in records),
+        "cached_tokens": sum(r.get("cached_tokens", 0) for r in records),
+        "wall_time_total_s": round(sum(r.get("wall_time_s", 0.0) for r in records), 4),
+        "latency_p50_s": _percentile(latencies, 0.5),
+        "latency_p95_s": _percentile(latencies, 0.95),
+        "time_to_first_token_p50_s": _percentile(first_token, 0.5),
+        "estimated_cost_usd": round(sum(known_costs), 6) if known_costs else None,
+    }
+    if len(known_costs) < len(costs):
+        summary["unpriced_calls"] = len(costs) - len(known_costs)
+    return summary
+
+
+def session_metrics_payload() -> dict[str, Any]:
+    """実験結果に保存する形（8_llm_metrics）で現在のセッションのメトリクスを返す。"""
+
+    calls = session_calls()
+    return {"81_summary": summarize_calls(calls), "82_calls": calls}
+
+
+def build_condition_report(entries: Iterable[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """保存済みの実験結果から条件（page / PROMPT_GROUP）ごとの集計を作る。"""
+
+    by_condition: dict[str, list[dict[str, Any]]] = {}
+    for entry in entries:
+        metrics = entry.get("8_llm_metrics") or {}
+        for call in metrics.get("82_calls") or []:
+            condition = call.get("page") or entry.get("prompt_group") or "unknown"
+            by_condition.setdefault(condition, []).append(call)
+    return {condition: summarize_calls(calls) for condition, calls in sorted(by_condition.items())}
+
+
+def _load_jsonl(path: Path) -> list[dict[str, Any]]:
+    entries = []
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="条件別の LLM レイテンシ／コスト集計")
+    parser.add_argument("paths", nargs="+", type=Path, help="実験結果の JSONL ファイル")
+    args = parser.parse_args(argv)
+
+    entries: list[dict[str, Any]] = []
+    for path in args.paths:
+        entries.extend(_load_jsonl(path))
+    report = build_condition_report(entries)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""プロバイダ側のプロンプトキャッシュが効くようにメッセージを組み立てる。
+
+YAML のプロンプトは先頭に {current_state_xml} を持つため、そのまま埋め込むと
+<System> の先頭がターンごとに変わり、前方一致のキャッシュが一切ヒットしない。
+ここでは役割・スキル・出力形式などの静的な部分をターンをまたいで同一のバイト列に保ち、
+変化する <CurrentState> は末尾のメッセージとして渡す。
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Optional
+
+_STATE_PLACEHOLDER_LINE_RE = re.compile(r"^[ \t]*\{current_state_xml\}[ \t]*\n?", re.MULTILINE)
+_PLACEHOLDER_RE = re.compile(r"\{(current_state_xml|house|room)\}")
+
+
+def safe_format_prompt(template: str, **kwargs) -> str:
+    # {current_state_xml},{house},{room} だけを置換し、他の { ... } は触らない
+    return _PLACEHOLDER_RE.sub(lambda m: str(kwargs.get(m.group(1), m.group(0))), template)
+
+
+def build_static_system_prompt(template: str, *, house: str = "", room: str = "") -> str:
+    """{current_state_xml} を取り除いた、ターンをまたいで不変のシステムプロンプト。"""
+
+    without_state = _STATE_PLACEHOLDER_LINE_RE.sub("", template)
+    return safe_format_prompt(without_state, current_state_xml="", house=house, room=room)
+
+
+def build_planner_messages(
+    template: str,
+    context_messages: list[dict[str, Any]],
+    current_state_xml: str,
+    *,
+    house: str = "",
+    room: str = "",
+) -> list[dict[str, Any]]:
+    """[静的なシステムプロンプト] + 会話 + [現在の状態] の順でメッセージを並べる。"""
+
+    static_prompt = build_static_system_prompt(template, house=house, room=room)
+    return (
+        [{"role": "system", "content": static_prompt}]
+        + list(context_messages)
+        + [{"role": "system", "content": current_state_xml}]
+    )
+
+
+def prompt_cache_usage(usage: Any) -> Optional[dict[str, int]]:
+    """usage からキャッシュ済み／未キャッシュのプロンプトトークン数を取り出す。"""
+
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "uncached_tokens": max(0, prompt_tokens - cached_tokens),
+    }
@@ -0,0 +1,230 @@
+"""保存済みの実験セッションを ExternalStateManager 上で再実行（リプレイ）して検証する。
+
+ESM の状態更新は行動の文字列だけで決まるので、初期状態と実行した行動の列があれば
+どのセッションの状態もオフラインで作り直せる。インタプリタ（utils/esm.py）を変えたときに
+全セッションを再実行し、保存済みの状態履歴（4_current_state）と食い違うものを洗い出す。
+
+    python -m utils.replay archive/json/experiment_2_results.jsonl
+    python -m utils.replay --details results.jsonl > replay_report.jsonl
+
+行動の列は、会話履歴（3_conversation_history）の実行ログ（「（実行完了: ...」）から取り出す。
+状態が変わらなかった行動は状態履歴に残らないため、会話履歴を優先し、
+実行ログが無いセッションだけ状態履歴の metadata（action / actions）を使う。
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+
+from utils.context_window import EXECUTION_LOG_PREFIX, execution_log_action
+from utils.esm import ExternalStateManager, history_state_keys, snapshot_key
+
+STATE_HISTORY_KEY = "4_current_state"
+CONVERSATION_KEY = "3_conversation_history"
+
+
+def stored_state_history(entry: dict[str, Any], *, with_keys: bool = False):
+    """保存済みの状態履歴を (各時点の記録, 各時点の状態キー) にする（無ければ空のリスト）。
+
+    各時点の記録は event / metadata を持つ辞書で、先頭は初期状態のスナップショット。
+    「初期状態 + 差分」の形（{"initial", "changes", "final"}）と、
+    以前のスナップショットのリストの形の両方を読む。状態キーは with_keys=True のときだけ求める。
+    """
+
+    stored = entry.get(STATE_HISTORY_KEY)
+    if isinstance(stored, dict) and stored.get("initial"):
+        records = [stored["initial"], *(stored.get("changes") or [])]
+        return records, history_state_keys(stored) if with_keys else []
+    if isinstance(stored, list):
+        records = [snapshot for snapshot in stored if isinstance(snapshot, dict)]
+        return records, [snapshot_key(snapshot) for snapshot in records] if with_keys else []
+    return [], []
+
+
+def _conversation_events(entry: dict[str, Any]) -> list[tuple[str, str]]:
+    events: list[tuple[str, str]] = []
+    for message in entry.get(CONVERSATION_KEY) or []:
+        role = message.get("35_role")
+        content = message.get("31_content") or ""
+        if role == "assistant":
+            goal = message.get("33_task_goal_definition") or ""
+            if "Goal:" in goal:
+                events.append(("goal", goal))
+        elif role == "user" and content.startswith(EXECUTION_LOG_PREFIX):
+            action = execution_log_action({"content": content})
+            if action:
+                events.append(("action", action))
+    return events
+
+
+def _state_history_events(records: list[dict[str, Any]]) -> list[tuple[str, str]]:
+    events: list[tuple[str, str]] = []
+    for record in records:
+        metadata = record.get("metadata") or {}
+        if metadata.get("raw"):
+            events.append(("goal", metadata["raw"]))
+        if metadata.get("action"):
+            events.append(("action", metadata["action"]))
+        for action in metadata.get("actions") or []:
+            events.append(("action", action))
+    return events
+
+
+def session_events(entry: dict[str, Any], records: Optional[list[dict[str, Any]]] = None):
+    """セッションで起きたこと（("goal", 文字列) / ("action", 行動)）の列と、その出どころを返す。"""
+
+    events = _conversation_events(entry)
+    if any(kind == "action" for kind, _ in events):
+        return events, "conversation"
+    if records is None:
+        records = stored_state_history(entry)[0]
+    events = _state_history_events(records)
+    if events:
+        return events, "state_history"
+    return [], "none"
+
+
+def _initial_state(records: list[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    if not records:
+        return None
+    initial = records[0]
+    return {
+        "robot_status": initial.get("robot_status", {}),
+        "environment": initial.get("environment", {}),
+        "known_item_locations": initial.get("known_locations", {}),
+        "open_locations": initial.get("open_locations", []),
+    }
+
+
+def _first_unmatched(stored_keys: list[tuple], replayed_keys: list[tuple]) -> Optional[int]:
+    """保存済みの各時点が、リプレイで通った状態の列に順番どおり現れるか。現れない最初の位置を返す。"""
+
+    position = 0
+    for index, key in enumerate(stored_keys):
+        while position < len(replayed_keys) and replayed_keys[position] != key:
+            position += 1
+        if position == len(replayed_keys):
+            return index
+    return None
+
+
+def replay_session(entry: dict[str, Any], *, verify: bool = True):
+    """1 セッションをリプレイし、(ESM, 結果) を返す。
+
+    結果の verified は、保存済みの状態履歴と一致すれば True、食い違えば False、
+    比較できる履歴が無ければ None。
+    """
+
+    records, stored_keys = stored_state_history(entry, with_keys=verify)
+    events, source = session_events(entry, records)
+    esm = ExternalStateManager(_initial_state(records), verbose=False)
+
+    statuses: Counter = Counter()
+    replayed_keys = [esm.state_key()]
+    goal_set = False
+    for kind, value in events:
+        if kind == "goal":
+            # 画面側と同じく、最初にパースできた目標だけを使う
+            if not goal_set:
+                goal_set = esm.set_task_goal_from_llm(value)
+            continue
+        step = esm.apply_actions([value])[0]
+        statuses[step["status"]] += 1
+        replayed_keys.append(esm.state_key())
+
+    result: dict[str, Any] = {
+        "document_id": entry.get("document_id", ""),
+        "source": source,
+        "actions": sum(statuses.values()),
+        "statuses": dict(statuses),
+        "verified": None,
+    }
+    if verify and stored_keys:
+        unmatched = _first_unmatched(stored_keys, replayed_keys)
+        if unmatched is None and stored_keys[-1] != replayed_keys[-1]:
+            # 途中の時点はすべて現れたが、最後の状態が違う（保存後に余分な行動を再生した）
+            unmatched = len(stored_keys) - 1
+        result["verified"] = unmatched is None
+        if unmatched is not None:
+            record = records[unmatched]
+            result["mismatch"] = {
+                "snapshot_index": unmatched,
+                "event": record.get("event", ""),
+                "metadata": record.get("metadata") or {},
+            }
+    return esm, result
+
+
+def replay_sessions(entries: Iterable[dict[str, Any]], *, verify: bool = True) -> Iterator[dict[str, Any]]:
+    for entry in entries:
+        yield replay_session(entry, verify=verify)[1]
+
+
+def summarize_replays(results: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    results = list(results)
+    statuses: Counter = Counter()
+    for result in results:
+        statuses.update(result["statuses"])
+    return {
+        "sessions": len(results),
+        "verified": sum(1 for r in results if r["verified"] is True),
+        "mismatched": sum(1 for r in results if r["verified"] is False),
+        "unverifiable": sum(1 for r in results if r["verified"] is None),
+        "actions": sum(r["actions"] for r in results),
+        "statuses": dict(statuses),
+        "mismatched_sessions": [
+            {"document_id": r["document_id"], **r["mismatch"]} for r in results if r["verified"] is False
+        ],
+    }
+
+
+def _load_jsonl(path: Path) -> list[dict[str, Any]]:
+    entries = []
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="保存済みセッションの ESM リプレイと検証")
+    parser.add_argument("paths", nargs="+", type=Path, help="実験結果の JSONL ファイル")
+    parser.add_argument("--details", action="store_true", help="セッションごとの結果を 1 行ずつ出力する")
+    parser.add_argument("--no-verify", action="store_true", help="保存済みの状態履歴との比較を行わない")
+    args = parser.parse_args(argv)
+
+    entries: list[dict[str, Any]] = []
+    for path in args.paths:
+        entries.extend(_load_jsonl(path))
+
+    started = time.perf_counter()
+    results = list(replay_sessions(entries, verify=not args.no_verify))
+    elapsed = time.perf_counter() - started
+
+    if args.details:
+        for result in results:
+            sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+        return 0
+    summary = summarize_replays(results)
+    summary["elapsed_s"] = round(elapsed, 4)
+    summary["sessions_per_s"] = round(len(results) / elapsed, 1) if elapsed > 0 else None
+    json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    # 食い違いがあれば終了コード 1（CI などで使えるように）
+    return 1 if summary["mismatched"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""アシスタント応答（XML タグ付きの自由文）を 1 回の走査で解析する。
+
+応答 1 件に対して SpokenResponse / TaskGoalDefinition / FunctionSequence の抽出、
+タグの除去、<li> の取り出し、番号付き手順の分解がそれぞれ正規表現で何度も走っていた。
+ここではタグを 1 回だけ字句解析して ParsedReply にまとめ、結果を
+文字列ごと（parse_reply）と会話のメッセージごと（parsed_message）にキャッシュする。
+
+タグの対応付けは従来の正規表現（<Tag>([\\s\\S]*?)</Tag>、大文字小文字を区別しない）と同じく、
+開始タグの後で最初に現れる同名の終了タグまでを 1 つの範囲とする。
+受信途中の応答（ストリーミング）は StreamingTagParser で、チャンクごとにイベントとして解析する。
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from typing import Any, Iterable, NamedTuple, Optional, Union
+
+# 範囲の対応付けに使う、属性の無い開始・終了タグ（従来の <Tag> / </Tag> の照合と同じ）
+SIMPLE_TAG_RE = re.compile(r"<(/?)([A-Za-z0-9_]+)>")
+# タグの除去（strip_tags）。属性付きのタグも除く
+TAG_RE = re.compile(r"</?([A-Za-z0-9_]+)(\s[^>]*)?>")
+LIST_ITEM_RE = re.compile(r"<li>(.*?)</li>")
+# "1. go to ..." などの番号付き手順
+STEP_RE = re.compile(r"^\s*\d+\.\s*(.*)", re.MULTILINE)
+
+PARSED_REPLY_KEY = "parsed_reply"
+PARSE_CACHE_SIZE = 512
+
+
+@dataclass(frozen=True)
+class TagSpan:
+    """応答中の <Tag>...</Tag> 1 つ分"""
+
+    name: str    # 応答に書かれていた表記のタグ名
+    start: int   # 開始タグの先頭
+    end: int     # 終了タグの末尾
+    inner: str   # 開始タグと終了タグの間（前後の空白も含む）
+    outer: str   # 開始タグから終了タグまで
+
+
+@dataclass(frozen=True)
+class ParsedReply:
+    text: str
+    spans: dict[str, tuple[TagSpan, ...]] = field(repr=False)  # 小文字のタグ名 -> 出現順の範囲
+    unclosed: dict[str, int] = field(repr=False)               # 閉じていないタグ -> 開始タグ直後の位置
+
+    @cached_property
+    def plain_text(self) -> str:
+        """タグをすべて除いた本文（必要になったときに 1 度だけ求める）"""
+        return TAG_RE.sub("", self.text).strip()
+
+    def span(self, tag: str) -> Optional[TagSpan]:
+        found = self.spans.get(tag.lower())
+        return found[0] if found else None
+
+    def tag(self, tag: str) -> Optional[str]:
+        """最初の <tag> の中身（前後の空白を除く）。無ければ None"""
+        span = self.span(tag)
+        return span.inner.strip() if span else None
+
+    def tag_or_tail(self, tag: str) -> Optional[str]:
+        """<tag> の中身。閉じタグが無い場合は開始タグから末尾まで（生成途中や欠落への備え）"""
+        span = self.span(tag)
+        if span:
+            return span.inner.strip()
+        position = self.unclosed.get(tag.lower())
+        return self.text[position:].strip() if position is not None else None
+
+    def tags_within(self, outer: str, inner: str) -> list[str]:
+        """最初の <outer> の中にある <inner> の中身をすべて（出現順、空白はそのまま）"""
+        container = self.span(outer)
+        if not container:
+            return []
+        return [
+            span.inner
+            for span in self.spans.get(inner.lower(), ())
+            if container.start <= span.start and span.end <= container.end
+        ]
+
+    def list_items(self, tag: str) -> list[str]:
+        """<tag> の中の <li> 項目（従来どおり 1 行に収まっているものだけ）"""
+        span = self.span(tag)
+        return LIST_ITEM_RE.findall(span.inner) if span else []
+
+    @property
+    def spoken_response(self) -> Optional[str]:
+        return self.tag("SpokenResponse")
+
+    @property
+    def task_goal_definition(self) -> Optional[str]:
+        return self.tag("TaskGoalDefinition")
+
+    @property
+    def function_sequence(self) -> Optional[str]:
+        return self.tag("FunctionSequence")
+
+    @property
+    def steps(self) -> list[str]:
+        """FunctionSequence の番号付き手順（番号を除いたもの）"""
+        return parse_steps(self.function_sequence)
+
+
+def parse_steps(sequence: Optional[str]) -> list[str]:
+    if not sequence:
+        return []
+    return [step.strip() for step in STEP_RE.findall(sequence)]
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(text: str) -> ParsedReply:
+    spans: dict[str, list[TagSpan]] = {}
+    pending: dict[str, tuple[int, int, str]] = {}   # 小文字のタグ名 -> (開始位置, 中身の開始位置, 表記)
+    for match in SIMPLE_TAG_RE.finditer(text):
+        name = match.group(2)
+        key = name.lower()
+        if match.group(1):
+            opened = pending.pop(key, None)
+            if opened is not None:
+                start, inner_start, written = opened
+                spans.setdefault(key, []).append(
+                    TagSpan(written, start, match.end(), text[inner_start:match.start()], text[start:match.end()])
+                )
+        elif key not in pending:
+            pending[key] = (match.start(), match.end(), name)
+
+    return ParsedReply(
+        text=text,
+        spans={key: tuple(found) for key, found in spans.items()},
+        unclosed={key: inner_start for key, (_, inner_start, _) in pending.items()},
+    )
+
+
+def parse_reply(reply: Union[str, ParsedReply, None]) -> ParsedReply:
+    """応答を解析する（同じ文字列はキャッシュから返す）。解析済みのものはそのまま返す。"""
+
+    if isinstance(reply, ParsedReply):
+        return reply
+    return _parse(reply or "")
+
+
+def message_reply_text(message: dict[str, Any]) -> str:
+    """メッセージの応答本文（タグ付きの full_reply があればそちら）"""
+
+    text = message.get("full_reply") or message.get("content")
+    return text if isinstance(text, str) else ""
+
+
+def parsed_message(message: dict[str, Any]) -> ParsedReply:
+    """会話のメッセージを解析し、結果をメッセージ自身に持たせる（再描画のたびに解析しない）。"""
+
+    text = message_reply_text(message)
+    cached = message.get(PARSED_REPLY_KEY)
+    if isinstance(cached, ParsedReply) and cached.text == text:
+        return cached
+    parsed = parse_reply(text)
+    message[PARSED_REPLY_KEY] = parsed
+    return parsed
+
+
+# ---- ストリーミング（受信途中の応答）の逐次解析 ----
+
+TAG_OPENED = "open"
+TEXT_DELTA = "text"
+TAG_CLOSED = "close"
+STEP_COMPLETED = "step"
+
+# 受信途中のタグ断片（"</Spo" など）。これより長いものはタグではなく本文として扱う
+PARTIAL_TAG_RE = re.compile(r"</?[A-Za-z0-9_]*")
+MAX_PARTIAL_TAG_LENGTH = 64
+# 手順 1 行（STEP_RE の 1 行版）
+STEP_LINE_RE = re.compile(r"\s*\d+\.\s*(.*)")
+
+
+class StreamEvent(NamedTuple):
+    kind: str     # TAG_OPENED / TEXT_DELTA / TAG_CLOSED / STEP_COMPLETED
+    tag: str      # タグ名（応答の表記）。タグの外の本文は ""
+    text: str = ""  # TEXT_DELTA: 増えた本文、TAG_CLOSED: 中身（capture_tags のみ）、STEP_COMPLETED: 手順
+
+
+class StreamingTagParser:
+    """チャンクを受け取るたびにイベントを返す、押し込み型のタグ解析器。
+
+    受信済みの全文は持たず、保持するのは開いているタグの名前、受信途中のタグ断片、
+    step_tags の現在の 1 行、capture_tags の中身だけ（応答の長さに依らない）。
+    タグの対応付けは parse_reply と同じく、開始タグの後で最初に現れる同名の終了タグまでで、
+    タグ同士の入れ子は問わない（中身には他のタグの表記もそのまま含む）。
+    step_tags の中の番号付きの行は、改行（または閉じタグ）を受信した時点で STEP_COMPLETED になる。
+    """
+
+    def __init__(
+        self,
+        *,
+        capture_tags: Iterable[str] = (),
+        step_tags: Iterable[str] = ("FunctionSequence",),
+    ) -> None:
+        self._capture_keys = {tag.lower() for tag in capture_tags}
+        self._step_keys = {tag.lower() for tag in step_tags}
+        self._open: dict[str, str] = {}               # 小文字のタグ名 -> 表記（開いた順）
+        self._captures: dict[str, list[str]] = {}
+        self._step_tag: Optional[str] = None          # 手順を拾っている step_tags のタグ（小文字）
+        self._step_line: list[str] = []
+        self._partial = ""
+
+    @property
+    def open_tags(self) -> list[str]:
+        return list(self._open.values())
+
+    def captured(self, tag: str) -> Optional[str]:
+        """開いている capture_tags のタグの、ここまでに受信した中身（受信途中のタグ断片は含まない）"""
+        captured = self._captures.get(tag.lower())
+        return "".join(captured) if captured is not None else None
+
+    def feed(self, chunk: str) -> list[StreamEvent]:
+        events: list[StreamEvent] = []
+        data = self._partial + chunk
+        self._partial = ""
+        position = 0
+        while position < len(data):
+            bracket = data.find("<", position)
+            if bracket == -1:
+                self._text(data[position:], events)
+                break
+            if bracket > position:
+                self._text(data[position:bracket], events)
+            match = SIMPLE_TAG_RE.match(data, bracket)
+            if match:
+                self._tag(match, events)
+                position = match.end()
+            elif len(data) - bracket <= MAX_PARTIAL_TAG_LENGTH and PARTIAL_TAG_RE.fullmatch(data, bracket):
+                # 残りは次のチャンクで完成するかもしれない
+                self._partial = data[bracket:]
+                break
+            else:
+                self._text("<", events)
+                position = bracket + 1
+        return events
+
+    def close(self) -> list[StreamEvent]:
+        """ストリームの終わり。閉じていないタグは閉じずに残す（途中で切れた応答）"""
+        events: list[StreamEvent] = []
+        if self._partial:
+            partial, self._partial = self._partial, ""
+            self._text(partial, events)
+        return events
+
+    def _text(self, text: str, events: list[StreamEvent]) -> None:
+        if not text:
+            return
+        self._raw(text, events)
+        tag = next(reversed(self._open.values()), "")
+        if events and events[-1].kind == TEXT_DELTA and events[-1].tag == tag:
+            events[-1] = StreamEvent(TEXT_DELTA, tag, events[-1].text + text)
+        else:
+            events.append(StreamEvent(TEXT_DELTA, tag, text))
+
+    def _raw(self, text: str, events: list[StreamEvent]) -> None:
+        """開いているタグの中身として text（他のタグの表記も含む）を受け取る"""
+        for captured in self._captures.values():
+            captured.append(text)
+        if self._step_tag is None:
+            return
+        *completed, rest = text.split("\n")
+        for line in completed:
+            self._step_line.append(line)
+            self._flush_step(events)
+        self._step_line.append(rest)
+
+    def _flush_step(self, events: list[StreamEvent]) -> None:
+        line = "".join(self._step_line)
+        self._step_line = []
+        match = STEP_LINE_RE.match(line)
+        if match and self._step_tag is not None:
+            events.append(StreamEvent(STEP_COMPLETED, self._open[self._step_tag], match.group(1).strip()))
+
+    def _tag(self, match: re.Match, events: list[StreamEvent]) -> None:
+        markup, closing, name = match.group(0), match.group(1), match.group(2)
+        key = name.lower()
+        if closing:
+            if key not in self._open:
+                self._text(markup, events)
+                return
+            if key == self._step_tag:
+                self._flush_step(events)
+                self._step_tag = None
+            written = self._open.pop(key)
+            captured = self._captures.pop(key, None)
+            self._raw(markup, events)
+            events.append(StreamEvent(TAG_CLOSED, written, "".join(captured) if captured is not None else ""))
+            return
+        if key in self._open:
+            # 同名のタグが閉じる前の開始タグは本文として扱う（parse_reply と同じ）
+            self._text(markup, events)
+            return
+        self._raw(markup, events)
+        self._open[key] = name
+        if key in self._capture_keys:
+            self._captures[key] = []
+        if key in self._step_keys and self._step_tag is None:
+            self._step_tag = key
+            self._step_line = []
+        events.append(StreamEvent(TAG_OPENED, name, ""))
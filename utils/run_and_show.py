@@ -1,41 +1,35 @@
 import streamlit as st
-import re
+from utils.reply_parser import parse_reply
 from utils.strips import parse_step
 from archive.move_functions import move_to, pick_object, place_object_next_to, place_object_on, detect_object
 
-def show_function_sequence(reply: str):
+# reply は応答の文字列か、解析済みの ParsedReply（utils.reply_parser.parsed_message など）
+
+def show_function_sequence(reply):
     """<FunctionSequence> ... </FunctionSequence> をコードブロックで表示"""
-    func_match = re.search(r"<FunctionSequence>([\s\S]*?)</FunctionSequence>", reply, re.IGNORECASE)
-    if not func_match:
+    func_span = parse_reply(reply).span("FunctionSequence")
+    if not func_span:
         return
     st.markdown("#### ロボット行動計画")
-    st.code(func_match.group(0), language="xml")
+    st.code(func_span.outer, language="xml")
 
-def show_spoken_response(reply: str):
+def show_spoken_response(reply):
     """<SpokenResponse> ... </SpokenResponse> を通常のテキストで表示"""
-    q_match = re.search(
-        r"<SpokenResponse>([\s\S]*?)</SpokenResponse>",
-        reply,
-        re.IGNORECASE,
-    )
-    if q_match:
-        response_text = q_match.group(1)
-    else:
-        fallback_match = re.search(r"<SpokenResponse>([\s\S]*)", reply, re.IGNORECASE)
-        if not fallback_match:
-            return
-        response_text = fallback_match.group(1)
+    # 閉じタグが無い場合は末尾までを発言とみなす
+    response_text = parse_reply(reply).tag_or_tail("SpokenResponse")
+    if response_text is None:
+        return
     st.markdown("#### ロボットの発言")
-    st.write(response_text.strip())
+    st.write(response_text)
 
 
-def show_information(reply: str):
+def show_information(reply):
     """<Information> ... </Information> を蓄積して表示"""
-    info_match = re.search(r"<Information>([\s\S]*?)</Information>", reply, re.IGNORECASE)
-    if not info_match:
+    parsed = parse_reply(reply)
+    if not parsed.span("Information"):
         return
 
-    items = re.findall(r"<li>(.*?)</li>", info_match.group(1))
+    items = parsed.list_items("Information")
     if "information_items" not in st.session_state:
         st.session_state.information_items = []
     for item in items:
@@ -47,23 +41,18 @@ def show_information(reply: str):
     st.markdown("<ul>" + aggregated + "</ul>", unsafe_allow_html=True)
 
 
-def show_provisional_output(reply: str):
+def show_provisional_output(reply):
     """<ProvisionalOutput> 内の関数列と確認質問のみを表示"""
-    prov_match = re.search(
-        r"<ProvisionalOutput>([\s\S]*?)</ProvisionalOutput>", reply, re.IGNORECASE
-    )
-    if not prov_match:
+    prov_span = parse_reply(reply).span("ProvisionalOutput")
+    if not prov_span:
         return
-    provisional = prov_match.group(1)
+    provisional = parse_reply(prov_span.inner)
     show_function_sequence(provisional)
     show_spoken_response(provisional)
 
-def run_plan_and_show(reply: str):
+def run_plan_and_show(reply):
     """<FunctionSequence> を見つけて実行し、結果を表示"""
-    func_match = re.search(r"<FunctionSequence>(.*?)</FunctionSequence>", reply, re.S)
-    if not func_match:
-        return
-    steps = re.findall(r"<Updated>(.*?)</Updated>", func_match.group(1))
+    steps = parse_reply(reply).tags_within("FunctionSequence", "Updated")
     if not steps:
         return
 
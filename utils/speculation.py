@@ -0,0 +1,153 @@
+"""行動計画キューの実行中に、次の計画を先読み（投機実行）する。
+
+キューに残っている行動は ExternalStateManager.update_state_from_action で決定的に
+状態へ反映されるため、ESM のコピー上で残りを実行すれば、キューが空になった時点で
+LLM に送るメッセージを事前に組み立てられる。そのリクエストを裏で投げておき、
+実際の呼び出し時にメッセージが一致すればその応答を使う。
+ユーザーが介入した場合など、メッセージが変わったときは破棄する。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+import streamlit as st
+
+from utils.context_window import execution_log_message
+from utils.llm_gateway import submit_chat_completion
+from utils.llm_metrics import build_call_record, record_llm_call, session_metrics_sink
+
+SPECULATION_KEY = "speculative_next_plan"
+
+
+def messages_fingerprint(messages: list[dict[str, Any]]) -> str:
+    """API に送る内容（role / content）だけから求めたハッシュ。"""
+
+    payload = [{"role": m.get("role"), "content": m.get("content")} for m in messages]
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def simulate_queue(esm, context: list[dict[str, Any]], queue: list[str]):
+    """ESM の分岐（fork）上でキューを最後まで実行し、(分岐した ESM, 予測される会話) を返す。"""
+
+    simulated_esm = esm.fork(verbose=False)
+    predicted_context = list(context)
+    for action in queue:
+        execution_log = simulated_esm.update_state_from_action(action)
+        predicted_context.append(execution_log_message(action, execution_log))
+    return simulated_esm, predicted_context
+
+
+def _record_speculative_call(
+    future: Future,
+    *,
+    page: Optional[str],
+    started: float,
+    sink: Optional[list[dict[str, Any]]],
+    **flags: Any,
+) -> None:
+    # イベントループのスレッドで呼ばれるので、投入時に取っておいたセッションの記録先に積む
+    if future.cancelled() or future.exception() is not None:
+        return
+    response = future.result()
+    record = build_call_record(
+        model=getattr(response, "model", None) or "",
+        usage=getattr(response, "usage", None),
+        wall_time_s=time.monotonic() - started,
+        page=page,
+    )
+    record["speculative"] = True
+    record.update(flags)
+    record_llm_call(record, sink=sink)
+
+
+def ensure_speculation(
+    esm,
+    context: list[dict[str, Any]],
+    queue: list[str],
+    build_messages: Callable[[list[dict[str, Any]], str], list[dict[str, Any]]],
+    *,
+    page: Optional[str] = None,
+    params: Optional[dict[str, Any]] = None,
+    state_encoding: str = "repr",
+) -> None:
+    """キューを実行し終えた後のメッセージで次の計画を先に要求しておく。
+
+    build_messages(context, current_state_xml)、params（response_format など）、
+    state_encoding（get_state_as_xml_prompt の書式）は実際の呼び出しと同じものを渡すこと。
+    同じメッセージの先読みが既にあれば何もしない。
+    """
+
+    if not queue:
+        return
+    simulated_esm, predicted_context = simulate_queue(esm, context, queue)
+    messages = build_messages(predicted_context, simulated_esm.get_state_as_xml_prompt(state_encoding))
+    fingerprint = messages_fingerprint(messages)
+
+    current = st.session_state.get(SPECULATION_KEY)
+    if current and current["fingerprint"] == fingerprint:
+        return
+    discard_speculation()
+    st.session_state[SPECULATION_KEY] = {
+        "fingerprint": fingerprint,
+        "future": submit_chat_completion(messages, page=page, **(params or {})),
+        "started": time.monotonic(),
+        "page": page,
+        "metrics_sink": session_metrics_sink(),
+    }
+    print(f"[Speculation] prefetching next plan for {len(queue)} queued action(s)")
+
+
+def take_speculative_reply(messages: list[dict[str, Any]]):
+    """先読みしたメッセージと一致すれば、その ChatCompletion を返す（未完了なら待つ）。
+
+    一致しない、または先読みが失敗していた場合は None を返す。
+    """
+
+    current = st.session_state.pop(SPECULATION_KEY, None)
+    if not current:
+        return None
+    if current["fingerprint"] != messages_fingerprint(messages):
+        _discard(current)
+        return None
+    waited_from = time.monotonic()
+    try:
+        response = current["future"].result()
+    except Exception as exc:
+        # 先読みが失敗しても、通常の呼び出しでやり直せばよい
+        print(f"[Speculation] prefetch failed, falling back to a fresh request: {exc}")
+        return None
+    record = build_call_record(
+        model=getattr(response, "model", None) or "",
+        usage=getattr(response, "usage", None),
+        wall_time_s=time.monotonic() - waited_from,
+        page=current["page"],
+    )
+    record["speculative"] = True
+    record["speculation_lead_s"] = round(waited_from - current["started"], 4)
+    record_llm_call(record)
+    print(f"[Speculation] used prefetched plan (lead {record['speculation_lead_s']}s)")
+    return response
+
+
+def _discard(current: dict[str, Any]) -> None:
+    # 実行中のリクエストは止められないので、完了後に無駄になったトークンだけ記録する
+    current["future"].add_done_callback(
+        lambda f: _record_speculative_call(
+            f, page=current["page"], started=current["started"], sink=current["metrics_sink"], discarded=True
+        )
+    )
+    print("[Speculation] discarded prefetched plan")
+
+
+def discard_speculation() -> None:
+    """ユーザーの介入などで先読みが使えなくなったときに呼ぶ。"""
+
+    current = st.session_state.pop(SPECULATION_KEY, None)
+    if current:
+        _discard(current)
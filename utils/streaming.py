@@ -0,0 +1,69 @@
+"""ストリーミング応答を逐次表示するためのヘルパー。"""
+
+from __future__ import annotations
+
+from typing import Callable, Iterable, Optional, Sequence
+
+from utils.reply_parser import STEP_COMPLETED, TAG_CLOSED, StreamingTagParser
+
+SPOKEN_RESPONSE_TAG = "SpokenResponse"
+DEFAULT_WATCH_TAGS: tuple[str, ...] = ("TaskGoalDefinition", "FunctionSequence")
+
+
+def stream_chat_reply(
+    stream: Iterable,
+    placeholder,
+    *,
+    on_tag_closed: Optional[Callable[[str, str], None]] = None,
+    on_step: Optional[Callable[[str], None]] = None,
+    watch_tags: Sequence[str] = DEFAULT_WATCH_TAGS,
+) -> str:
+    """ストリームを読みながら <SpokenResponse> を placeholder に表示し、全文を返す。
+
+    watch_tags のタグは閉じタグを受信した時点で on_tag_closed(tag, content) を呼ぶ。
+    <FunctionSequence> の番号付きの手順は、1 行受信し終えるたびに on_step(step) を呼ぶ。
+    受信済みの全文を毎回解析し直さず、StreamingTagParser にチャンクを渡すだけにしている。
+    """
+
+    watched = {tag.lower(): tag for tag in watch_tags}
+    parser = StreamingTagParser(capture_tags=(SPOKEN_RESPONSE_TAG, *watch_tags))
+    chunks: list[str] = []
+    spoken_text: Optional[str] = None  # 閉じた最初の SpokenResponse の中身
+    shown_text = ""
+
+    def handle(events) -> None:
+        nonlocal spoken_text
+        for event in events:
+            if event.kind == TAG_CLOSED:
+                key = event.tag.lower()
+                if key == SPOKEN_RESPONSE_TAG.lower() and spoken_text is None:
+                    spoken_text = event.text.strip()
+                elif key in watched:
+                    tag = watched.pop(key)
+                    if on_tag_closed:
+                        on_tag_closed(tag, event.text.strip())
+            elif event.kind == STEP_COMPLETED and on_step:
+                on_step(event.text)
+
+    try:
+        for chunk in stream:
+            if not getattr(chunk, "choices", None):
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            chunks.append(delta)
+            handle(parser.feed(delta))
+
+            text = spoken_text if spoken_text is not None else (parser.captured(SPOKEN_RESPONSE_TAG) or "").strip()
+            if text and text != shown_text:
+                placeholder.markdown(text)
+                shown_text = text
+    finally:
+        # 途中で抜けた場合もストリームを閉じ、受信を打ち切らせる
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+    handle(parser.close())
+    return "".join(chunks)
@@ -1,7 +1,6 @@
 import streamlit as st
 import re
-
-TAG_RE = re.compile(r"</?([A-Za-z0-9_]+)(\s[^>]*)?>")
+from utils.reply_parser import parse_reply
 
 ROOM_TRANSLATIONS = {
     "BATHROOM": "洗面所",
@@ -15,12 +14,11 @@ ROOM_TRANSLATIONS = {
 
 SELF_CLOSING_MOVE_TO_RE = re.compile(r"<move_to\s+room_name=['\"](.*?)['\"]\s*/>", re.IGNORECASE)
 
-def strip_tags(text: str) -> str:
-    return TAG_RE.sub("", text or "").strip()
+def strip_tags(text) -> str:
+    return parse_reply(text).plain_text
 
-def extract_between(tag: str, text: str) -> str | None:
-    m = re.search(fr"<{tag}>([\s\S]*?)</{tag}>", text or "", re.IGNORECASE)
-    return m.group(1).strip() if m else None
+def extract_between(tag: str, text) -> str | None:
+    return parse_reply(text).tag(tag)
 
 def _normalize_step(step: str) -> str:
     def repl(match: re.Match) -> str:
@@ -0,0 +1,145 @@
+"""プランナー応答の構造化出力（JSON Schema）モード。
+
+通常の応答は XML タグ付きの自由文で、正規表現で各タグを取り出している。
+このモードでは response_format に JSON Schema を指定して
+spoken_response / task_goal / function_sequence / clarifying_question を直接受け取る。
+会話履歴（full_reply）や保存処理は XML を前提にしているため、同等の XML にも変換できる。
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Optional
+
+PLANNER_REPLY_SCHEMA: dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+        "spoken_response": {
+            "type": "string",
+            "description": "ユーザーへの発話（SpokenResponse に相当）",
+        },
+        "clarifying_question": {
+            "type": ["string", "null"],
+            "description": "確認したいことがあるときの質問。質問しない場合は null",
+        },
+        "task_goal": {
+            "description": "ゴールが確定したターンにだけ一度出力する（TaskGoalDefinition に相当）。それ以外は null",
+            "anyOf": [
+                {"type": "null"},
+                {
+                    "type": "object",
+                    "additionalProperties": False,
+                    "properties": {
+                        "target_location": {"type": "string"},
+                        "items_needed": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "additionalProperties": False,
+                                "properties": {
+                                    "item": {"type": "string"},
+                                    "count": {"type": "integer"},
+                                },
+                                "required": ["item", "count"],
+                            },
+                        },
+                    },
+                    "required": ["target_location", "items_needed"],
+                },
+            ],
+        },
+        "function_sequence": {
+            "type": "array",
+            "description": "AvailableSkills のパターンに従った 1 ステップ 1 文の行動計画。質問したターンは空配列",
+            "items": {"type": "string"},
+        },
+    },
+    "required": ["spoken_response", "clarifying_question", "task_goal", "function_sequence"],
+}
+
+PLANNER_RESPONSE_FORMAT: dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "planner_reply",
+        "strict": True,
+        "schema": PLANNER_REPLY_SCHEMA,
+    },
+}
+
+# OutputFormat の XML 指定を上書きする。ターンをまたいで不変なのでプロンプトキャッシュは効く
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "<StructuredOutput>\n"
+    "この会話では XML タグではなく、指定された JSON スキーマで出力してください。\n"
+    "各フィールドは OutputFormat のタグに対応します: "
+    "spoken_response=<SpokenResponse>, clarifying_question=<ClarifyingQuestion>, "
+    "task_goal=<TaskGoalDefinition>, function_sequence=<FunctionSequence>。\n"
+    "function_sequence の各要素は番号を付けず、スキル文を 1 つだけ書いてください。\n"
+    "</StructuredOutput>"
+)
+
+
+def parse_structured_reply(content: str) -> dict[str, Any]:
+    """JSON 応答を読み、欠けたフィールドを補った dict を返す（不正な JSON は発話として扱う）。"""
+
+    try:
+        data = json.loads(content or "")
+    except json.JSONDecodeError:
+        print(f"[StructuredReply] invalid JSON reply: {content[:200] if content else content!r}")
+        data = {"spoken_response": content or ""}
+    if not isinstance(data, dict):
+        data = {"spoken_response": str(data)}
+
+    goal = data.get("task_goal")
+    if not isinstance(goal, dict) or not goal.get("target_location"):
+        goal = None
+    actions = [
+        action.strip()
+        for action in data.get("function_sequence") or []
+        if isinstance(action, str) and action.strip()
+    ]
+    return {
+        "spoken_response": (data.get("spoken_response") or "").strip(),
+        "clarifying_question": (data.get("clarifying_question") or "").strip() or None,
+        "task_goal": goal,
+        "function_sequence": actions,
+    }
+
+
+def items_needed_to_dict(items_needed: Any) -> dict[str, int]:
+    """[{"item": "皿", "count": 2}, ...] を ESM の items_needed 形式 {"皿": 2} にする。"""
+
+    needed: dict[str, int] = {}
+    for entry in items_needed or []:
+        if not isinstance(entry, dict):
+            continue
+        item = str(entry.get("item") or "").strip()
+        if not item:
+            continue
+        try:
+            count = int(entry.get("count") or 1)
+        except (TypeError, ValueError):
+            count = 1
+        needed[item] = needed.get(item, 0) + count
+    return needed
+
+
+def structured_reply_to_xml(data: dict[str, Any]) -> str:
+    """構造化応答を、通常モードと同じタグ構成の XML 文字列にする。"""
+
+    parts = [f"<SpokenResponse>\n{data.get('spoken_response') or ''}\n</SpokenResponse>"]
+    question: Optional[str] = data.get("clarifying_question")
+    if question:
+        parts.append(f"<ClarifyingQuestion>\n{question}\n</ClarifyingQuestion>")
+    goal = data.get("task_goal")
+    if goal:
+        goal_dict = {
+            "target_location": goal.get("target_location"),
+            "items_needed": items_needed_to_dict(goal.get("items_needed")),
+        }
+        parts.append(f"<TaskGoalDefinition>\nGoal: {goal_dict}\n</TaskGoalDefinition>")
+    steps = "\n".join(
+        f"{idx}. {action}" for idx, action in enumerate(data.get("function_sequence") or [], start=1)
+    )
+    parts.append(f"<FunctionSequence>\n{steps}\n</FunctionSequence>")
+    return "\n".join(parts)